@@ -6,6 +6,11 @@ from torch import nn, Tensor
 from torchvision import ops
 from torchvision.transforms import functional as F, InterpolationMode, transforms as T
 
+try:
+    from torchvision.transforms import _functional_tensor as F_t
+except ImportError:  # torchvision < 0.15
+    from torchvision.transforms import functional_tensor as F_t
+
 
 def _flip_coco_person_keypoints(kps, width):
     flip_inds = [0, 2, 1, 4, 3, 6, 5, 8, 7, 10, 9, 12, 11, 14, 13, 16, 15]
@@ -17,6 +22,50 @@ def _flip_coco_person_keypoints(kps, width):
     return flipped_data
 
 
+def _as_batch(images):
+    if isinstance(images, torch.Tensor):
+        if images.ndimension() != 4:
+            raise ValueError(f"images should be 4 dimensional. Got {images.ndimension()} dimensions.")
+        return images
+    return torch.stack(list(images))
+
+
+def _crop_batch(images: Tensor, top: Tensor, left: Tensor, height: int, width: int) -> Tensor:
+    # Crops a window of the same size at a different offset from every image in one indexing call
+    batch = torch.arange(len(images), device=images.device)[:, None, None]
+    rows = (top.to(images.device)[:, None] + torch.arange(height, device=images.device))[:, :, None]
+    cols = (left.to(images.device)[:, None] + torch.arange(width, device=images.device))[:, None, :]
+    return images[batch, :, rows, cols].permute(0, 3, 1, 2)
+
+
+def _paste_batch(canvas: Tensor, images: Tensor, top: Tensor, left: Tensor) -> Tensor:
+    # Inverse of _crop_batch, writes every image into the canvas at its own offset
+    _, _, height, width = images.shape
+    batch = torch.arange(len(images), device=images.device)[:, None, None]
+    rows = (top.to(images.device)[:, None] + torch.arange(height, device=images.device))[:, :, None]
+    cols = (left.to(images.device)[:, None] + torch.arange(width, device=images.device))[:, None, :]
+    canvas[batch, :, rows, cols] = images.permute(0, 2, 3, 1)
+    return canvas
+
+
+def _resize_masks(targets: List[Dict[str, Tensor]], size: List[int], antialias=True) -> None:
+    # The masks of all the images are resized together in a single call
+    with_masks = [target for target in targets if "masks" in target]
+    counts = [len(target["masks"]) for target in with_masks]
+    if sum(counts) == 0:
+        for target in with_masks:
+            target["masks"] = target["masks"].new_zeros((0, size[0], size[1]))
+        return
+    masks = F.resize(
+        torch.cat([target["masks"] for target in with_masks]),
+        size,
+        interpolation=InterpolationMode.NEAREST,
+        antialias=antialias,
+    )
+    for target, resized in zip(with_masks, masks.split(counts)):
+        target["masks"] = resized
+
+
 class Compose:
     def __init__(self, transforms):
         self.transforms = transforms
@@ -26,6 +75,38 @@ class Compose:
             image, target = t(image, target)
         return image, target
 
+    def forward_batch(self, images, targets):
+        """Applies the transforms to a batch of same-sized images at once.
+
+        Transforms with a ``forward_batch`` method process the whole (B, C, H, W) stack in one call. Random
+        parameters that change the output size are drawn once per batch so the stack keeps a single shape,
+        all others are drawn per image. Transforms without a batched version are applied image by image.
+
+        Args:
+            images (Tensor or list): (B, C, H, W) tensor, or a list of images of the same size.
+            targets (list of dicts): One target per image.
+        """
+        targets = list(targets)
+        for t in self.transforms:
+            if hasattr(t, "forward_batch"):
+                images, targets = t.forward_batch(images, targets)
+            else:
+                outputs = [t(image, target) for image, target in zip(images, targets)]
+                images = torch.stack([image for image, _ in outputs])
+                targets = [target for _, target in outputs]
+        return images, targets
+
+
+class BatchCollate:
+    """collate_fn for a DataLoader that stacks the samples and runs the batched transforms in the workers."""
+
+    def __init__(self, transforms: Compose):
+        self.transforms = transforms
+
+    def __call__(self, batch):
+        images, targets = zip(*batch)
+        return self.transforms.forward_batch(list(images), list(targets))
+
 
 class RandomHorizontalFlip(T.RandomHorizontalFlip):
     def forward(
@@ -38,12 +119,31 @@ class RandomHorizontalFlip(T.RandomHorizontalFlip):
                 target["boxes"][:, [0, 2]] = width - target["boxes"][:, [2, 0]]
                 if "masks" in target:
                     target["masks"] = target["masks"].flip(-1)
+                if "mask_crops" in target:
+                    _flip_mask_crops(target, width)
                 if "keypoints" in target:
                     keypoints = target["keypoints"]
                     keypoints = _flip_coco_person_keypoints(keypoints, width)
                     target["keypoints"] = keypoints
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        flip = torch.rand(len(images)) < self.p
+        images = torch.where(flip.to(images.device)[:, None, None, None], images.flip(-1), images)
+        width = images.shape[-1]
+        for target in [target for target, flipped in zip(targets, flip.tolist()) if flipped]:
+            target["boxes"][:, [0, 2]] = width - target["boxes"][:, [2, 0]]
+            if "masks" in target:
+                target["masks"] = target["masks"].flip(-1)
+            if "mask_crops" in target:
+                _flip_mask_crops(target, width)
+            if "keypoints" in target:
+                target["keypoints"] = _flip_coco_person_keypoints(target["keypoints"], width)
+        return images, targets
+
 
 class PILToTensor(nn.Module):
     def forward(
@@ -52,6 +152,9 @@ class PILToTensor(nn.Module):
         image = F.pil_to_tensor(image)
         return image, target
 
+    def forward_batch(self, images, targets: List[Dict[str, Tensor]]) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        return torch.stack([F.pil_to_tensor(image) for image in images]), targets
+
 
 class ToDtype(nn.Module):
     def __init__(self, dtype: torch.dtype, scale: bool = False) -> None:
@@ -67,6 +170,11 @@ class ToDtype(nn.Module):
         image = F.convert_image_dtype(image, self.dtype)
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        return self.forward(_as_batch(images), targets)
+
 
 class RandomIoUCrop(nn.Module):
     def __init__(
@@ -103,56 +211,94 @@ class RandomIoUCrop(nn.Module):
 
         _, orig_h, orig_w = F.get_dimensions(image)
 
+        crop = self._sample_crop(orig_h, orig_w, [target["boxes"]])
+        if crop is None:
+            return image, target
+
+        left, top, new_w, new_h, is_within_crop_area = crop
+        self._crop_target(target, is_within_crop_area, left, top, new_w, new_h)
+        image = F.crop(image, top, left, new_h, new_w)
+        return image, target
+
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        _, _, orig_h, orig_w = images.shape
+
+        # one crop for the whole batch, which has to satisfy the constraints of every image
+        crop = self._sample_crop(orig_h, orig_w, [target["boxes"] for target in targets])
+        if crop is None:
+            return images, targets
+
+        left, top, new_w, new_h, is_within_crop_area = crop
+        for target, is_within in zip(targets, is_within_crop_area.split([len(t["boxes"]) for t in targets])):
+            self._crop_target(target, is_within, left, top, new_w, new_h)
+        return images[..., top : top + new_h, left : left + new_w], targets
+
+    def _sample_crop(self, orig_h: int, orig_w: int, boxes: List[Tensor]):
+        # all the trials of an option are sampled and checked at once, against the boxes of every image
+        num_boxes = torch.tensor([len(b) for b in boxes])
+        boxes = torch.cat(boxes)
+        image_index = torch.repeat_interleave(torch.arange(len(num_boxes)), num_boxes).to(boxes.device)
+        cx = 0.5 * (boxes[:, 0] + boxes[:, 2])
+        cy = 0.5 * (boxes[:, 1] + boxes[:, 3])
+
         while True:
             # sample an option
             idx = int(torch.randint(low=0, high=len(self.options), size=(1,)))
             min_jaccard_overlap = self.options[idx]
             if min_jaccard_overlap >= 1.0:  # a value larger than 1 encodes the leave as-is option
-                return image, target
-
-            for _ in range(self.trials):
-                # check the aspect ratio limitations
-                r = self.min_scale + (self.max_scale - self.min_scale) * torch.rand(2)
-                new_w = int(orig_w * r[0])
-                new_h = int(orig_h * r[1])
-                aspect_ratio = new_w / new_h
-                if not (self.min_aspect_ratio <= aspect_ratio <= self.max_aspect_ratio):
-                    continue
-
-                # check for 0 area crops
-                r = torch.rand(2)
-                left = int((orig_w - new_w) * r[0])
-                top = int((orig_h - new_h) * r[1])
-                right = left + new_w
-                bottom = top + new_h
-                if left == right or top == bottom:
-                    continue
-
-                # check for any valid boxes with centers within the crop area
-                cx = 0.5 * (target["boxes"][:, 0] + target["boxes"][:, 2])
-                cy = 0.5 * (target["boxes"][:, 1] + target["boxes"][:, 3])
-                is_within_crop_area = (left < cx) & (cx < right) & (top < cy) & (cy < bottom)
-                if not is_within_crop_area.any():
-                    continue
-
-                # check at least 1 box with jaccard limitations
-                boxes = target["boxes"][is_within_crop_area]
-                ious = torchvision.ops.boxes.box_iou(
-                    boxes, torch.tensor([[left, top, right, bottom]], dtype=boxes.dtype, device=boxes.device)
-                )
-                if ious.max() < min_jaccard_overlap:
-                    continue
-
-                # keep only valid boxes and perform cropping
-                target["boxes"] = boxes
-                target["labels"] = target["labels"][is_within_crop_area]
-                target["boxes"][:, 0::2] -= left
-                target["boxes"][:, 1::2] -= top
-                target["boxes"][:, 0::2].clamp_(min=0, max=new_w)
-                target["boxes"][:, 1::2].clamp_(min=0, max=new_h)
-                image = F.crop(image, top, left, new_h, new_w)
+                return None
+
+            # check the aspect ratio limitations
+            r = self.min_scale + (self.max_scale - self.min_scale) * torch.rand(self.trials, 2)
+            new_w = (orig_w * r[:, 0]).long()
+            new_h = (orig_h * r[:, 1]).long()
+            aspect_ratio = new_w.double() / new_h
+            is_valid = (self.min_aspect_ratio <= aspect_ratio) & (aspect_ratio <= self.max_aspect_ratio)
+
+            # check for 0 area crops
+            r = torch.rand(self.trials, 2)
+            left = ((orig_w - new_w) * r[:, 0]).long()
+            top = ((orig_h - new_h) * r[:, 1]).long()
+            right = left + new_w
+            bottom = top + new_h
+            is_valid &= (left != right) & (top != bottom)
+
+            # check for any valid boxes with centers within the crop area
+            crops = torch.stack([left, top, right, bottom], dim=1).to(device=boxes.device, dtype=boxes.dtype)
+            is_within_crop_area = (
+                (crops[:, 0:1] < cx) & (cx < crops[:, 2:3]) & (crops[:, 1:2] < cy) & (cy < crops[:, 3:4])
+            )
 
-                return image, target
+            # check at least 1 box with jaccard limitations, in every image
+            ious = torchvision.ops.boxes.box_iou(crops, boxes).masked_fill(~is_within_crop_area, -1.0)
+            best_iou = ious.new_full((self.trials, len(num_boxes)), -1.0).scatter_reduce(
+                1, image_index.expand(self.trials, -1), ious, "amax"
+            )
+            is_valid &= (best_iou >= min_jaccard_overlap).all(dim=1).cpu()
+
+            # the first valid trial is the one the sequential search would have stopped at
+            if is_valid.any():
+                t = int(is_valid.nonzero()[0])
+                return int(left[t]), int(top[t]), int(new_w[t]), int(new_h[t]), is_within_crop_area[t]
+
+    @staticmethod
+    def _crop_target(target, is_within_crop_area, left, top, new_w, new_h):
+        # keep only valid boxes and perform cropping
+        target["boxes"] = target["boxes"][is_within_crop_area]
+        target["labels"] = target["labels"][is_within_crop_area]
+        target["boxes"][:, 0::2] -= left
+        target["boxes"][:, 1::2] -= top
+        target["boxes"][:, 0::2].clamp_(min=0, max=new_w)
+        target["boxes"][:, 1::2].clamp_(min=0, max=new_h)
+        if "masks" in target:
+            target["masks"] = target["masks"][is_within_crop_area, top : top + new_h, left : left + new_w]
+        if "mask_crops" in target:
+            target["mask_crops"] = target["mask_crops"][is_within_crop_area]
+            target["mask_offsets"] = target["mask_offsets"][is_within_crop_area]
+            _crop_mask_crops(target, top, left, new_h, new_w)
 
 
 class RandomZoomOut(nn.Module):
@@ -214,9 +360,69 @@ class RandomZoomOut(nn.Module):
         if target is not None:
             target["boxes"][:, 0::2] += left
             target["boxes"][:, 1::2] += top
+            if "masks" in target:
+                target["masks"] = F.pad(target["masks"], [left, top, right, bottom], 0, "constant")
+            if "mask_crops" in target:
+                target["mask_offsets"] = target["mask_offsets"] + target["mask_offsets"].new_tensor([top, left])
 
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        if torch.rand(1) >= self.p:
+            return images, targets
+
+        batch_size, channels, orig_h, orig_w = images.shape
+
+        # the canvas size is shared by the batch, the position of every image on it is not
+        r = self.side_range[0] + torch.rand(1) * (self.side_range[1] - self.side_range[0])
+        canvas_width = int(orig_w * r)
+        canvas_height = int(orig_h * r)
+
+        r = torch.rand(batch_size, 2)
+        left = ((canvas_width - orig_w) * r[:, 0]).long()
+        top = ((canvas_height - orig_h) * r[:, 1]).long()
+
+        v = torch.tensor(self.fill, device=images.device, dtype=images.dtype).view(1, -1, 1, 1)
+        canvas = v.expand(batch_size, channels, canvas_height, canvas_width).clone()
+        images = _paste_batch(canvas, images, top, left)
+
+        for target, dx, dy in zip(targets, left.tolist(), top.tolist()):
+            target["boxes"][:, 0::2] += dx
+            target["boxes"][:, 1::2] += dy
+            if "masks" in target:
+                padding = [dx, dy, canvas_width - orig_w - dx, canvas_height - orig_h - dy]
+                target["masks"] = F.pad(target["masks"], padding, 0, "constant")
+            if "mask_crops" in target:
+                target["mask_offsets"] = target["mask_offsets"] + target["mask_offsets"].new_tensor([dy, dx])
+
+        return images, targets
+
+
+def _blend(img1: Tensor, img2: Tensor, ratio: Tensor) -> Tensor:
+    # F_t._blend with one ratio per image
+    bound = 1.0 if img1.is_floating_point() else float(torch.iinfo(img1.dtype).max)
+    ratio = ratio.to(img1.device)
+    return (ratio * img1 + (1.0 - ratio) * img2).clamp(0, bound).to(img1.dtype)
+
+
+def _adjust_contrast(images: Tensor, factor: Tensor) -> Tensor:
+    dtype = images.dtype if torch.is_floating_point(images) else torch.float32
+    mean = torch.mean(F.rgb_to_grayscale(images).to(dtype), dim=(-3, -2, -1), keepdim=True)
+    return _blend(images, mean, factor)
+
+
+def _adjust_hue(images: Tensor, factor: Tensor) -> Tensor:
+    # F_t.adjust_hue with one hue shift per image
+    orig_dtype = images.dtype
+    images = F_t._rgb2hsv(F.convert_image_dtype(images, torch.float32))
+    h, s, v = images.unbind(dim=-3)
+    h = (h + factor.to(h.device)[:, 0]) % 1.0
+    images = F_t._hsv2rgb(torch.stack((h, s, v), dim=-3))
+    return F.convert_image_dtype(images, orig_dtype)
+
 
 class RandomPhotometricDistort(nn.Module):
     def __init__(
@@ -277,6 +483,45 @@ class RandomPhotometricDistort(nn.Module):
 
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images).clone()
+        batch_size, channels, _, _ = images.shape
+
+        # every image draws its own distortions, each one is applied to all the selected images at once
+        r = torch.rand(batch_size, 7)
+        contrast_before = r[:, 1] < 0.5
+
+        def factors(jitter):
+            return torch.empty(batch_size).uniform_(jitter[0], jitter[1]).view(-1, 1, 1, 1)
+
+        brightness = factors(self._brightness.brightness)
+        contrast = factors(self._contrast.contrast)
+        saturation = factors(self._saturation.saturation)
+        hue = factors(self._hue.hue)
+
+        apply = r[:, 0] < self.p
+        images[apply] = _blend(images[apply], torch.zeros_like(images[apply]), brightness[apply])
+
+        apply = contrast_before & (r[:, 2] < self.p)
+        images[apply] = _adjust_contrast(images[apply], contrast[apply])
+
+        apply = r[:, 3] < self.p
+        images[apply] = _blend(images[apply], F.rgb_to_grayscale(images[apply]), saturation[apply])
+
+        apply = r[:, 4] < self.p
+        images[apply] = _adjust_hue(images[apply], hue[apply])
+
+        apply = ~contrast_before & (r[:, 5] < self.p)
+        images[apply] = _adjust_contrast(images[apply], contrast[apply])
+
+        apply = r[:, 6] < self.p
+        permutation = torch.rand(int(apply.sum()), channels).argsort(dim=1).to(images.device)
+        images[apply] = images[apply].gather(1, permutation[:, :, None, None].expand_as(images[apply]))
+
+        return images, targets
+
 
 class ScaleJitter(nn.Module):
     """Randomly resizes the image and its bounding boxes  within the specified scale range.
@@ -332,9 +577,34 @@ class ScaleJitter(nn.Module):
                     interpolation=InterpolationMode.NEAREST,
                     antialias=self.antialias,
                 )
+            if "mask_crops" in target:
+                _resize_mask_crops(target, [orig_height, orig_width], [new_height, new_width])
 
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        _, _, orig_height, orig_width = images.shape
+
+        # one scale for the whole batch
+        scale = self.scale_range[0] + torch.rand(1) * (self.scale_range[1] - self.scale_range[0])
+        r = min(self.target_size[1] / orig_height, self.target_size[0] / orig_width) * scale
+        new_width = int(orig_width * r)
+        new_height = int(orig_height * r)
+
+        images = F.resize(images, [new_height, new_width], interpolation=self.interpolation, antialias=self.antialias)
+
+        for target in targets:
+            target["boxes"][:, 0::2] *= new_width / orig_width
+            target["boxes"][:, 1::2] *= new_height / orig_height
+            if "mask_crops" in target:
+                _resize_mask_crops(target, [orig_height, orig_width], [new_height, new_width])
+        _resize_masks(targets, [new_height, new_width], antialias=self.antialias)
+
+        return images, targets
+
 
 class FixedSizeCrop(nn.Module):
     def __init__(self, size, fill=0, padding_mode="constant"):
@@ -367,26 +637,36 @@ class FixedSizeCrop(nn.Module):
             target["boxes"][:, 1::2] += pad_top
             if "masks" in target:
                 target["masks"] = F.pad(target["masks"], padding, 0, "constant")
+            if "mask_crops" in target:
+                offsets = target["mask_offsets"]
+                target["mask_offsets"] = offsets + offsets.new_tensor([pad_top, pad_left])
 
         return img, target
 
     def _crop(self, img, target, top, left, height, width):
         img = F.crop(img, top, left, height, width)
         if target is not None:
-            boxes = target["boxes"]
-            boxes[:, 0::2] -= left
-            boxes[:, 1::2] -= top
-            boxes[:, 0::2].clamp_(min=0, max=width)
-            boxes[:, 1::2].clamp_(min=0, max=height)
+            self._crop_target(target, top, left, height, width)
 
-            is_valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+        return img, target
 
-            target["boxes"] = boxes[is_valid]
-            target["labels"] = target["labels"][is_valid]
-            if "masks" in target:
-                target["masks"] = F.crop(target["masks"][is_valid], top, left, height, width)
+    def _crop_target(self, target, top, left, height, width):
+        boxes = target["boxes"]
+        boxes[:, 0::2] -= left
+        boxes[:, 1::2] -= top
+        boxes[:, 0::2].clamp_(min=0, max=width)
+        boxes[:, 1::2].clamp_(min=0, max=height)
 
-        return img, target
+        is_valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+
+        target["boxes"] = boxes[is_valid]
+        target["labels"] = target["labels"][is_valid]
+        if "masks" in target:
+            target["masks"] = F.crop(target["masks"][is_valid], top, left, height, width)
+        if "mask_crops" in target:
+            target["mask_crops"] = target["mask_crops"][is_valid]
+            target["mask_offsets"] = target["mask_offsets"][is_valid]
+            _crop_mask_crops(target, top, left, height, width)
 
     def forward(self, img, target=None):
         _, height, width = F.get_dimensions(img)
@@ -410,6 +690,36 @@ class FixedSizeCrop(nn.Module):
 
         return img, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        batch_size, _, height, width = images.shape
+        new_height = min(height, self.crop_height)
+        new_width = min(width, self.crop_width)
+
+        if new_height != height or new_width != width:
+            offset_height = max(height - self.crop_height, 0)
+            offset_width = max(width - self.crop_width, 0)
+
+            r = torch.rand(batch_size)
+            top = (offset_height * r).long()
+            left = (offset_width * r).long()
+
+            images = _crop_batch(images, top, left, new_height, new_width)
+            for target, y, x in zip(targets, top.tolist(), left.tolist()):
+                self._crop_target(target, y, x, new_height, new_width)
+
+        pad_bottom = max(self.crop_height - new_height, 0)
+        pad_right = max(self.crop_width - new_width, 0)
+        if pad_bottom != 0 or pad_right != 0:
+            images = F.pad(images, [0, 0, pad_right, pad_bottom], self.fill, self.padding_mode)
+            for target in targets:
+                if "masks" in target:
+                    target["masks"] = F.pad(target["masks"], [0, 0, pad_right, pad_bottom], 0, "constant")
+
+        return images, targets
+
 
 class RandomShortestSize(nn.Module):
     def __init__(
@@ -443,9 +753,148 @@ class RandomShortestSize(nn.Module):
                 target["masks"] = F.resize(
                     target["masks"], [new_height, new_width], interpolation=InterpolationMode.NEAREST
                 )
+            if "mask_crops" in target:
+                _resize_mask_crops(target, [orig_height, orig_width], [new_height, new_width])
 
         return image, target
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        images = _as_batch(images)
+        _, _, orig_height, orig_width = images.shape
+
+        # one size for the whole batch
+        min_size = self.min_size[torch.randint(len(self.min_size), (1,)).item()]
+        r = min(min_size / min(orig_height, orig_width), self.max_size / max(orig_height, orig_width))
+
+        new_width = int(orig_width * r)
+        new_height = int(orig_height * r)
+
+        images = F.resize(images, [new_height, new_width], interpolation=self.interpolation)
+
+        for target in targets:
+            target["boxes"][:, 0::2] *= new_width / orig_width
+            target["boxes"][:, 1::2] *= new_height / orig_height
+            if "mask_crops" in target:
+                _resize_mask_crops(target, [orig_height, orig_width], [new_height, new_width])
+        _resize_masks(targets, [new_height, new_width])
+
+        return images, targets
+
+
+def masks_to_crops(masks: Tensor) -> Tuple[Tensor, Tensor]:
+    """Packs (N, H, W) instance masks into crops at their bounding boxes.
+
+    Returns:
+        (N, h, w) crops padded to the largest box, and the (N, 2) (top, left) offsets of the crops.
+    """
+    num_masks, height, width = masks.shape
+    # any() keeps the dtype of uint8 masks, so they are turned into booleans first
+    rows = (masks != 0).any(dim=2)
+    cols = (masks != 0).any(dim=1)
+    top = rows.to(torch.uint8).argmax(dim=1)
+    left = cols.to(torch.uint8).argmax(dim=1)
+    # empty masks get empty crops
+    bottom = torch.where(rows.any(dim=1), height - rows.flip(1).to(torch.uint8).argmax(dim=1), top)
+    right = torch.where(cols.any(dim=1), width - cols.flip(1).to(torch.uint8).argmax(dim=1), left)
+    crop_height = int((bottom - top).max()) if num_masks else 0
+    crop_width = int((right - left).max()) if num_masks else 0
+    offsets = torch.stack([top, left], dim=1)
+    return _gather_crops(masks[:, None], offsets, crop_height, crop_width)[:, 0], offsets
+
+
+def crops_to_masks(crops: Tensor, offsets: Tensor, size: List[int]) -> Tensor:
+    """Inverse of masks_to_crops, pastes every crop into its own (H, W) mask."""
+    masks = crops.new_zeros((len(crops), size[0], size[1]))
+    k, i, j = crops.nonzero(as_tuple=True)
+    masks[k, offsets[k, 0] + i, offsets[k, 1] + j] = crops[k, i, j]
+    return masks
+
+
+def _gather_crops(images: Tensor, offsets: Tensor, height: int, width: int) -> Tensor:
+    # Like _crop_batch, reading zeros where a crop reaches past the image
+    _, _, image_height, image_width = images.shape
+    rows = offsets[:, 0:1] + torch.arange(height, device=images.device)
+    cols = offsets[:, 1:2] + torch.arange(width, device=images.device)
+    inside = (rows < image_height)[:, :, None] & (cols < image_width)[:, None, :]
+    batch = torch.arange(len(images), device=images.device)[:, None, None]
+    crops = images[batch, :, rows.clamp(max=image_height - 1)[:, :, None], cols.clamp(max=image_width - 1)[:, None, :]]
+    return crops.permute(0, 3, 1, 2) * inside[:, None]
+
+
+def _pad_crops(crops: Tensor, height: int, width: int) -> Tensor:
+    return torch.nn.functional.pad(crops, [0, width - crops.shape[-1], 0, height - crops.shape[-2]])
+
+
+def _crops_to_boxes(crops: Tensor, offsets: Tensor) -> Tensor:
+    # Same boxes as ops.masks_to_boxes on the full masks, with inclusive (x2, y2)
+    _, crop_height, crop_width = crops.shape
+    if crops.numel() == 0:
+        # argmax fails on empty dimensions, e.g. for a target without instances
+        return torch.zeros((len(crops), 4), dtype=torch.float32, device=crops.device)
+    rows = (crops != 0).any(dim=2).to(torch.uint8)
+    cols = (crops != 0).any(dim=1).to(torch.uint8)
+    top = offsets[:, 0] + rows.argmax(dim=1)
+    left = offsets[:, 1] + cols.argmax(dim=1)
+    bottom = offsets[:, 0] + crop_height - 1 - rows.flip(1).argmax(dim=1)
+    right = offsets[:, 1] + crop_width - 1 - cols.flip(1).argmax(dim=1)
+    return torch.stack([left, top, right, bottom], dim=1).to(torch.float32)
+
+
+def _repack_crops(crops: Tensor, offsets: Tensor) -> Tuple[Tensor, Tensor]:
+    # Shrinks the crops to their content again after a transform moved it inside them
+    if crops.numel() == 0:
+        return crops, offsets.clamp(min=0)
+    crops, inner = masks_to_crops(crops)
+    # empty crops keep their offset, which may have left the image
+    return crops, (offsets + inner).clamp(min=0)
+
+
+def _flip_mask_crops(target: Dict[str, Tensor], width: int) -> None:
+    # Same as flipping the full masks: the crops are mirrored and so is their position
+    crops = target["mask_crops"].flip(-1)
+    offsets = target["mask_offsets"].clone()
+    offsets[:, 1] = width - offsets[:, 1] - crops.shape[-1]
+    target["mask_crops"], target["mask_offsets"] = _repack_crops(crops, offsets)
+
+
+def _crop_mask_crops(target: Dict[str, Tensor], top: int, left: int, height: int, width: int) -> None:
+    # Same as F.crop on the full masks: the crops move with the window and lose what falls outside it
+    crops = target["mask_crops"]
+    offsets = target["mask_offsets"] - target["mask_offsets"].new_tensor([top, left])
+    rows = offsets[:, 0:1] + torch.arange(crops.shape[-2], device=crops.device)
+    cols = offsets[:, 1:2] + torch.arange(crops.shape[-1], device=crops.device)
+    inside = ((rows >= 0) & (rows < height))[:, :, None] & ((cols >= 0) & (cols < width))[:, None, :]
+    target["mask_crops"], target["mask_offsets"] = _repack_crops(crops * inside, offsets)
+
+
+def _resize_mask_crops(target: Dict[str, Tensor], size: List[int], new_size: List[int]) -> None:
+    # Same as the nearest resize of the full masks, which reads source pixel floor(i * in / out) for output pixel i.
+    # Every crop gets the output pixels whose source lies inside it.
+    crops, offsets = target["mask_crops"], target["mask_offsets"]
+    if crops.numel() == 0:
+        target["mask_offsets"] = (offsets * offsets.new_tensor(new_size) // offsets.new_tensor(size)).clamp(min=0)
+        return
+    axes = []
+    for axis in range(2):
+        scale = torch.tensor(size[axis] / new_size[axis], dtype=torch.float32)
+        source = (torch.arange(new_size[axis], dtype=torch.float32) * scale).floor().long().clamp(max=size[axis] - 1)
+        source = source.to(crops.device)
+        start = torch.searchsorted(source, offsets[:, axis].contiguous())
+        end = torch.searchsorted(source, (offsets[:, axis] + crops.shape[axis - 2]).contiguous())
+        length = int((end - start).max())
+        index = start[:, None] + torch.arange(length, device=crops.device)
+        valid = index < end[:, None]
+        axes.append((start, source[index.clamp(max=new_size[axis] - 1)] - offsets[:, axis : axis + 1], valid))
+    (top, rows, valid_rows), (left, cols, valid_cols) = axes
+    batch = torch.arange(len(crops), device=crops.device)[:, None, None]
+    rows = rows.clamp(0, crops.shape[-2] - 1)[:, :, None]
+    cols = cols.clamp(0, crops.shape[-1] - 1)[:, None, :]
+    crops = crops[batch, rows, cols]
+    target["mask_crops"] = crops * (valid_rows[:, :, None] & valid_cols[:, None, :])
+    target["mask_offsets"] = torch.stack([top, left], dim=1)
+
 
 def _copy_paste(
     image: torch.Tensor,
@@ -455,9 +904,32 @@ def _copy_paste(
     blending: bool = True,
     resize_interpolation: F.InterpolationMode = F.InterpolationMode.BILINEAR,
 ) -> Tuple[torch.Tensor, Dict[str, Tensor]]:
+    # Instances are handled as crops at their boxes, full masks are packed on the way in and out
+    if "mask_crops" in target:
+        return _copy_paste_crops(image, target, paste_image, paste_target, blending, resize_interpolation)
+
+    size = image.shape[-2:]
+    target = {k: v for k, v in target.items()}
+    target["mask_crops"], target["mask_offsets"] = masks_to_crops(target.pop("masks"))
+    paste_target = {k: v for k, v in paste_target.items()}
+    paste_target["mask_crops"], paste_target["mask_offsets"] = masks_to_crops(paste_target.pop("masks"))
+
+    image, out_target = _copy_paste_crops(image, target, paste_image, paste_target, blending, resize_interpolation)
+    out_target["masks"] = crops_to_masks(out_target.pop("mask_crops"), out_target.pop("mask_offsets"), size)
+    return image, out_target
+
+
+def _copy_paste_crops(
+    image: torch.Tensor,
+    target: Dict[str, Tensor],
+    paste_image: torch.Tensor,
+    paste_target: Dict[str, Tensor],
+    blending: bool = True,
+    resize_interpolation: F.InterpolationMode = F.InterpolationMode.BILINEAR,
+) -> Tuple[torch.Tensor, Dict[str, Tensor]]:
 
     # Random paste targets selection:
-    num_masks = len(paste_target["masks"])
+    num_masks = len(paste_target["mask_crops"])
 
     if num_masks < 1:
         # Such degerante case with num_masks=0 can happen with LSJ
@@ -468,11 +940,13 @@ def _copy_paste(
     random_selection = torch.randint(0, num_masks, (num_masks,), device=paste_image.device)
     random_selection = torch.unique(random_selection).to(torch.long)
 
-    paste_masks = paste_target["masks"][random_selection]
+    paste_crops = paste_target["mask_crops"][random_selection]
+    paste_offsets = paste_target["mask_offsets"][random_selection]
     paste_boxes = paste_target["boxes"][random_selection]
     paste_labels = paste_target["labels"][random_selection]
 
-    masks = target["masks"]
+    crops = target["mask_crops"]
+    offsets = target["mask_offsets"]
 
     # We resize source and paste data if they have different sizes
     # This is something we introduced here as originally the algorithm works
@@ -481,12 +955,18 @@ def _copy_paste(
     size2 = paste_image.shape[-2:]
     if size1 != size2:
         paste_image = F.resize(paste_image, size1, interpolation=resize_interpolation)
-        paste_masks = F.resize(paste_masks, size1, interpolation=F.InterpolationMode.NEAREST)
+        paste_masks = F.resize(
+            crops_to_masks(paste_crops, paste_offsets, size2), size1, interpolation=F.InterpolationMode.NEAREST
+        )
+        paste_crops, paste_offsets = masks_to_crops(paste_masks)
         # resize bboxes:
         ratios = torch.tensor((size1[1] / size2[1], size1[0] / size2[0]), device=paste_boxes.device)
         paste_boxes = paste_boxes.view(-1, 2, 2).mul(ratios).view(paste_boxes.shape)
 
-    paste_alpha_mask = paste_masks.sum(dim=0) > 0
+    # Union of the pasted instances, scattered from their crops instead of summing N full masks
+    paste_alpha_mask = torch.zeros(size1, dtype=torch.bool, device=paste_crops.device)
+    k, i, j = paste_crops.nonzero(as_tuple=True)
+    paste_alpha_mask[paste_offsets[k, 0] + i, paste_offsets[k, 1] + j] = True
 
     if blending:
         paste_alpha_mask = F.gaussian_blur(
@@ -500,18 +980,26 @@ def _copy_paste(
     # Copy-paste images:
     image = (image * (~paste_alpha_mask)) + (paste_image * paste_alpha_mask)
 
-    # Copy-paste masks:
-    masks = masks * (~paste_alpha_mask)
-    non_all_zero_masks = masks.sum((-1, -2)) > 0
-    masks = masks[non_all_zero_masks]
+    # Copy-paste masks, the occlusion of every instance is read from the paste mask inside its crop only:
+    alpha = paste_alpha_mask.view(1, 1, size1[0], size1[1]).expand(len(crops), -1, -1, -1)
+    occluded = _gather_crops(alpha, offsets, crops.shape[-2], crops.shape[-1])[:, 0]
+    crops = crops * (~occluded)
+    non_all_zero_masks = (crops != 0).flatten(1).any(dim=1)
+    crops = crops[non_all_zero_masks]
+    offsets = offsets[non_all_zero_masks]
 
     # Do a shallow copy of the target dict
     out_target = {k: v for k, v in target.items()}
 
-    out_target["masks"] = torch.cat([masks, paste_masks])
+    crop_height = max(crops.shape[-2], paste_crops.shape[-2])
+    crop_width = max(crops.shape[-1], paste_crops.shape[-1])
+    out_target["mask_crops"] = torch.cat(
+        [_pad_crops(crops, crop_height, crop_width), _pad_crops(paste_crops, crop_height, crop_width)]
+    )
+    out_target["mask_offsets"] = torch.cat([offsets, paste_offsets])
 
     # Copy-paste boxes and labels
-    boxes = ops.masks_to_boxes(masks)
+    boxes = _crops_to_boxes(crops, offsets)
     out_target["boxes"] = torch.cat([boxes, paste_boxes])
 
     labels = target["labels"][non_all_zero_masks]
@@ -519,7 +1007,7 @@ def _copy_paste(
 
     # Update additional optional keys: area and iscrowd if exist
     if "area" in target:
-        out_target["area"] = out_target["masks"].sum((-1, -2)).to(torch.float32)
+        out_target["area"] = out_target["mask_crops"].sum((-1, -2)).to(torch.float32)
 
     if "iscrowd" in target and "iscrowd" in paste_target:
         # target['iscrowd'] size can be differ from mask size (non_all_zero_masks)
@@ -537,7 +1025,8 @@ def _copy_paste(
         valid_targets = ~degenerate_boxes.any(dim=1)
 
         out_target["boxes"] = boxes[valid_targets]
-        out_target["masks"] = out_target["masks"][valid_targets]
+        out_target["mask_crops"] = out_target["mask_crops"][valid_targets]
+        out_target["mask_offsets"] = out_target["mask_offsets"][valid_targets]
         out_target["labels"] = out_target["labels"][valid_targets]
 
         if "area" in out_target:
@@ -568,9 +1057,12 @@ class SimpleCopyPaste(torch.nn.Module):
         for target in targets:
             # Can not check for instance type dict with inside torch.jit.script
             # torch._assert(isinstance(target, dict), "targets item should be a dict")
-            for k in ["masks", "boxes", "labels"]:
+            torch._assert("masks" in target or "mask_crops" in target, "Key masks should be present in targets")
+            for k in ["masks", "mask_crops", "mask_offsets", "boxes", "labels"]:
+                if k in target:
+                    torch._assert(isinstance(target[k], torch.Tensor), f"Value for the key {k} should be a tensor")
+            for k in ["boxes", "labels"]:
                 torch._assert(k in target, f"Key {k} should be present in targets")
-                torch._assert(isinstance(target[k], torch.Tensor), f"Value for the key {k} should be a tensor")
 
         # images = [t1, t2, ..., tN]
         # Let's define paste_images as shifted list of input images
@@ -596,6 +1088,14 @@ class SimpleCopyPaste(torch.nn.Module):
 
         return output_images, output_targets
 
+    def forward_batch(
+        self, images: Tensor, targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        # Every image of the batch is paired with the previous one, run through BatchCollate
+        # this happens inside the DataLoader workers
+        output_images, output_targets = self.forward(list(_as_batch(images)), targets)
+        return torch.stack(output_images), output_targets
+
     def __repr__(self) -> str:
         s = f"{self.__class__.__name__}(blending={self.blending}, resize_interpolation={self.resize_interpolation})"
         return s
@@ -0,0 +1,129 @@
+"""
+On-the-fly augmentation of the training slides.
+
+Applies the augmentation pipeline of data_augmentation.ipynb while training
+instead of writing augmented PNG/JSON pairs to disk. Every sample is
+augmented at full resolution, resized to the training size, and its mask is
+rasterized from the augmented keypoints, which is how the offline
+augmented_images/augmented_labels were turned into training data.
+
+Samples are generated by a pool of worker processes. Each sample carries its
+own seed drawn from one base seed, so a run is reproducible however the
+samples are spread across the workers.
+
+Example:
+    pairs = find_pairs('TMA_WSI_Padded_PNGs', 'TMA_WSI_Labels_updated')
+    model.fit(augmented_batches(pairs, batch_size=32, workers=4, seed=0), steps_per_epoch=12, ...)
+"""
+import random
+from multiprocessing import Pool
+
+import numpy as np
+
+import core_detection
+from dataset_cache import resize_image
+from label_io import load_labels
+from masks import ORIGINAL_SIZE, create_mask_from_json, resize_labels
+
+
+def build_augmentation():
+    """
+    The augmentation pipeline of data_augmentation.ipynb. The radius travels
+    with each keypoint as an extra value.
+    """
+    import albumentations as A
+    import cv2
+
+    return A.Compose([
+        A.Rotate(limit=45, p=0.5, border_mode=cv2.BORDER_CONSTANT),
+        A.HorizontalFlip(p=0.5),
+        A.Affine(scale=(1, 1), translate_percent=None, rotate=0, shear=10, p=0.5),
+        A.GaussianBlur(blur_limit=(3, 7), p=0.2),
+        A.RandomFog(fog_coef_lower=0.1, fog_coef_upper=0.4, alpha_coef=0.1, p=0.2),
+    ], keypoint_params=A.KeypointParams(format='xy', remove_invisible=True))
+
+
+def seed_augmentation(aug, seed):
+    # Recent albumentations keep their own generator, older releases draw from the global ones
+    if hasattr(aug, 'set_random_seed'):
+        aug.set_random_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def augment_sample(image, labels, aug, size=(512, 512), original_size=ORIGINAL_SIZE):
+    """
+    Augment one slide and rasterize the mask of the augmented cores.
+    :param image: (H, W, 3) uint8 image the labels were drawn on.
+    :param labels: List of {x, y, radius} dictionaries.
+    :param aug: Pipeline from build_augmentation.
+    :param size: (height, width) of the returned image and mask.
+    :return: ((height, width, 3) uint8 image, (height, width) uint8 mask, augmented labels at full resolution).
+    """
+    keypoints = [(label['x'], label['y'], label['radius']) for label in labels]
+    augmented = aug(image=image, keypoints=keypoints)
+    labels_aug = [{'x': kp[0], 'y': kp[1], 'radius': kp[2]} for kp in augmented['keypoints']]
+
+    image_aug = resize_image(augmented['image'], size)
+    mask = create_mask_from_json(labels_aug, size, np.uint8, original_size)
+    return image_aug, mask, labels_aug
+
+
+# Decoded slides and pipeline, loaded once per worker process
+_sources = None
+_aug = None
+
+
+def _init_worker(pairs):
+    global _sources, _aug
+    _sources = []
+    for _, image_path, label_path in pairs:
+        _sources.append((core_detection.load_image(image_path), load_labels(label_path)))
+    _aug = build_augmentation()
+
+
+def _generate(task):
+    index, seed, size = task
+    seed_augmentation(_aug, seed)
+    image, labels = _sources[index]
+    image_aug, mask, _ = augment_sample(image, labels, _aug, size)
+    return image_aug, mask
+
+
+def _collate(samples):
+    images = np.stack([image for image, _ in samples]).astype(np.float32) / 255.0
+    masks = np.stack([mask for _, mask in samples])[..., np.newaxis].astype(np.float32)
+    return images, masks
+
+
+def augmented_batches(pairs, batch_size=32, size=(512, 512), workers=4, seed=None, prefetch=2):
+    """
+    Endless stream of freshly augmented batches, in the format of
+    load_images_and_labels.
+    :param pairs: (name, image path, label path) of the slides, e.g. from dataset_cache.find_pairs.
+    :param batch_size: Number of samples per batch.
+    :param size: (height, width) of the samples.
+    :param workers: Number of worker processes, 0 to augment in this process.
+    :param seed: Base seed of the sample order and the augmentations.
+    :param prefetch: Number of batches generated ahead of the one being consumed.
+    :return: Generator of ((N, H, W, 3) float32 images, (N, H, W, 1) float32 masks).
+    """
+    pairs = list(pairs)
+    rng = np.random.default_rng(seed)
+
+    def next_tasks():
+        indices = rng.integers(len(pairs), size=batch_size)
+        seeds = rng.integers(2 ** 31, size=batch_size)
+        return [(int(index), int(sample_seed), tuple(size)) for index, sample_seed in zip(indices, seeds)]
+
+    if workers == 0:
+        _init_worker(pairs)
+        while True:
+            yield _collate([_generate(task) for task in next_tasks()])
+
+    with Pool(workers, initializer=_init_worker, initargs=(pairs,)) as pool:
+        pending = [pool.map_async(_generate, next_tasks()) for _ in range(prefetch + 1)]
+        while True:
+            samples = pending.pop(0).get()
+            pending.append(pool.map_async(_generate, next_tasks()))
+            yield _collate(samples)
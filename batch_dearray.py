@@ -0,0 +1,270 @@
+"""
+Headless dearraying of a whole directory of slides.
+
+Runs segmentation, centroid extraction, Delaunay gridding and the traveling
+algorithm on every image and writes one row/column JSON per slide, in the
+format saved by the browser's "Save" button.
+
+Example:
+    python batch_dearray.py TMA_WSI_Padded_PNGs --model tfjs_model/model.json --output-dir dearrayed --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import core_detection
+import profiling
+from data_processing import (
+    DEFAULT_HYPERPARAMETERS,
+    estimate_rotation,
+    filter_grid_edges,
+    grid_params,
+    normalize_cores,
+    run_traveling_algorithm,
+)
+from label_io import find_label, load_labels
+from result_cache import DEFAULT_MAX_BYTES, ResultCache, file_hash, model_hash, stage_key
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+STAGES = ('decode', 'predict', 'segmentation', 'gridding', 'traveling')
+
+# Model and result cache, set up once per worker process
+_model = None
+_model_key = None
+_cache = None
+
+
+def _init_worker(model_path, cache_dir=None, cache_bytes=DEFAULT_MAX_BYTES, profile=False):
+    global _model, _model_key, _cache
+    if profile:
+        profiling.enable()
+    if model_path is not None:
+        _model = core_detection.load_model(model_path)
+        _model_key = model_hash(model_path) if cache_dir is not None else None
+    if cache_dir is not None:
+        _cache = ResultCache(cache_dir, cache_bytes)
+
+
+def _cached(stage, parent_key, params, compute):
+    # Without a cache every stage is computed and keys are not needed
+    if _cache is None:
+        return compute(), None
+    key = stage_key(stage, parent_key, params)
+    return _cache.get_or_compute(key, compute), key
+
+
+def output_path_for(image_path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(image_path))[0] + '.json')
+
+
+def write_json_atomic(data, path):
+    # Write to a temporary file first so an interrupted run never leaves a partial output behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def dearray_slide(image_path, output_path, cores_dir, detection_params, params):
+    """
+    Dearray one slide and write its JSON. With a result cache, every stage
+    whose inputs and hyperparameters are unchanged is read back instead.
+    :return: (image_path, number of cores, {stage: seconds}, profiling spans recorded for the slide)
+    """
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    with profiling.span('slide', slide=name) as slide_span:
+        timings, cores = _dearray_slide(image_path, output_path, cores_dir, detection_params, params)
+        slide_span.count(cores=len(cores))
+    return image_path, len(cores), timings, profiling.collect()
+
+
+def _dearray_slide(image_path, output_path, cores_dir, detection_params, params):
+    timings = {}
+
+    if cores_dir is not None:
+        # Centroids were already extracted, e.g. TMA_WSI_Labels_updated
+        start = time.perf_counter()
+        label_path = find_label(cores_dir, os.path.splitext(os.path.basename(image_path))[0])
+        with profiling.span('decode') as decode_span:
+            cores = load_labels(label_path)
+            decode_span.count(cores=len(cores))
+        cores_key = stage_key('cores', file_hash(label_path), params) if _cache is not None else None
+        timings['decode'] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        image_key = file_hash(image_path) if _cache is not None else None
+        timings['decode'] = time.perf_counter() - start
+
+        def predict():
+            # The image is only decoded when the prediction is not cached, and that time counts as decode
+            start = time.perf_counter()
+            image = core_detection.load_image(image_path)
+            timings['decode'] += time.perf_counter() - start
+            return core_detection.preprocess_and_predict(image, _model)
+
+        start = time.perf_counter()
+        decode_seconds = timings['decode']
+        predictions, predict_key = _cached('predict', image_key, {'model': _model_key}, predict)
+        timings['predict'] = time.perf_counter() - start - (timings['decode'] - decode_seconds)
+
+        def segment():
+            thresholded_predictions = core_detection.apply_threshold(predictions, detection_params['threshold'])
+            properties = core_detection.segmentation_algorithm(
+                thresholded_predictions,
+                detection_params['min_area'],
+                detection_params['max_area'],
+                detection_params['dis_transform_multiplier'],
+            )
+            scale = core_detection.CANVAS_SIZE / core_detection.MODEL_INPUT_SIZE
+            return [{k: v * scale for k, v in prop.items()} for prop in properties.values()]
+
+        start = time.perf_counter()
+        cores, cores_key = _cached('segmentation', predict_key, detection_params, segment)
+        timings['segmentation'] = time.perf_counter() - start
+
+    sorted_data = []
+    if len(cores) >= 3:
+        start = time.perf_counter()
+        coordinates, offset = normalize_cores(cores)
+        edges, edges_key = _cached(
+            'filtered_edges', cores_key, params,
+            lambda: filter_grid_edges(coordinates, params['threshold_multiplier']),
+        )
+        (best_edge_set, origin_angle), rotation_key = _cached(
+            'rotation', edges_key, params, lambda: estimate_rotation(coordinates, edges, params),
+        )
+        slide_params = grid_params(coordinates, best_edge_set, origin_angle, params)
+        timings['gridding'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sorted_data, _ = _cached(
+            'rows', rotation_key, params,
+            lambda: run_traveling_algorithm(coordinates, slide_params, offset, edges),
+        )
+        timings['traveling'] = time.perf_counter() - start
+
+    write_json_atomic(sorted_data, output_path)
+    return timings, cores
+
+
+def format_timing_summary(all_timings):
+    lines = [f"{'stage':<14}{'slides':>8}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}"]
+    for stage in STAGES:
+        values = all_timings.get(stage)
+        if not values:
+            continue
+        lines.append(
+            f"{stage:<14}{len(values):>8}{sum(values):>12.2f}"
+            f"{1000 * sum(values) / len(values):>12.1f}{1000 * max(values):>12.1f}"
+        )
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Dearray every slide in a directory.')
+    parser.add_argument('input_dir', help='Directory of slide images, e.g. TMA_WSI_Padded_PNGs')
+    parser.add_argument('--output-dir', default='dearrayed_cores', help='Where the per-slide JSON files are written')
+    parser.add_argument('--model', help='Segmentation model (tfjs model.json or Keras .hdf5)')
+    parser.add_argument('--cores-dir', help='Read {x, y, radius} JSON or .cores label files from here instead of running the model')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--overwrite', action='store_true', help='Reprocess slides that already have an output')
+    parser.add_argument('--cache-dir', help='Keep intermediate results here and reuse them on later runs')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 2 ** 30,
+                        help='Size budget of the result cache in GiB')
+    parser.add_argument('--profile', help='Write per-stage spans here, as JSON lines or as a Chrome trace (.json)')
+
+    detection = parser.add_argument_group('segmentation')
+    detection.add_argument('--threshold', type=float, default=0.5)
+    detection.add_argument('--min-area', type=int, default=0)
+    detection.add_argument('--max-area', type=int, default=2000)
+    detection.add_argument('--dis-transform-multiplier', type=float, default=0.625)
+
+    gridding = parser.add_argument_group('gridding')
+    for name in ('threshold_multiplier', 'threshold_angle', 'radius_multiplier', 'min_angle', 'max_angle',
+                 'angle_step_size', 'angle_threshold', 'multiplier', 'search_angle', 'user_radius'):
+        gridding.add_argument('--' + name.replace('_', '-'), type=float, default=DEFAULT_HYPERPARAMETERS[name])
+
+    args = parser.parse_args(argv)
+    if args.model is None and args.cores_dir is None:
+        parser.error('one of --model or --cores-dir is required')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    detection_params = {
+        'threshold': args.threshold,
+        'min_area': args.min_area,
+        'max_area': args.max_area,
+        'dis_transform_multiplier': args.dis_transform_multiplier,
+    }
+    params = dict(DEFAULT_HYPERPARAMETERS)
+    params.update({name: getattr(args, name) for name in params if hasattr(args, name)})
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    image_paths = [
+        os.path.join(args.input_dir, filename)
+        for filename in sorted(os.listdir(args.input_dir))
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+    # Resume: skip slides whose output was already written by a previous run
+    pending = [
+        path for path in image_paths
+        if args.overwrite or not os.path.exists(output_path_for(path, args.output_dir))
+    ]
+    print(f"{len(image_paths)} slides, {len(image_paths) - len(pending)} already done, {len(pending)} to process")
+
+    model_path = None if args.cores_dir is not None else args.model
+    cache_bytes = int(args.cache_size * 2 ** 30)
+    all_timings = defaultdict(list)
+    failures = 0
+    start = time.perf_counter()
+
+    if args.profile:
+        profiling.enable()
+
+    def record(result):
+        image_path, core_count, timings, spans = result
+        profiling.record(spans)
+        for stage, seconds in timings.items():
+            all_timings[stage].append(seconds)
+        print(f"{os.path.basename(image_path)}: {core_count} cores in {sum(timings.values()):.2f}s")
+
+    jobs = [
+        (path, output_path_for(path, args.output_dir), args.cores_dir, detection_params, params)
+        for path in pending
+    ]
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                                 initargs=(model_path, args.cache_dir, cache_bytes, bool(args.profile))) as executor:
+            futures = {executor.submit(dearray_slide, *job): job[0] for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    record(future.result())
+                except Exception as error:
+                    failures += 1
+                    print(f"{os.path.basename(futures[future])}: failed ({error})", file=sys.stderr)
+    else:
+        _init_worker(model_path, args.cache_dir, cache_bytes, bool(args.profile))
+        for job in jobs:
+            try:
+                record(dearray_slide(*job))
+            except Exception as error:
+                failures += 1
+                print(f"{os.path.basename(job[0])}: failed ({error})", file=sys.stderr)
+
+    print(f"\nProcessed {len(pending) - failures} slides in {time.perf_counter() - start:.2f}s ({failures} failed)")
+    print(format_timing_summary(all_timings))
+    if args.profile:
+        profiling.disable(args.profile)
+        print(f"Spans written to {args.profile}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
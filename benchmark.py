@@ -0,0 +1,328 @@
+"""
+Benchmark of the gridding stages on the bundled label files.
+
+Replays {x, y, radius} label files through every stage of the dearraying
+pipeline, from normalizing the cores through the Delaunay triangulation, the
+edge filters and the rotation sweep to the traveling algorithm. Synthetic
+jittered grids with known rows and columns are added at growing core counts.
+Every case records the wall time and peak memory of each stage and how the
+cores were assigned to rows and columns. Results are compared with a stored
+baseline, and slower or larger stages and changed assignments are flagged.
+
+Example:
+    python benchmark.py --update-baseline   # record benchmarks/baseline.json
+    python benchmark.py                     # compare with it, exit status 1 on a regression
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+from scipy.spatial import KDTree
+
+from data_processing import (
+    DEFAULT_HYPERPARAMETERS,
+    estimate_rotation,
+    grid_params,
+    normalize_cores,
+    rows_to_records,
+)
+from delaunay_triangulation import (
+    filter_edges_by_angle,
+    filter_edges_by_length,
+    get_edges_from_coordinates,
+    limit_connections,
+    sort_edges_and_add_isolated_points,
+    traveling_algorithm,
+)
+from synthetic_grid import synthetic_grid
+
+STAGES = ('preprocess', 'triangulation', 'length_filter', 'rotation', 'angle_filter', 'limit_connections',
+          'traveling', 'records')
+DEFAULT_BASELINE = os.path.join('benchmarks', 'baseline.json')
+DEFAULT_SIZES = ('10x10', '20x25', '40x40', '60x60', '100x100')
+
+# Jittered, slightly rotated grids with a few missing cores
+SYNTHETIC_LAYOUT = {'pitch': 40.0, 'rotation': 2.0, 'jitter': 2.0, 'missing': 0.05}
+
+# A stage is only flagged when it is slower or larger by both the relative tolerance and these amounts
+MIN_SECONDS_DIFFERENCE = 0.005
+MIN_BYTES_DIFFERENCE = 1 << 20
+
+
+class _StageTimer:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    def __call__(self, stage, function, *args):
+        if self.trace_memory:
+            # Peak of the memory allocated by the stage itself
+            tracemalloc.clear_traces()
+        start = time.perf_counter()
+        result = function(*args)
+        self.seconds[stage] = time.perf_counter() - start
+        if self.trace_memory:
+            self.peak_bytes[stage] = tracemalloc.get_traced_memory()[1]
+        return result
+
+
+def run_stages(cores, params, timer):
+    """
+    The gridding of batch_dearray, one timed call per stage.
+    :param cores: List of {x, y, ...} dictionaries.
+    :param params: Hyperparameters, see DEFAULT_HYPERPARAMETERS.
+    :param timer: Callable(stage, function, *args) running function.
+    :return: Records in the format of run_traveling_algorithm.
+    """
+    coordinates, offset = timer('preprocess', normalize_cores, cores)
+    edges = timer('triangulation', get_edges_from_coordinates, coordinates)
+    length_filtered_edges = timer('length_filter', filter_edges_by_length, edges, coordinates,
+                                  params['threshold_multiplier'])
+    best_edge_set, origin_angle = timer('rotation', estimate_rotation, coordinates, length_filtered_edges, params)
+    slide_params = grid_params(coordinates, best_edge_set, origin_angle, params)
+
+    angle_filtered_edges = timer('angle_filter', filter_edges_by_angle, length_filtered_edges, coordinates,
+                                 slide_params['threshold_angle'], origin_angle)
+    limited_edges = timer('limit_connections', limit_connections, angle_filtered_edges, coordinates)
+    segments = coordinates[sort_edges_and_add_isolated_points(limited_edges, coordinates)]
+    rows = timer('traveling', traveling_algorithm, segments, slide_params['image_width'],
+                 slide_params['grid_width'], slide_params['gamma'], slide_params['search_angle'],
+                 origin_angle, slide_params['radius_multiplier'])
+    return timer('records', rows_to_records, rows, slide_params, offset)
+
+
+def _majority_agreement(predicted, true):
+    # Fraction of cores whose predicted label maps to their true label, each predicted label mapped by majority
+    if len(predicted) == 0:
+        return 0.0
+    pairs, counts = np.unique(np.stack([predicted, true], axis=1), axis=0, return_counts=True)
+    best = defaultdict(int)
+    for (label, _), count in zip(pairs.tolist(), counts.tolist()):
+        best[label] = max(best[label], count)
+    return sum(best.values())
+
+
+def assignment_metrics(cores, records, truth=None):
+    """
+    How the cores were assigned to rows and columns.
+    :param cores: Input {x, y} dictionaries.
+    :param records: Output of run_stages.
+    :param truth: Optional (N, 2) true (row, col) of the cores.
+    :return: Dictionary with the coverage of the cores, duplicates, the number of rows, a digest of the
+        assignment and, with truth, the row and column accuracy.
+    """
+    points = np.array([(core['x'], core['y']) for core in cores], dtype=np.float64).reshape(-1, 2)
+    real = [record for record in records if not record['isImaginary']]
+    metrics = {'cores': len(points), 'rows': len({record['row'] for record in records})}
+    if len(points) == 0:
+        return metrics
+
+    # Output records carry the input coordinates, up to the rounding of the normalization
+    found = np.array([(record['x'], record['y']) for record in real], dtype=np.float64).reshape(-1, 2)
+    distance, index = KDTree(points).query(found) if len(found) else (np.empty(0), np.empty(0, dtype=int))
+    matched = distance < 1e-6
+    index = index[matched]
+    assigned = np.array([(record['row'], record['col']) for record in real], dtype=np.int64).reshape(-1, 2)[matched]
+
+    unique_index, first = np.unique(index, return_index=True)
+    metrics['coverage'] = len(unique_index) / len(points)
+    metrics['duplicates'] = int(len(index) - len(unique_index))
+    metrics['digest'] = hashlib.sha1(
+        np.concatenate([unique_index[:, np.newaxis], assigned[first]], axis=1).astype(np.int64).tobytes()
+    ).hexdigest()
+
+    if truth is not None:
+        truth = np.asarray(truth)[unique_index]
+        metrics['row_accuracy'] = _majority_agreement(assigned[first, 0], truth[:, 0]) / len(points)
+        metrics['col_accuracy'] = _majority_agreement(assigned[first, 1], truth[:, 1]) / len(points)
+    return metrics
+
+
+def benchmark_case(cores, params, truth=None, repeat=3):
+    """
+    Time every stage on one layout, measure its peak memory and check the assignment.
+    :param repeat: Number of timed runs, the fastest is kept.
+    :return: Dictionary with seconds and peak_bytes per stage and the metrics, or the error.
+    """
+    seconds = {}
+    try:
+        for _ in range(repeat):
+            timer = _StageTimer()
+            records = run_stages(cores, params, timer)
+            for stage, value in timer.seconds.items():
+                seconds[stage] = min(value, seconds.get(stage, value))
+
+        # Memory is traced in a separate run, tracing slows the stages down
+        timer = _StageTimer(trace_memory=True)
+        tracemalloc.start()
+        try:
+            run_stages(cores, params, timer)
+        finally:
+            tracemalloc.stop()
+    except ValueError as error:
+        return {'error': str(error), 'metrics': {'cores': len(cores)}}
+    return {'seconds': seconds, 'peak_bytes': timer.peak_bytes, 'metrics': assignment_metrics(cores, records, truth)}
+
+
+def run_benchmark(label_dirs, sizes=DEFAULT_SIZES, params=None, repeat=3, seed=0):
+    """
+    Benchmark every label file in label_dirs and a synthetic grid per size.
+    :param label_dirs: Directories of {x, y, radius} JSON files.
+    :param sizes: Synthetic grid sizes as 'ROWSxCOLS'.
+    :return: Dictionary of results per case, keyed 'dir/name' or 'synthetic/ROWSxCOLS'.
+    """
+    params = dict(DEFAULT_HYPERPARAMETERS, **(params or {}))
+    cases = {}
+    for label_dir in label_dirs:
+        group = os.path.basename(os.path.normpath(label_dir))
+        for filename in sorted(os.listdir(label_dir)):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(label_dir, filename)) as file:
+                cores = json.load(file)
+            result = benchmark_case(cores, params, repeat=repeat)
+            cases[f'{group}/{os.path.splitext(filename)[0]}'] = dict(result, group=group)
+
+    for size in sizes:
+        rows, cols = (int(value) for value in size.lower().split('x'))
+        cores, truth = synthetic_grid(rows, cols, **dict(SYNTHETIC_LAYOUT, seed=seed))
+        result = benchmark_case(cores, params, truth, repeat=repeat)
+        cases[f'synthetic/{size}'] = dict(result, group=f'synthetic/{size}')
+
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'params': params,
+        'cases': cases,
+    }
+
+
+def group_totals(results):
+    """
+    Stage seconds summed and stage peak memory maximized over the cases of each group.
+    :return: {group: {'cases': n, 'seconds': {...}, 'peak_bytes': {...}, 'errors': n}}
+    """
+    totals = {}
+    for case in results['cases'].values():
+        group = totals.setdefault(case['group'], {'cases': 0, 'errors': 0, 'seconds': {}, 'peak_bytes': {}})
+        group['cases'] += 1
+        if 'error' in case:
+            group['errors'] += 1
+            continue
+        for stage, value in case['seconds'].items():
+            group['seconds'][stage] = group['seconds'].get(stage, 0.0) + value
+        for stage, value in case['peak_bytes'].items():
+            group['peak_bytes'][stage] = max(group['peak_bytes'].get(stage, 0), value)
+    return totals
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25):
+    """
+    Regressions of results against a baseline from the same benchmark.
+    :param tolerance: Allowed relative increase of stage times and peak memory.
+    :return: List of messages, empty if nothing regressed.
+    """
+    regressions = []
+    current_groups, baseline_groups = group_totals(results), group_totals(baseline)
+    for name, base in baseline_groups.items():
+        current = current_groups.get(name)
+        if current is None:
+            continue
+        for stage, base_seconds in base['seconds'].items():
+            seconds = current['seconds'].get(stage)
+            if seconds is not None and seconds > base_seconds * (1 + tolerance) and \
+                    seconds - base_seconds > MIN_SECONDS_DIFFERENCE:
+                regressions.append(f"{name} {stage}: {1000 * seconds:.1f} ms, baseline {1000 * base_seconds:.1f} ms")
+        for stage, base_bytes in base['peak_bytes'].items():
+            peak = current['peak_bytes'].get(stage)
+            if peak is not None and peak > base_bytes * (1 + tolerance) and peak - base_bytes > MIN_BYTES_DIFFERENCE:
+                regressions.append(f"{name} {stage}: peak {peak / 2 ** 20:.1f} MiB, baseline {base_bytes / 2 ** 20:.1f} MiB")
+
+    for name, base in baseline['cases'].items():
+        case = results['cases'].get(name)
+        if case is None:
+            continue
+        if 'error' in case and 'error' not in base:
+            regressions.append(f"{name}: failed ({case['error']})")
+            continue
+        base_metrics, metrics = base['metrics'], case['metrics']
+        for key in ('coverage', 'row_accuracy', 'col_accuracy'):
+            if key in base_metrics and metrics.get(key, 0.0) < base_metrics[key] - 1e-9:
+                regressions.append(f"{name} {key}: {metrics.get(key, 0.0):.4f}, baseline {base_metrics[key]:.4f}")
+        if 'digest' in base_metrics and metrics.get('digest') != base_metrics['digest']:
+            regressions.append(f"{name}: grid assignment changed")
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'group':<28}{'cases':>6}" + ''.join(f'{stage[:12]:>14}' for stage in STAGES) + f"{'peak MiB':>10}"]
+    for name, group in group_totals(results).items():
+        cells = ''.join(
+            f"{1000 * group['seconds'][stage]:>11.1f} ms" if stage in group['seconds'] else f"{'-':>14}"
+            for stage in STAGES
+        )
+        peak = max(group['peak_bytes'].values(), default=0) / 2 ** 20
+        lines.append(f"{name:<28}{group['cases']:>6}{cells}{peak:>10.1f}")
+
+    for name, case in results['cases'].items():
+        metrics = case['metrics']
+        if 'error' in case:
+            lines.append(f"{name}: failed ({case['error']})")
+        elif 'row_accuracy' in metrics or metrics.get('coverage', 1.0) < 1.0:
+            accuracy = ''
+            if 'row_accuracy' in metrics:
+                accuracy = f", rows {metrics['row_accuracy']:.3f}, columns {metrics['col_accuracy']:.3f}"
+            lines.append(f"{name}: {metrics['cores']} cores, coverage {metrics['coverage']:.3f}{accuracy}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the gridding stages.')
+    parser.add_argument('--labels', nargs='*', default=['TMA_WSI_Labels_updated'],
+                        help='Directories of {x, y, radius} JSON files, none for synthetic grids only')
+    parser.add_argument('--sizes', nargs='*', default=list(DEFAULT_SIZES), help='Synthetic grid sizes, e.g. 40x40')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case, the fastest is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown and memory growth')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.labels, args.sizes, repeat=args.repeat)
+    print(format_results(results))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}, run with --update-baseline to record one")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regressions against {args.baseline}:")
+        print('\n'.join('  ' + message for message in regressions))
+        return 1
+    print(f"\nNo regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
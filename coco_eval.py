@@ -1,17 +1,25 @@
 import copy
 import io
+from collections import defaultdict
 from contextlib import redirect_stdout
+from multiprocessing import Pool
 
 import numpy as np
 import pycocotools.mask as mask_util
 import torch
-import utils
+import torch.distributed as dist
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 
 
 class CocoEvaluator:
-    def __init__(self, coco_gt, iou_types):
+    """
+    With workers > 1 the images of every update are split into contiguous
+    shards of sorted ids, and each shard is loaded and evaluated in a local
+    process pool. This needs no torch.distributed setup.
+    """
+
+    def __init__(self, coco_gt, iou_types, workers=1, crop_masks=False):
         if not isinstance(iou_types, (list, tuple)):
             raise TypeError(f"This constructor expects iou_types of type list or tuple, instead  got {type(iou_types)}")
         coco_gt = copy.deepcopy(coco_gt)
@@ -25,10 +33,18 @@ class CocoEvaluator:
         self.img_ids = []
         self.eval_imgs = {k: [] for k in iou_types}
 
+        self.workers = workers
+        self.pool = None
+        self.crop_masks = crop_masks
+
     def update(self, predictions):
         img_ids = list(np.unique(list(predictions.keys())))
         self.img_ids.extend(img_ids)
 
+        if self.workers > 1 and len(img_ids) > 1:
+            self._update_parallel(predictions, img_ids)
+            return
+
         for iou_type in self.iou_types:
             results = self.prepare(predictions, iou_type)
             with redirect_stdout(io.StringIO()):
@@ -41,7 +57,36 @@ class CocoEvaluator:
 
             self.eval_imgs[iou_type].append(eval_imgs)
 
+    def _update_parallel(self, predictions, img_ids):
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=_init_worker, initargs=(self.coco_gt,))
+
+        shards = [list(shard) for shard in np.array_split(img_ids, min(self.workers, len(img_ids)))]
+        jobs = []
+        for iou_type in self.iou_types:
+            results = self.prepare(predictions, iou_type)
+            for shard in shards:
+                shard_ids = set(shard)
+                params = copy.copy(self.coco_eval[iou_type].params)
+                params.imgIds = shard
+                shard_results = [result for result in results if result["image_id"] in shard_ids]
+                jobs.append((iou_type, self.pool.apply_async(_evaluate_shard, (params, shard_results))))
+
+        # Shards are contiguous runs of the sorted ids, so concatenating them keeps the order of evaluate()
+        shard_eval_imgs = {iou_type: [] for iou_type in self.iou_types}
+        for iou_type, job in jobs:
+            shard_eval_imgs[iou_type].append(job.get()[1])
+        for iou_type in self.iou_types:
+            self.eval_imgs[iou_type].append(np.concatenate(shard_eval_imgs[iou_type], 2))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def synchronize_between_processes(self):
+        self.close()
         for iou_type in self.iou_types:
             self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
             create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
@@ -98,16 +143,10 @@ class CocoEvaluator:
             labels = prediction["labels"]
             masks = prediction["masks"]
 
-            masks = masks > 0.5
-
             scores = prediction["scores"].tolist()
             labels = prediction["labels"].tolist()
 
-            rles = [
-                mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0] for mask in masks
-            ]
-            for rle in rles:
-                rle["counts"] = rle["counts"].decode("utf-8")
+            rles = encode_masks(masks, self.crop_masks)
 
             coco_results.extend(
                 [
@@ -149,14 +188,282 @@ class CocoEvaluator:
         return coco_results
 
 
+class DetectionStore:
+    """
+    Detections of one iou type, appended into preallocated columns that grow
+    by doubling. Segmentations are kept as a list of RLEs.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.image_id = np.empty(capacity, dtype=np.int64)
+        self.category_id = np.empty(capacity, dtype=np.int64)
+        self.score = np.empty(capacity, dtype=np.float64)
+        self.bbox = np.empty((capacity, 4), dtype=np.float64)
+        self.area = np.empty(capacity, dtype=np.float64)
+        self.segmentation = []
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, count):
+        capacity = len(self.score)
+        if self.size + count <= capacity:
+            return
+        while capacity < self.size + count:
+            capacity *= 2
+        for name in ("image_id", "category_id", "score", "bbox", "area"):
+            column = getattr(self, name)
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[: self.size] = column[: self.size]
+            setattr(self, name, grown)
+
+    def append(self, image_id, category_id, score, bbox, area, segmentation=None):
+        """
+        Append the detections of one image.
+        :return: (start, end) rows of the new detections.
+        """
+        count = len(score)
+        self._reserve(count)
+        start, end = self.size, self.size + count
+        self.image_id[start:end] = image_id
+        self.category_id[start:end] = category_id
+        self.score[start:end] = score
+        self.bbox[start:end] = bbox
+        self.area[start:end] = area
+        if segmentation is not None:
+            self.segmentation.extend(segmentation)
+        self.size = end
+        return start, end
+
+
+class IncrementalCocoEvaluator:
+    """
+    Evaluator that matches each image as soon as its predictions arrive.
+
+    The ground truth is shared and never modified. Detections are appended to
+    a DetectionStore instead of a new COCO built by loadRes, and only the
+    per-image match results of COCOeval.evaluateImg are kept. accumulate()
+    and summarize() can therefore be called at any point of an epoch. The
+    results are the same as CocoEvaluator for the bbox and segm iou types.
+    """
+
+    def __init__(self, coco_gt, iou_types, capacity=1024, crop_masks=False):
+        if not isinstance(iou_types, (list, tuple)):
+            raise TypeError(f"This constructor expects iou_types of type list or tuple, instead  got {type(iou_types)}")
+        for iou_type in iou_types:
+            if iou_type not in ("bbox", "segm"):
+                raise ValueError(f"Unsupported iou type {iou_type} for incremental evaluation")
+        self.coco_gt = coco_gt
+        self.crop_masks = crop_masks
+
+        self.iou_types = iou_types
+        self.coco_eval = {}
+        self.detections = {}
+        self.image_rows = {}
+        self.eval_imgs = {}
+        for iou_type in iou_types:
+            coco_eval = COCOeval(coco_gt, iouType=iou_type)
+            coco_eval.params.catIds = list(np.unique(coco_eval.params.catIds))
+            coco_eval.params.maxDets = sorted(coco_eval.params.maxDets)
+            self.coco_eval[iou_type] = coco_eval
+            self.detections[iou_type] = DetectionStore(capacity)
+            self.image_rows[iou_type] = defaultdict(list)
+            # Image id -> evaluateImg results for every (category, area range)
+            self.eval_imgs[iou_type] = {}
+
+    def update(self, predictions):
+        for iou_type in self.iou_types:
+            store = self.detections[iou_type]
+            for image_id, prediction in predictions.items():
+                if len(prediction) != 0:
+                    rows = self._append(store, image_id, prediction, iou_type)
+                    self.image_rows[iou_type][image_id].append(rows)
+                self.eval_imgs[iou_type][image_id] = self._evaluate_image(iou_type, image_id)
+
+    def _append(self, store, image_id, prediction, iou_type):
+        scores = prediction["scores"].numpy()
+        labels = prediction["labels"].numpy()
+        if iou_type == "bbox":
+            boxes = convert_to_xywh(prediction["boxes"]).numpy()
+            return store.append(image_id, labels, scores, boxes, boxes[:, 2].astype(np.float64) * boxes[:, 3])
+
+        # Same area and box as COCO.loadRes derives for segmentation results
+        rles = encode_masks(prediction["masks"], self.crop_masks)
+        area = mask_util.area(rles) if rles else np.empty(0)
+        boxes = mask_util.toBbox(rles) if rles else np.empty((0, 4))
+        return store.append(image_id, labels, scores, boxes, area, rles)
+
+    def _evaluate_image(self, iou_type, image_id):
+        coco_eval = self.coco_eval[iou_type]
+        p = coco_eval.params
+        store = self.detections[iou_type]
+
+        # Step 1: Ground truth and detections of the image, as COCOeval._prepare builds them
+        coco_eval._gts = defaultdict(list)
+        coco_eval._dts = defaultdict(list)
+        cat_ids = set(p.catIds)
+        for ann in self.coco_gt.imgToAnns.get(image_id, []):
+            if ann["category_id"] not in cat_ids:
+                continue
+            gt = dict(ann, ignore="iscrowd" in ann and ann["iscrowd"])
+            if iou_type == "segm":
+                gt["segmentation"] = self.coco_gt.annToRLE(ann)
+            coco_eval._gts[image_id, ann["category_id"]].append(gt)
+        for start, end in self.image_rows[iou_type].get(image_id, []):
+            for row in range(start, end):
+                if store.category_id[row] not in cat_ids:
+                    continue
+                dt = {
+                    "id": row + 1,
+                    "image_id": image_id,
+                    "category_id": int(store.category_id[row]),
+                    "score": float(store.score[row]),
+                    "bbox": store.bbox[row].tolist(),
+                    "area": float(store.area[row]),
+                    "iscrowd": 0,
+                }
+                if iou_type == "segm":
+                    dt["segmentation"] = store.segmentation[row]
+                coco_eval._dts[image_id, dt["category_id"]].append(dt)
+
+        # Step 2: Match them for every category and area range
+        coco_eval.ious = {(image_id, cat_id): coco_eval.computeIoU(image_id, cat_id) for cat_id in p.catIds}
+        eval_imgs = [
+            coco_eval.evaluateImg(image_id, cat_id, area_rng, p.maxDets[-1])
+            for cat_id in p.catIds
+            for area_rng in p.areaRng
+        ]
+        coco_eval._gts, coco_eval._dts, coco_eval.ious = defaultdict(list), defaultdict(list), {}
+        return eval_imgs
+
+    def accumulate(self):
+        for iou_type, coco_eval in self.coco_eval.items():
+            img_ids = sorted(self.eval_imgs[iou_type])
+            per_image = np.empty((len(img_ids), len(coco_eval.params.catIds) * len(coco_eval.params.areaRng)), object)
+            for i, img_id in enumerate(img_ids):
+                per_image[i] = self.eval_imgs[iou_type][img_id]
+
+            # COCOeval orders evalImgs by category, then area range, then image
+            coco_eval.evalImgs = list(per_image.T.flatten())
+            coco_eval.params.imgIds = img_ids
+            coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+            with redirect_stdout(io.StringIO()):
+                coco_eval.accumulate()
+
+    def summarize(self):
+        for iou_type, coco_eval in self.coco_eval.items():
+            print(f"IoU metric: {iou_type}")
+            coco_eval.summarize()
+
+    def stats(self):
+        """
+        Accumulate the images seen so far.
+        :return: Dictionary mapping iou type to the 12 COCO summary metrics.
+        """
+        self.accumulate()
+        with redirect_stdout(io.StringIO()):
+            for coco_eval in self.coco_eval.values():
+                coco_eval.summarize()
+        return {iou_type: coco_eval.stats for iou_type, coco_eval in self.coco_eval.items()}
+
+
 def convert_to_xywh(boxes):
     xmin, ymin, xmax, ymax = boxes.unbind(1)
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
 
 
+def encode_masks(masks, crop=False):
+    """
+    Threshold (N, 1, H, W) mask probabilities at 0.5 and RLE-encode them.
+
+    By default the whole batch is reordered into one Fortran-ordered
+    (H, W, N) array and encoded in a single call. With crop=True every mask is
+    cut to the bounding box of its pixels and the full-image run lengths are
+    derived from the box. The thresholding and the search for the box still
+    read the full frame, only the Fortran-order copy and the run-length scan
+    are limited to the box. Both give the same RLEs.
+    :return: List of RLEs with str counts.
+    """
+    masks = (masks > 0.5)[:, 0]
+    if isinstance(masks, torch.Tensor):
+        masks = masks.cpu().numpy()
+    if len(masks) == 0:
+        return []
+
+    if crop:
+        rles = [_encode_cropped(mask) for mask in masks]
+    else:
+        rles = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0), dtype=np.uint8))
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return rles
+
+
+def _encode_cropped(mask):
+    height, width = mask.shape
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return encode_crop(mask[:0, :0], 0, 0, height, width)
+    cols = np.flatnonzero(mask.any(axis=0))
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return encode_crop(mask[top:bottom, left:right], top, left, height, width)
+
+
+def encode_crop(crop, top, left, height, width):
+    """
+    RLE-encode a full (height, width) mask that is empty outside of crop.
+    :param crop: (h, w) binary mask placed at (top, left).
+    :return: RLE with bytes counts, as mask_util.encode returns it.
+    """
+    # Transitions down each column of the crop, in column-major order like the RLE itself
+    padded = np.zeros((crop.shape[0] + 2, crop.shape[1]), dtype=np.int8)
+    padded[1:-1] = crop
+    col, row = np.nonzero(np.diff(padded, axis=0).T)
+    positions = (left + col) * height + top + row
+
+    # A run ending at the bottom of a column and one starting at the top of the next one are a single run
+    positions, repeats = np.unique(positions, return_counts=True)
+    positions = positions[repeats == 1]
+
+    counts = np.diff(np.concatenate([[0], positions, [height * width]]))
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    return mask_util.frPyObjects({"counts": counts.tolist(), "size": [height, width]}, height, width)
+
+
+# Ground truth of the pool workers, set once per process
+_coco_gt = None
+
+
+def _init_worker(coco_gt):
+    global _coco_gt
+    _coco_gt = coco_gt
+
+
+def _evaluate_shard(params, results):
+    with redirect_stdout(io.StringIO()):
+        coco_dt = COCO.loadRes(_coco_gt, results) if results else COCO()
+    coco_eval = COCOeval(_coco_gt, coco_dt, iouType=params.iouType)
+    coco_eval.params = params
+    return evaluate(coco_eval)
+
+
+def all_gather(data):
+    """
+    Gather picklable data from every torch.distributed process, or just wrap
+    it in a list when running in a single process.
+    """
+    if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+        return [data]
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, data)
+    return gathered
+
+
 def merge(img_ids, eval_imgs):
-    all_img_ids = utils.all_gather(img_ids)
-    all_eval_imgs = utils.all_gather(eval_imgs)
+    all_img_ids = all_gather(img_ids)
+    all_eval_imgs = all_gather(eval_imgs)
 
     merged_img_ids = []
     for p in all_img_ids:
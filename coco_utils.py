@@ -1,9 +1,18 @@
+import hashlib
+import json
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import torch
 import torch.utils.data
 import torchvision
 import transforms as T
+from coco_eval import encode_crop
+from label_io import find_label, load_cores
+from masks import disk_stamps
+from PIL import Image
 from pycocotools import mask as coco_mask
 from pycocotools.coco import COCO
 
@@ -119,59 +128,155 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
     return dataset
 
 
-def convert_to_coco_api(ds):
-    coco_ds = COCO()
-    # annotation IDs need to start at 1, not 0, see torchvision issue #1530
-    ann_id = 1
-    dataset = {"images": [], "categories": [], "annotations": []}
-    categories = set()
-    for img_idx in range(len(ds)):
-        # find better way to get target
-        # targets = ds.get_annotations(img_idx)
+def _image_annotations(ds, img_idx):
+    """
+    Targets of one image as columns, with the masks already RLE-encoded.
+    Datasets that define get_annotations(idx), returning the targets plus
+    "height" and "width", are read without decoding or transforming pixels.
+    """
+    if hasattr(ds, "get_annotations"):
+        targets = ds.get_annotations(img_idx)
+        height, width = targets["height"], targets["width"]
+    else:
         img, targets = ds[img_idx]
-        image_id = targets["image_id"]
-        img_dict = {}
-        img_dict["id"] = image_id
-        img_dict["height"] = img.shape[-2]
-        img_dict["width"] = img.shape[-1]
-        dataset["images"].append(img_dict)
-        bboxes = targets["boxes"].clone()
-        bboxes[:, 2:] -= bboxes[:, :2]
-        bboxes = bboxes.tolist()
-        labels = targets["labels"].tolist()
-        areas = targets["area"].tolist()
-        iscrowd = targets["iscrowd"].tolist()
-        if "masks" in targets:
-            masks = targets["masks"]
-            # make masks Fortran contiguous for coco_mask
-            masks = masks.permute(0, 2, 1).contiguous().permute(0, 2, 1)
-        if "keypoints" in targets:
-            keypoints = targets["keypoints"]
-            keypoints = keypoints.reshape(keypoints.shape[0], -1).tolist()
-        num_objs = len(bboxes)
-        for i in range(num_objs):
-            ann = {}
-            ann["image_id"] = image_id
-            ann["bbox"] = bboxes[i]
-            ann["category_id"] = labels[i]
-            categories.add(labels[i])
-            ann["area"] = areas[i]
-            ann["iscrowd"] = iscrowd[i]
-            ann["id"] = ann_id
-            if "masks" in targets:
-                ann["segmentation"] = coco_mask.encode(masks[i].numpy())
-            if "keypoints" in targets:
-                ann["keypoints"] = keypoints[i]
-                ann["num_keypoints"] = sum(k != 0 for k in keypoints[i][2::3])
-            dataset["annotations"].append(ann)
-            ann_id += 1
-    dataset["categories"] = [{"id": i} for i in sorted(categories)]
+        height, width = img.shape[-2], img.shape[-1]
+
+    bboxes = targets["boxes"].clone()
+    bboxes[:, 2:] -= bboxes[:, :2]
+    columns = {
+        "image_id": targets["image_id"],
+        "height": height,
+        "width": width,
+        "bbox": bboxes.numpy(),
+        "category_id": targets["labels"].numpy(),
+        "area": targets["area"].numpy(),
+        "iscrowd": targets["iscrowd"].numpy(),
+    }
+    if "segmentation" in targets:
+        columns["segmentation"] = targets["segmentation"]
+    elif "masks" in targets:
+        # One Fortran-ordered (H, W, N) array and a single encode call for all instances
+        masks = targets["masks"].to(torch.uint8).permute(1, 2, 0).numpy()
+        columns["segmentation"] = coco_mask.encode(np.asfortranarray(masks)) if masks.shape[2] else []
+    if "keypoints" in targets:
+        keypoints = targets["keypoints"]
+        columns["keypoints"] = keypoints.reshape(keypoints.shape[0], -1).numpy()
+    return columns
+
+
+def _unwrap_subset(ds, indices):
+    # Read through Subsets so get_annotations of the underlying dataset is used
+    while isinstance(ds, torch.utils.data.Subset):
+        indices = [ds.indices[i] for i in indices]
+        ds = ds.dataset
+    return ds, indices
+
+
+# Dataset of the conversion workers, set once per process
+_convert_ds = None
+
+
+def _init_convert_worker(ds):
+    global _convert_ds
+    _convert_ds = ds
+
+
+def _convert_worker_annotations(img_idx):
+    return _image_annotations(_convert_ds, img_idx)
+
+
+def dataset_fingerprint(ds):
+    """
+    Key of the COCO conversion cache, or None when the dataset cannot
+    describe its annotations without being read. Datasets opt in by defining
+    fingerprint() returning a string that changes whenever their annotations do.
+    """
+    base, indices = _unwrap_subset(ds, list(range(len(ds))))
+    if not hasattr(base, "fingerprint"):
+        return None
+    key = hashlib.sha1(base.fingerprint().encode())
+    key.update(np.asarray(indices, dtype=np.int64).tobytes())
+    return key.hexdigest()
+
+
+def convert_to_coco_api(ds, cache_dir=None, workers=1):
+    """
+    Build a COCO ground truth from a detection dataset.
+    :param ds: Dataset returning (image, targets), optionally with get_annotations and fingerprint.
+    :param cache_dir: Where converted datasets are stored by fingerprint, so later runs load them instead.
+    :param workers: Number of worker processes reading the annotations.
+    :return: COCO object.
+    """
+    fingerprint = dataset_fingerprint(ds) if cache_dir is not None else None
+    if fingerprint is not None:
+        cache_path = os.path.join(cache_dir, f"coco_api_{fingerprint}.pkl")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                dataset = pickle.load(f)
+            return _coco_from_dataset(dataset)
+
+    # Step 1: Read the annotation columns of every image, in parallel if asked to
+    base, indices = _unwrap_subset(ds, list(range(len(ds))))
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_init_convert_worker, initargs=(base,)) as executor:
+            images = list(executor.map(_convert_worker_annotations, indices, chunksize=16))
+    else:
+        images = [_image_annotations(base, img_idx) for img_idx in indices]
+
+    # Step 2: Concatenate the columns and build the annotation dicts in one pass
+    counts = [len(image["category_id"]) for image in images]
+    image_ids = [image["image_id"] for image, count in zip(images, counts) for _ in range(count)]
+    bboxes = [value for image in images for value in image["bbox"].tolist()]
+    labels = [value for image in images for value in image["category_id"].tolist()]
+    areas = [value for image in images for value in image["area"].tolist()]
+    iscrowd = [value for image in images for value in image["iscrowd"].tolist()]
+
+    # annotation IDs need to start at 1, not 0, see torchvision issue #1530
+    annotations = [
+        {
+            "image_id": image_ids[i],
+            "bbox": bboxes[i],
+            "category_id": labels[i],
+            "area": areas[i],
+            "iscrowd": iscrowd[i],
+            "id": i + 1,
+        }
+        for i in range(len(labels))
+    ]
+    if any("segmentation" in image for image in images):
+        segmentations = [rle for image in images for rle in image["segmentation"]]
+        for ann, rle in zip(annotations, segmentations):
+            ann["segmentation"] = rle
+    if any("keypoints" in image for image in images):
+        keypoints = [value for image in images for value in image["keypoints"].tolist()]
+        num_keypoints = [num for image in images for num in (image["keypoints"][:, 2::3] != 0).sum(axis=1).tolist()]
+        for ann, keypoint, num in zip(annotations, keypoints, num_keypoints):
+            ann["keypoints"] = keypoint
+            ann["num_keypoints"] = num
+
+    dataset = {
+        "images": [{"id": image["image_id"], "height": image["height"], "width": image["width"]} for image in images],
+        "categories": [{"id": i} for i in sorted(set(labels))],
+        "annotations": annotations,
+    }
+
+    if fingerprint is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(dataset, f)
+        os.replace(tmp_path, cache_path)
+    return _coco_from_dataset(dataset)
+
+
+def _coco_from_dataset(dataset):
+    coco_ds = COCO()
     coco_ds.dataset = dataset
     coco_ds.createIndex()
     return coco_ds
 
 
-def get_coco_api_from_dataset(dataset):
+def get_coco_api_from_dataset(dataset, cache_dir=None, workers=1):
     # FIXME: This is... awful?
     for _ in range(10):
         if isinstance(dataset, torchvision.datasets.CocoDetection):
@@ -180,7 +285,7 @@ def get_coco_api_from_dataset(dataset):
             dataset = dataset.dataset
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
-    return convert_to_coco_api(dataset)
+    return convert_to_coco_api(dataset, cache_dir, workers)
 
 
 class CocoDetection(torchvision.datasets.CocoDetection):
@@ -197,6 +302,118 @@ class CocoDetection(torchvision.datasets.CocoDetection):
         return img, target
 
 
+class TMACircleDataset(torch.utils.data.Dataset):
+    """
+    Detection dataset read straight from {x, y, radius} label files, e.g.
+    TMA_WSI_Padded_PNGs with TMA_WSI_Labels_updated.
+
+    Boxes are the bounding squares of the circles and the area is pi * r^2.
+    The circles themselves are in target["circles"] as (x, y, radius). Full
+    (N, H, W) masks are only rasterized when with_masks is set, for models
+    and transforms that need them. get_annotations returns the targets with
+    per-instance RLEs built from each core's box, without decoding the image.
+    With crop_masks the masks are instead returned as target["mask_crops"]
+    (N, h, w) crops at the boxes and target["mask_offsets"] (N, 2) (top, left),
+    the form transforms.SimpleCopyPaste works on. The geometric transforms
+    move, resize and clip the crops like they do full masks.
+    """
+
+    def __init__(self, img_folder, label_folder, transforms=None, with_masks=False, category_id=1, crop_masks=False):
+        if crop_masks and not with_masks:
+            raise ValueError("crop_masks only applies with with_masks=True")
+        self.img_folder = img_folder
+        self.label_folder = label_folder
+        self._transforms = transforms
+        self.with_masks = with_masks
+        self.crop_masks = crop_masks
+        self.category_id = category_id
+        self.names = [
+            os.path.splitext(filename)[0]
+            for filename in sorted(os.listdir(img_folder))
+            if filename.endswith(".png") and os.path.exists(find_label(label_folder, os.path.splitext(filename)[0]))
+        ]
+        self._circles = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _label_path(self, idx):
+        return find_label(self.label_folder, self.names[idx])
+
+    def _image_path(self, idx):
+        return os.path.join(self.img_folder, self.names[idx] + ".png")
+
+    def circles(self, idx):
+        # Labels are small, so they are parsed once and kept
+        if idx not in self._circles:
+            self._circles[idx] = load_cores(self._label_path(idx), np.float64)
+        return self._circles[idx]
+
+    def _target(self, idx, height, width):
+        circles = self.circles(idx)
+        x, y, r = circles.T
+        boxes = np.stack([x - r, y - r, x + r, y + r], axis=1)
+        boxes[:, 0::2] = boxes[:, 0::2].clip(0, width)
+        boxes[:, 1::2] = boxes[:, 1::2].clip(0, height)
+        keep = (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
+        circles = circles[keep]
+
+        return {
+            "boxes": torch.as_tensor(boxes[keep], dtype=torch.float32),
+            "labels": torch.full((len(circles),), self.category_id, dtype=torch.int64),
+            "image_id": idx,
+            "area": torch.as_tensor(np.pi * circles[:, 2] ** 2, dtype=torch.float32),
+            "iscrowd": torch.zeros(len(circles), dtype=torch.int64),
+            "circles": torch.as_tensor(circles, dtype=torch.float64),
+        }
+
+    def instance_masks(self, idx, height, width):
+        """
+        Rasterize every core inside its own box only.
+        :return: List of (top, left, (h, w) uint8 crop).
+        """
+        x, y, r = self._target(idx, height, width)["circles"].numpy().T
+        return [(top, left, stamp.astype(np.uint8)) for top, left, stamp in disk_stamps(x, y, r, (height, width))]
+
+    def get_annotations(self, idx):
+        # Only the PNG header is read for the size
+        with Image.open(self._image_path(idx)) as img:
+            width, height = img.size
+        target = self._target(idx, height, width)
+        target["height"], target["width"] = height, width
+        if self.with_masks:
+            target["segmentation"] = [
+                encode_crop(crop, top, left, height, width) for top, left, crop in self.instance_masks(idx, height, width)
+            ]
+        return target
+
+    def fingerprint(self):
+        stats = [(name, os.stat(self._label_path(i)).st_mtime_ns, os.stat(self._label_path(i)).st_size)
+                 for i, name in enumerate(self.names)]
+        return json.dumps([os.path.abspath(self.label_folder), self.with_masks, self.category_id, stats])
+
+    def __getitem__(self, idx):
+        img = Image.open(self._image_path(idx)).convert("RGB")
+        width, height = img.size
+        target = self._target(idx, height, width)
+        if self.with_masks and self.crop_masks:
+            instances = self.instance_masks(idx, height, width)
+            side = max([max(crop.shape) for _, _, crop in instances], default=0)
+            crops = np.zeros((len(instances), side, side), dtype=np.uint8)
+            for i, (_, _, crop) in enumerate(instances):
+                crops[i, :crop.shape[0], :crop.shape[1]] = crop
+            target["mask_crops"] = torch.from_numpy(crops)
+            target["mask_offsets"] = torch.tensor([(top, left) for top, left, _ in instances], dtype=torch.int64).reshape(-1, 2)
+        elif self.with_masks:
+            masks = np.zeros((len(target["circles"]), height, width), dtype=np.uint8)
+            for i, (top, left, crop) in enumerate(self.instance_masks(idx, height, width)):
+                masks[i, top:top + crop.shape[0], left:left + crop.shape[1]] = crop
+            target["masks"] = torch.from_numpy(masks)
+        if self._transforms is not None:
+            img, target = self._transforms(img, target)
+        return img, target
+
+
 def get_coco(root, image_set, transforms, mode="instances", use_v2=False, with_masks=False):
     anno_file_template = "{}_{}2017.json"
     PATHS = {
@@ -0,0 +1,219 @@
+import numpy as np
+from PIL import Image
+
+from profiling import profiled
+
+# Input frame of the segmentation model and the canvas the slides are padded to
+MODEL_INPUT_SIZE = 512
+CANVAS_SIZE = 1024
+
+
+def load_model(model_path):
+    """
+    Load the segmentation model. Paths ending in model.json are read with the
+    TensorFlow.js converter (the format shipped in tfjs_model/), anything else
+    with tf.keras (e.g. the pixel_core_fold_*.hdf5 checkpoints).
+    :param model_path: Path to the model.
+    :return: A Keras model.
+    """
+    if model_path.endswith('.json'):
+        from tensorflowjs.converters import load_keras_model
+
+        return load_keras_model(model_path)
+
+    import tensorflow as tf
+
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+@profiled('decode', lambda image, *args: {'pixels': image.shape[0] * image.shape[1]})
+def load_image(image_path):
+    """
+    Decode an image file into an (H, W, 3) uint8 RGB array.
+    :param image_path: Path to the image.
+    :return: RGB image array.
+    """
+    with Image.open(image_path) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+def crop_image_if_necessary(image, max_width=CANVAS_SIZE, max_height=CANVAS_SIZE):
+    # Center crop images larger than the canvas
+    height, width = image.shape[:2]
+    start_x = (width - max_width) // 2 if width > max_width else 0
+    start_y = (height - max_height) // 2 if height > max_height else 0
+    return image[start_y:start_y + min(height, max_height), start_x:start_x + min(width, max_width)]
+
+
+def pad_image_to_size(image, target_width=CANVAS_SIZE, target_height=CANVAS_SIZE):
+    # Pad to the canvas size, keeping the image in the top left corner
+    padded = np.zeros((target_height, target_width) + image.shape[2:], dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded
+
+
+def preprocess_image(image, size=MODEL_INPUT_SIZE):
+    """
+    Crop, pad and resize an RGB image into the model's input tensor, as
+    preprocessAndPredict does in the browser.
+    :param image: (H, W, 3) uint8 RGB image.
+    :param size: Side length of the model input.
+    :return: (1, size, size, 3) float32 tensor scaled to [0, 1].
+    """
+    import cv2
+
+    image = pad_image_to_size(crop_image_if_necessary(image))
+    resized = cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)
+    return (resized.astype(np.float32) / 255.0)[np.newaxis]
+
+
+@profiled('predict')
+def preprocess_and_predict(image, model):
+    """
+    Run the segmentation model on an RGB image.
+    :param image: (H, W, 3) uint8 RGB image.
+    :param model: Keras model.
+    :return: (512, 512) float32 probability mask.
+    """
+    predictions = model.predict(preprocess_image(image), verbose=0)
+    return np.asarray(predictions, dtype=np.float32).reshape(MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+
+
+# Function to apply the threshold to the predictions
+@profiled('threshold')
+def apply_threshold(predictions, threshold):
+    return (predictions >= threshold).astype(np.uint8) * 255
+
+
+def calculate_centroids(markers, min_area, max_area):
+    """
+    Compute the centroid and equivalent radius of every labelled region whose
+    area lies within [min_area, max_area]. Labels <= 0 (unknown pixels and
+    watershed boundaries) are skipped.
+
+    The per-label pixel counts and coordinate sums come from np.bincount over
+    the flattened label image, so the cost is a few passes over the pixels
+    regardless of the number of regions.
+    :param markers: (H, W) int label image.
+    :param min_area: Minimum region area in pixels.
+    :param max_area: Maximum region area in pixels.
+    :return: Dictionary mapping label to {'x', 'y', 'radius'}.
+    """
+    height, width = markers.shape
+    labels = markers.ravel()
+    if labels.min(initial=0) < 0:
+        labels = np.where(labels < 0, 0, labels)
+
+    count = np.bincount(labels)
+    x_sum = np.bincount(labels, weights=np.tile(np.arange(width, dtype=np.float64), height), minlength=len(count))
+    y_sum = np.bincount(labels, weights=np.repeat(np.arange(height, dtype=np.float64), width), minlength=len(count))
+
+    labels = np.arange(1, len(count))
+    return _filter_regions(labels, count[1:], x_sum[1:], y_sum[1:], min_area, max_area)
+
+
+def _filter_regions(labels, area, x_sum, y_sum, min_area, max_area):
+    keep = (area > 0) & (area >= min_area) & (area <= max_area)
+    labels, area = labels[keep], area[keep]
+    xs = x_sum[keep] / area
+    ys = y_sum[keep] / area
+    radii = np.sqrt(area / np.pi)
+    return {
+        int(label): {'x': float(x), 'y': float(y), 'radius': float(radius)}
+        for label, x, y, radius in zip(labels, xs, ys, radii)
+    }
+
+
+@profiled('segmentation', lambda cores, *args, **kwargs: {'cores': len(cores)})
+def segmentation_algorithm(data, min_area, max_area, dis_transform_multiplier=0.6, watershed=False):
+    """
+    Split a thresholded prediction into cores: Otsu binarisation, opening,
+    distance transform for the sure foreground and connected component
+    markers, mirroring segmentationAlgorithm in core_detection.js. The browser
+    measures the markers directly; watershed=True grows them with
+    cv2.watershed first, which splits touching cores along their boundary.
+    :param data: (H, W) or (H, W, 3) uint8 image of the thresholded mask.
+    :param min_area: Minimum region area in pixels.
+    :param max_area: Maximum region area in pixels.
+    :param dis_transform_multiplier: Fraction of the maximum distance used as the sure foreground threshold.
+    :param watershed: Whether to run the watershed on the markers.
+    :return: Dictionary mapping label to {'x', 'y', 'radius'}.
+    """
+    import cv2
+
+    # Convert to grayscale if the image is not already
+    if data.ndim == 3:
+        gray = cv2.cvtColor(data, cv2.COLOR_RGBA2GRAY if data.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+    else:
+        gray = data.astype(np.uint8, copy=False)
+
+    # Convert to binary image
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+    # Noise removal with opening
+    kernel = np.ones((3, 3), np.uint8)
+    opening = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=2)
+
+    # Sure background area (dilation enlarges the regions)
+    sure_bg = cv2.dilate(opening, kernel, iterations=3)
+
+    # Finding sure foreground area (distance transform gives regions of sure foreground)
+    dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
+    _, sure_fg = cv2.threshold(dist_transform, dis_transform_multiplier * dist_transform.max(), 255, 0)
+
+    sure_fg = np.uint8(sure_fg)
+
+    if watershed:
+        # Finding unknown region (subtracting sure foreground from sure background)
+        unknown = cv2.subtract(sure_bg, sure_fg)
+
+        # Marker labelling
+        _, markers = cv2.connectedComponents(sure_fg, ltype=cv2.CV_32S)
+
+        # Add one to all labels so that sure background is not 0, but 1
+        markers += 1
+
+        # Now, mark the region of unknown with zero
+        markers[unknown == 255] = 0
+
+        markers = cv2.watershed(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), markers)
+        return calculate_centroids(markers, min_area, max_area)
+
+    # Without the watershed, markers 2.. are exactly the connected components of the sure foreground and
+    # marker 1 is everything outside the sure background, so their statistics come straight from OpenCV
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(sure_fg, ltype=cv2.CV_32S)
+    background = cv2.moments(cv2.bitwise_not(sure_bg), binaryImage=True)
+    area = np.concatenate([[background['m00']], stats[1:, cv2.CC_STAT_AREA]]).astype(np.float64)
+    x_sum = np.concatenate([[background['m10']], centroids[1:, 0] * area[1:]])
+    y_sum = np.concatenate([[background['m01']], centroids[1:, 1] * area[1:]])
+    return _filter_regions(np.arange(1, count + 1), area, x_sum, y_sum, min_area, max_area)
+
+
+def run_pipeline(image, model, threshold=0.5, min_area=0, max_area=2000, dis_transform_multiplier=0.625):
+    """
+    Predict, threshold and segment an image, returning the core centroids in
+    the coordinates of the padded 1024x1024 canvas.
+    :param image: (H, W, 3) uint8 RGB image.
+    :param model: Keras model.
+    :return: List of {'x', 'y', 'radius'} dictionaries.
+    """
+    predictions = preprocess_and_predict(image, model)
+    return segment_predictions(predictions, threshold, min_area, max_area, dis_transform_multiplier)
+
+
+def segment_predictions(predictions, threshold=0.5, min_area=0, max_area=2000, dis_transform_multiplier=0.625):
+    """
+    Threshold and segment a (512, 512) probability mask, returning the core
+    centroids in the coordinates of the padded 1024x1024 canvas.
+    :param predictions: (512, 512) float probability mask.
+    :return: List of {'x', 'y', 'radius'} dictionaries.
+    """
+    thresholded_predictions = apply_threshold(predictions, threshold)
+    properties = segmentation_algorithm(thresholded_predictions, min_area, max_area, dis_transform_multiplier)
+
+    # Scale centroids back to the canvas size
+    scale = CANVAS_SIZE / MODEL_INPUT_SIZE
+    return [
+        {'x': prop['x'] * scale, 'y': prop['y'] * scale, 'radius': prop['radius'] * scale}
+        for prop in properties.values()
+    ]
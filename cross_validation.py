@@ -0,0 +1,322 @@
+"""
+Leave-one-slide-out cross-validation of the U-Net, several folds at a time.
+
+Runs the training loop of SegmentationMobileNet.ipynb for every fold: one
+slide is held out for testing, the next two validate, and the augmented
+copies of the remaining slides are trained on. The slides come from a
+dataset_cache.py cache, which every worker memory-maps, so the dataset is
+decoded once and shared by all folds through the page cache.
+
+Folds run in separate processes with a limited number of threads each, and a
+row is appended to the results CSV as soon as a fold finishes. With --resume,
+an interrupted sweep picks up where it stopped: folds already in the CSV are
+skipped, folds whose training completed are only evaluated from their
+checkpoint, and unfinished folds continue training from the epoch, optimizer
+state and best validation loss they had reached.
+
+Example:
+    python dataset_cache.py dataset_cache --source augmented_images augmented_labels \
+        --source TMA_WSI_Padded_PNGs TMA_WSI_Labels_updated --size 512
+    python cross_validation.py dataset_cache --workers 3 --threads 4 --epochs 150
+    python cross_validation.py dataset_cache --workers 3 --threads 4 --epochs 150 --resume
+"""
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataset_cache import DatasetCache, slide_group
+
+CSV_HEADER = ['Fold', 'Loss', 'AUC', 'Accuracy', 'Precision', 'Recall']
+DEFAULT_CSV = 'cv_results.csv'
+
+
+def create_loocv_folds(names, augmentations=20):
+    """
+    Folds of the notebook's create_loocv_folds, on slide names.
+    :param names: Slide names in the cache, originals and '<slide>_aug_<n>' copies.
+    :param augmentations: Number of augmented copies per slide.
+    :return: List of (training names, [test name], validation names), fold i + 1 at index i.
+    """
+    available = set(names)
+    originals = sorted(name for name in names if slide_group(name) == name)
+    n = len(originals)
+
+    folds = []
+    for i in range(n):
+        val_indices = [(i + 1) % n, (i + 2) % n]
+        train = [name for index, name in enumerate(originals) if index not in [i] + val_indices]
+        augmented_train = [f'{name}_aug_{k}' for name in train for k in range(augmentations)
+                           if f'{name}_aug_{k}' in available]
+        folds.append((augmented_train, [originals[i]], [originals[j] for j in val_indices]))
+    return folds
+
+
+def weighted_binary_crossentropy(zero_weight, one_weight):
+    from tensorflow.keras import backend as K
+
+    def loss(y_true, y_pred):
+        bce = K.binary_crossentropy(y_true, y_pred)
+        weight_vector = y_true * one_weight + (1. - y_true) * zero_weight
+        return K.mean(weight_vector * bce)
+    return loss
+
+
+def scheduler(epoch, lr):
+    # Learning rate schedule of the notebook
+    import tensorflow as tf
+
+    if epoch < 15 and epoch % 2 == 0:
+        return lr * tf.math.exp(-0.2)
+    elif epoch > 30:
+        return lr * tf.math.exp(-0.5)
+    return lr
+
+
+def unet(input_size=(512, 512, 3), num_filters=16, depth=2, dropout=0.5, batch_norm=True):
+    """
+    The U-Net of SegmentationMobileNet.ipynb.
+    """
+    from tensorflow.keras.layers import (
+        Activation, BatchNormalization, Conv2D, Dropout, Input, MaxPooling2D, UpSampling2D, concatenate,
+    )
+    from tensorflow.keras.models import Model
+
+    def conv_block(x, filters):
+        for _ in range(2):
+            x = Conv2D(filters, 3, padding='same', kernel_initializer='he_normal')(x)
+            if batch_norm:
+                x = BatchNormalization()(x)
+            x = Activation('relu')(x)
+        return x
+
+    inputs = Input(input_size)
+    conv_blocks = []
+    x = inputs
+    for i in range(depth):
+        x = conv_block(x, num_filters * (2 ** i))
+        conv_blocks.append(x)
+        x = MaxPooling2D(pool_size=(2, 2))(x)
+        if dropout:
+            x = Dropout(dropout)(x)
+
+    x = conv_block(x, num_filters * (2 ** depth))
+
+    for i in reversed(range(depth)):
+        x = UpSampling2D(size=(2, 2))(x)
+        x = concatenate([x, conv_blocks[i]], axis=3)
+        x = conv_block(x, num_filters * (2 ** i))
+
+    output = Conv2D(1, 1, activation='sigmoid')(x)
+    return Model(inputs=inputs, outputs=output)
+
+
+# Cache opened once per worker process
+_cache = None
+
+
+def _init_worker(cache_dir, threads):
+    global _cache
+    # The limits have to be set before TensorFlow starts its thread pools
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    if threads:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+        os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    _cache = DatasetCache(cache_dir)
+
+
+def _fold_files(checkpoint_path):
+    # Marker of a finished training, best validation loss so far, and the BackupAndRestore directory
+    return checkpoint_path + '.done', checkpoint_path + '.json', checkpoint_path + '.backup'
+
+
+def _load_best(state_path):
+    try:
+        with open(state_path) as file:
+            return json.load(file)['best']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_best(state_path, best):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'best': best}, file)
+    os.replace(tmp_path, state_path)
+
+
+def _run_fold(fold_number, fold, checkpoint_path, epochs, batch_size, resume=False):
+    from tensorflow.keras.callbacks import (
+        BackupAndRestore, EarlyStopping, LambdaCallback, LearningRateScheduler, ModelCheckpoint,
+    )
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.optimizers import Adam
+
+    train_names, test_names, val_names = fold
+    custom_loss = weighted_binary_crossentropy(zero_weight=1, one_weight=1)
+    done_path, state_path, backup_dir = _fold_files(checkpoint_path)
+
+    if not resume:
+        # A fresh run must not pick up the checkpoint or training state of an earlier one
+        for path in (checkpoint_path, done_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(backup_dir, ignore_errors=True)
+
+    if not os.path.exists(done_path):
+        # Step 1: Train. BackupAndRestore restores the weights, optimizer and epoch of an interrupted run, and
+        # the stored best validation loss keeps a worse first epoch from overwriting the best checkpoint
+        best = _load_best(state_path)
+
+        def record_best(epoch, logs):
+            nonlocal best
+            val_loss = (logs or {}).get('val_loss')
+            if val_loss is not None and (best is None or val_loss < best):
+                best = float(val_loss)
+                _save_best(state_path, best)
+
+        model = unet()
+        model.compile(optimizer=Adam(learning_rate=1e-3), loss=custom_loss,
+                      metrics=['AUC', 'accuracy', 'Precision', 'Recall'])
+        model.fit(
+            _cache.batches(train_names, batch_size, shuffle=True, seed=fold_number),
+            steps_per_epoch=math.ceil(len(train_names) / batch_size),
+            epochs=epochs,
+            verbose=2,
+            validation_data=_cache.load(val_names),
+            callbacks=[
+                BackupAndRestore(backup_dir),
+                ModelCheckpoint(checkpoint_path, monitor='val_loss', verbose=1, save_best_only=True,
+                                initial_value_threshold=best),
+                LambdaCallback(on_epoch_end=record_best),
+                LearningRateScheduler(scheduler),
+                EarlyStopping(monitor='val_loss', patience=40, verbose=1, baseline=best, restore_best_weights=True),
+            ],
+        )
+        open(done_path, 'w').close()
+
+    # Step 2: Evaluate the best checkpoint on the held-out slide
+    model = load_model(checkpoint_path, custom_objects={'loss': custom_loss})
+    test_images, test_masks = _cache.load(test_names)
+    loss, auc, accuracy, precision, recall = model.evaluate(test_images, test_masks, verbose=0)
+    return [fold_number, loss, auc, accuracy, precision, recall]
+
+
+def finished_folds(csv_path):
+    """
+    Fold numbers that already have a row in the results CSV.
+    """
+    if not os.path.exists(csv_path):
+        return set()
+    with open(csv_path, newline='') as file:
+        return {int(row['Fold']) for row in csv.DictReader(file)}
+
+
+def _drop_rows(csv_path, fold_numbers):
+    # Rewrites the CSV without the rows of fold_numbers, keeping the results of every other fold
+    kept = []
+    if os.path.exists(csv_path):
+        with open(csv_path, newline='') as file:
+            kept = [row for row in csv.DictReader(file) if int(row['Fold']) not in fold_numbers]
+    tmp_path = csv_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_HEADER)
+        writer.writerows([row[column] for column in CSV_HEADER] for row in kept)
+    os.replace(tmp_path, csv_path)
+
+
+def run_cross_validation(cache_dir, csv_path=DEFAULT_CSV, checkpoint_dir='.', fold_numbers=None, workers=2,
+                         threads=None, epochs=300, batch_size=32, augmentations=20, resume=False):
+    """
+    Train and evaluate the leave-one-out folds, several at a time.
+    :param cache_dir: Directory written by dataset_cache.py with the original and augmented slides.
+    :param csv_path: Results CSV, rows are written as folds finish.
+    :param checkpoint_dir: Directory of the pixel_core_fold_<n>.hdf5 checkpoints.
+    :param fold_numbers: 1-based folds to run, all by default.
+    :param workers: Number of folds trained at the same time.
+    :param threads: Threads per fold, by default the CPU cores divided by the workers.
+    :param epochs: Maximum number of epochs per fold.
+    :param batch_size: Number of slides per batch.
+    :param augmentations: Number of augmented copies per slide in the cache.
+    :param resume: Skip the folds already in the CSV and continue unfinished folds from their checkpoints.
+        Otherwise the folds run train from scratch and their rows in the CSV are replaced, the rows of other
+        folds are kept.
+    :return: (rows written in this run, fold numbers that failed).
+    """
+    folds = create_loocv_folds(DatasetCache(cache_dir).names, augmentations)
+    if fold_numbers is None:
+        fold_numbers = range(1, len(folds) + 1)
+    done = finished_folds(csv_path) if resume else set()
+    pending = [number for number in fold_numbers if number not in done]
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    rows, failed = [], []
+    if not resume:
+        _drop_rows(csv_path, set(fold_numbers))
+    write_header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+    with open(csv_path, 'a', newline='') as file:
+        writer = csv.writer(file)
+        if write_header:
+            writer.writerow(CSV_HEADER)
+            file.flush()
+
+        # TensorFlow does not survive a fork, so the workers are spawned
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(cache_dir, threads)) as executor:
+            futures = {
+                executor.submit(_run_fold, number, folds[number - 1],
+                                os.path.join(checkpoint_dir, f'pixel_core_fold_{number}.hdf5'), epochs, batch_size,
+                                resume): number
+                for number in pending
+            }
+            for future in as_completed(futures):
+                # A failed fold must not stop the rows of the others from being written
+                try:
+                    row = future.result()
+                except Exception as error:
+                    failed.append(futures[future])
+                    print(f"Fold {futures[future]}: failed ({error})", file=sys.stderr)
+                    continue
+                writer.writerow(row)
+                file.flush()
+                rows.append(row)
+    return rows, sorted(failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Leave-one-slide-out cross-validation of the U-Net.')
+    parser.add_argument('cache_dir', help='Training set cache written by dataset_cache.py')
+    parser.add_argument('--csv', default=DEFAULT_CSV, help='Results CSV')
+    parser.add_argument('--checkpoint-dir', default='.', help='Directory of the fold checkpoints')
+    parser.add_argument('--folds', type=int, nargs='+', help='1-based folds to run, all by default')
+    parser.add_argument('--workers', type=int, default=2, help='Number of folds trained at the same time')
+    parser.add_argument('--threads', type=int, help='Threads per fold')
+    parser.add_argument('--epochs', type=int, default=300, help='Maximum number of epochs per fold')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of slides per batch')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip folds already in the CSV and continue unfinished folds from their checkpoints')
+    args = parser.parse_args(argv)
+
+    rows, failed = run_cross_validation(args.cache_dir, args.csv, args.checkpoint_dir, args.folds, args.workers,
+                                        args.threads, args.epochs, args.batch_size, resume=args.resume)
+    print(f"{len(rows)} folds written to {args.csv}, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import numpy as np
+
+from delaunay_triangulation import (
+    determine_image_rotation,
+    filter_edges_by_angle,
+    filter_edges_by_length,
+    get_edges_from_coordinates,
+    limit_connections,
+    sort_edges_and_add_isolated_points,
+    traveling_algorithm,
+)
+from profiling import profiled
+
+# Defaults of the hyperparameter inputs in index.html
+DEFAULT_HYPERPARAMETERS = {
+    'threshold_multiplier': 1.5,
+    'threshold_angle': 10,
+    'origin_angle': 0,
+    'radius_multiplier': 0.6,
+    'min_angle': 0,
+    'max_angle': 5,
+    'angle_step_size': 5,
+    'angle_threshold': 20,
+    'multiplier': 1.5,
+    # The browser's sector search only checks the radius, i.e. a full circle
+    'search_angle': 360,
+    'gamma': 60,
+    'grid_width': 70,
+    'image_width': 1024,
+    'user_radius': 20,
+}
+
+
+def rotate_point(point, angle):
+    radians = np.radians(angle)
+    cos, sin = np.cos(radians), np.sin(radians)
+    return np.array([point[0] * cos - point[1] * sin, point[0] * sin + point[1] * cos])
+
+
+def normalize_cores(cores):
+    """
+    Offset the cores so the minimum x and y are zero, as preprocessCores does.
+    :param cores: List of dictionaries with 'x' and 'y' keys.
+    :return: ((N, 2) normalized coordinates, (min_x, min_y) offset).
+    """
+    coordinates = np.array([(core['x'], core['y']) for core in cores], dtype=np.float64).reshape(-1, 2)
+    offset = coordinates.min(axis=0)
+    return coordinates - offset, offset
+
+
+def calculate_grid_width(coordinates, d, multiplier):
+    return coordinates[:, 0].max() + multiplier * d
+
+
+def calculate_average_distance(edges, coordinates):
+    # Median length of the traveling algorithm input, isolated points included
+    delta = coordinates[edges[:, 0]] - coordinates[edges[:, 1]]
+    return float(np.median(np.hypot(delta[:, 0], delta[:, 1])))
+
+
+# Function to calculate the median x coordinate of the first column
+def calculate_median_x(sorted_rows, origin_angle):
+    return float(np.median([rotate_point(row[0]['point'], -origin_angle)[0] for row in sorted_rows]))
+
+
+def sort_row_by_rotated_x(row, origin_angle):
+    return sorted(row, key=lambda core: rotate_point(core['point'], -origin_angle)[0])
+
+
+def sort_rows_by_rotated_points(rows, origin_angle):
+    # Sort the rows based on the y-coordinate of the rotated first point in each row
+    return sorted(rows, key=lambda row: rotate_point(row[0]['point'], -origin_angle)[1])
+
+
+# Function to normalize rows by adding imaginary points
+def normalize_rows_by_adding_imaginary_points(sorted_rows, median_x, grid_width, origin_angle,
+                                              threshold_for_imaginary_points=0.6):
+    normalized_rows = []
+    for row in sorted_rows:
+        # Rotate first point to align with the x-axis
+        rotated_first_point = rotate_point(row[0]['point'], -origin_angle)
+
+        # Determine the number of imaginary points to add from the offset to the median
+        offset_x = rotated_first_point[0] - median_x
+        imaginary_points_count = max(0, int(np.floor(offset_x / grid_width + threshold_for_imaginary_points)))
+
+        imaginary_points = [
+            {
+                'point': rotate_point(
+                    [rotated_first_point[0] - (i + 1) * grid_width, rotated_first_point[1]], origin_angle
+                ),
+                'is_imaginary': True,
+            }
+            for i in reversed(range(imaginary_points_count))
+        ]
+        normalized_rows.append(imaginary_points + list(row))
+    return normalized_rows
+
+
+def filter_grid_edges(coordinates, threshold_multiplier):
+    """
+    Delaunay edges of the cores without the unusually long or short ones.
+    :param coordinates: (N, 2) normalized coordinates.
+    :return: (E, 2) edge index array.
+    """
+    edges = get_edges_from_coordinates(coordinates)
+    return filter_edges_by_length(edges, coordinates, threshold_multiplier)
+
+
+def estimate_rotation(coordinates, length_filtered_edges, params, workers=1):
+    """
+    Sweep the rotation angles for the edge set that best forms rows.
+    :return: (best edge set with isolated points added, origin angle).
+    """
+    best_edge_set, _, origin_angle = determine_image_rotation(
+        coordinates,
+        length_filtered_edges,
+        params['min_angle'],
+        params['max_angle'],
+        params['angle_step_size'],
+        params['angle_threshold'],
+        workers=workers,
+    )
+    if best_edge_set is None:
+        best_edge_set = sort_edges_and_add_isolated_points(np.empty((0, 2), dtype=np.intp), coordinates)
+    return best_edge_set, origin_angle
+
+
+def grid_params(coordinates, best_edge_set, origin_angle, params):
+    # Calculate the average distance and the image width
+    d = calculate_average_distance(best_edge_set, coordinates)
+    params = dict(params)
+    params['origin_angle'] = origin_angle
+    params['grid_width'] = d
+    params['image_width'] = calculate_grid_width(coordinates, d, params['multiplier'])
+    params['gamma'] = d
+    return params
+
+
+def load_data_and_determine_params(coordinates, params, workers=1):
+    """
+    Estimate the image rotation, the grid spacing and the image width from the
+    normalized core coordinates.
+    :param coordinates: (N, 2) normalized coordinates.
+    :param params: Hyperparameters, see DEFAULT_HYPERPARAMETERS.
+    :param workers: Worker processes for the rotation sweep.
+    :return: A copy of params with origin_angle, grid_width, image_width and gamma updated.
+    """
+    length_filtered_edges = filter_grid_edges(coordinates, params['threshold_multiplier'])
+    best_edge_set, origin_angle = estimate_rotation(coordinates, length_filtered_edges, params, workers)
+    return grid_params(coordinates, best_edge_set, origin_angle, params)
+
+
+def run_traveling_algorithm(coordinates, params, offset=(0, 0), length_filtered_edges=None):
+    """
+    Assign every core to a row and column.
+    :param coordinates: (N, 2) normalized coordinates.
+    :param params: Hyperparameters, usually from load_data_and_determine_params.
+    :param offset: (min_x, min_y) added back to the output coordinates.
+    :param length_filtered_edges: Output of filter_grid_edges, computed if not given.
+    :return: List of records in the format written by saveUpdatedCores.
+    """
+    if length_filtered_edges is None:
+        length_filtered_edges = filter_grid_edges(coordinates, params['threshold_multiplier'])
+    best_edge_set = filter_edges_by_angle(
+        length_filtered_edges, coordinates, params['threshold_angle'], params['origin_angle']
+    )
+    best_edge_set = limit_connections(best_edge_set, coordinates)
+    best_edge_set = sort_edges_and_add_isolated_points(best_edge_set, coordinates)
+
+    rows = traveling_algorithm(
+        coordinates[best_edge_set],
+        params['image_width'],
+        params['grid_width'],
+        params['gamma'],
+        params['search_angle'],
+        params['origin_angle'],
+        params['radius_multiplier'],
+    )
+    return rows_to_records(rows, params, offset)
+
+
+@profiled('rows', lambda records, *args, **kwargs: {
+    'records': len(records), 'imaginary': sum(record['isImaginary'] for record in records)})
+def rows_to_records(rows, params, offset=(0, 0)):
+    """
+    Order the traced rows, pad them with imaginary points and number the cores.
+    :param rows: Output of traveling_algorithm.
+    :return: List of records in the format written by saveUpdatedCores.
+    """
+    rows = [sort_row_by_rotated_x(row, params['origin_angle']) for row in rows]
+
+    sorted_rows = sort_rows_by_rotated_points(rows, params['origin_angle'])
+    median_x = calculate_median_x(sorted_rows, params['origin_angle'])
+    sorted_rows = normalize_rows_by_adding_imaginary_points(
+        sorted_rows, median_x, params['grid_width'], params['origin_angle']
+    )
+
+    sorted_data = []
+    for row_index, row in enumerate(sorted_rows):
+        for col_index, core in enumerate(row):
+            sorted_data.append({
+                'x': float(core['point'][0] + offset[0]),
+                'y': float(core['point'][1] + offset[1]),
+                'row': row_index,
+                'col': col_index,
+                'currentRadius': int(params['user_radius']),
+                'isImaginary': bool(core['is_imaginary']),
+                'annotations': '',
+            })
+    return sorted_data
@@ -0,0 +1,205 @@
+"""
+Pre-decoded training set stored as memory-mapped arrays.
+
+Images are decoded and resized once and written as uint8, masks are
+rasterized once and bit-packed along the width. Training code then reads
+batches lazily instead of holding every slide as float32 in memory.
+
+Layout of a cache directory:
+    images.npy   (N, H, W, 3) uint8
+    masks.npy    (N, H, ceil(W / 8)) uint8, bit-packed (or (N, H, W) uint8 with --no-pack)
+    index.json   {"names": [...], "size": [H, W], "packed": bool}
+
+Example:
+    python dataset_cache.py dataset_cache --source augmented_images augmented_labels \
+        --source TMA_WSI_Padded_PNGs TMA_WSI_Labels_updated --size 512 --workers 4
+"""
+import argparse
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import core_detection
+from label_io import find_label
+from masks import load_mask
+
+INDEX_FILE = 'index.json'
+IMAGES_FILE = 'images.npy'
+MASKS_FILE = 'masks.npy'
+
+
+def find_pairs(image_dir, label_dir):
+    """
+    Pair every PNG in image_dir with the labels of the same name in label_dir,
+    the binary file if there is one and the JSON otherwise.
+    :return: List of (name, image path, label path).
+    """
+    pairs = []
+    for filename in sorted(os.listdir(image_dir)):
+        name, extension = os.path.splitext(filename)
+        if extension.lower() == '.png':
+            pairs.append((name, os.path.join(image_dir, filename), find_label(label_dir, name)))
+    return pairs
+
+
+def slide_group(name):
+    # Augmented copies are named '<slide>_aug_<n>' and belong with their source slide
+    return name.split('_aug_')[0]
+
+
+def fold_of(name, num_folds):
+    """
+    Deterministic fold of a slide, the same across runs, machines and listings.
+    :param name: Slide name, e.g. '158867_aug_0'.
+    :param num_folds: Number of folds.
+    :return: Fold index in [0, num_folds).
+    """
+    return zlib.crc32(slide_group(name).encode()) % num_folds
+
+
+def split_folds(pairs, num_folds, fold):
+    """
+    Split (name, image path, label path) pairs into the training and
+    validation slides of one cross-validation fold. A slide and its augmented
+    copies always end up on the same side.
+    :return: (training pairs, validation pairs).
+    """
+    train, val = [], []
+    for pair in pairs:
+        (val if fold_of(pair[0], num_folds) == fold else train).append(pair)
+    return train, val
+
+
+def resize_image(image, size):
+    # Same resizing as load_img(target_size=...), which uses nearest neighbour
+    if image.shape[:2] == tuple(size):
+        return image
+    return np.asarray(Image.fromarray(image).resize((size[1], size[0]), Image.NEAREST))
+
+
+def _write_entry(cache_dir, index, image_path, label_path, size, packed):
+    image = resize_image(core_detection.load_image(image_path), size)
+    mask = load_mask(label_path, size, np.uint8)
+
+    images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode='r+')
+    masks = np.load(os.path.join(cache_dir, MASKS_FILE), mmap_mode='r+')
+    images[index] = image
+    masks[index] = np.packbits(mask, axis=-1) if packed else mask
+    images.flush()
+    masks.flush()
+
+
+def build_dataset_cache(pairs, cache_dir, size=(512, 512), packed=True, workers=1):
+    """
+    Decode and rasterize every (name, image path, label path) into cache_dir.
+    :param pairs: Output of find_pairs, possibly from several directories.
+    :param cache_dir: Directory the cache is written to.
+    :param size: (height, width) the images and masks are stored at.
+    :param packed: Whether to bit-pack the masks.
+    :param workers: Number of worker processes.
+    :return: DatasetCache opened on the new cache.
+    """
+    names = [name for name, _, _ in pairs]
+    if len(set(names)) != len(names):
+        raise ValueError("Slide names must be unique across all sources")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    height, width = size
+    mask_width = (width + 7) // 8 if packed else width
+    np.lib.format.open_memmap(os.path.join(cache_dir, IMAGES_FILE), 'w+', np.uint8, (len(pairs), height, width, 3))
+    np.lib.format.open_memmap(os.path.join(cache_dir, MASKS_FILE), 'w+', np.uint8, (len(pairs), height, mask_width))
+
+    jobs = [(cache_dir, i, image_path, label_path, size, packed) for i, (_, image_path, label_path) in enumerate(pairs)]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for future in [executor.submit(_write_entry, *job) for job in jobs]:
+                future.result()
+    else:
+        for job in jobs:
+            _write_entry(*job)
+
+    # The index is written last, so a cache without one is incomplete
+    with open(os.path.join(cache_dir, INDEX_FILE), 'w') as file:
+        json.dump({'names': names, 'size': list(size), 'packed': packed}, file)
+    return DatasetCache(cache_dir)
+
+
+class DatasetCache:
+    """
+    Read-only view of a cache written by build_dataset_cache. Nothing is
+    loaded until a batch is requested.
+    """
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, INDEX_FILE)) as file:
+            index = json.load(file)
+        self.names = index['names']
+        self.size = tuple(index['size'])
+        self.packed = index['packed']
+        self.indices = {name: i for i, name in enumerate(self.names)}
+        self.images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode='r')
+        self.masks = np.load(os.path.join(cache_dir, MASKS_FILE), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def index_of(self, names):
+        return np.array([self.indices[name] for name in names], dtype=np.intp)
+
+    def load(self, names):
+        """
+        Load slides by name, in the format of load_images_and_labels.
+        :param names: Slide names, e.g. '158867_aug_0'.
+        :return: ((N, H, W, 3) float32 images in [0, 1], (N, H, W, 1) float32 masks).
+        """
+        indices = self.index_of(names)
+
+        # Fancy indexing on a memmap is slow for unsorted indices, so read in order and restore the order after
+        order = np.argsort(indices)
+        restore = np.empty_like(order)
+        restore[order] = np.arange(len(order))
+        images = self.images[indices[order]][restore]
+        masks = self.masks[indices[order]][restore]
+
+        if self.packed:
+            masks = np.unpackbits(masks, axis=-1, count=self.size[1])
+        return images.astype(np.float32) / 255.0, masks[..., np.newaxis].astype(np.float32)
+
+    def batches(self, names, batch_size=32, shuffle=True, seed=None):
+        """
+        Yield (images, masks) batches of the given slides, e.g. for model.fit.
+        :param names: Slide names of the split.
+        :param batch_size: Number of slides per batch.
+        :param shuffle: Whether to shuffle the slides on every pass.
+        :param seed: Seed of the shuffle.
+        :return: Infinite generator of batches.
+        """
+        names = list(names)
+        rng = np.random.default_rng(seed)
+        while True:
+            order = rng.permutation(len(names)) if shuffle else np.arange(len(names))
+            for start in range(0, len(names), batch_size):
+                yield self.load([names[i] for i in order[start:start + batch_size]])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a memory-mapped training set cache.')
+    parser.add_argument('cache_dir', help='Directory the cache is written to')
+    parser.add_argument('--source', nargs=2, action='append', required=True, metavar=('IMAGE_DIR', 'LABEL_DIR'),
+                        help='Directory of PNGs and the directory of their JSON labels, can be repeated')
+    parser.add_argument('--size', type=int, default=512, help='Side length the slides are stored at')
+    parser.add_argument('--no-pack', action='store_true', help='Store masks as one byte per pixel')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    pairs = [pair for image_dir, label_dir in args.source for pair in find_pairs(image_dir, label_dir)]
+    cache = build_dataset_cache(pairs, args.cache_dir, (args.size, args.size), not args.no_pack, args.workers)
+    print(f"{len(cache)} slides written to {args.cache_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,500 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import Delaunay, KDTree
+
+from profiling import profiled
+
+
+def _filter_counts(kept, edges, *args, **kwargs):
+    return {'kept': len(kept), 'dropped': len(edges) - len(kept)}
+
+
+# Step 1: Preprocess the core data
+def preprocess_cores(cores, invert_y=True):
+    """
+    Preprocess the core data to normalize positions. By default the y-axis is
+    inverted so that the numbering starts from the top left corner, as in the
+    gridding notebooks; pass invert_y=False for the browser convention
+    (offset by the minimum x and y only).
+
+    :param cores: List of dictionaries with 'x', 'y' keys, or an (N, 2+) array.
+    :param invert_y: Whether to flip the y-axis.
+    :return: (N, 2) float array of normalized core coordinates.
+    """
+    if isinstance(cores, np.ndarray):
+        coordinates = np.asarray(cores[:, :2], dtype=np.float64)
+    else:
+        coordinates = np.array([(core['x'], core['y']) for core in cores], dtype=np.float64).reshape(-1, 2)
+    normalized = np.empty_like(coordinates)
+    normalized[:, 0] = coordinates[:, 0] - coordinates[:, 0].min()
+    if invert_y:
+        normalized[:, 1] = coordinates[:, 1].max() - coordinates[:, 1]
+    else:
+        normalized[:, 1] = coordinates[:, 1] - coordinates[:, 1].min()
+    return normalized
+
+
+# Step 2: Perform Delaunay triangulation and get all edges
+def get_all_edges_from_triangulation(triangulation):
+    """
+    Extract the unique undirected edges of a Delaunay triangulation.
+
+    Parameters:
+    triangulation (Delaunay or ndarray): The triangulation, or its (T, 3) simplices.
+
+    Returns:
+    ndarray: (E, 2) int array of edges with the smaller index first, sorted.
+    """
+    simplices = triangulation.simplices if isinstance(triangulation, Delaunay) else np.asarray(triangulation)
+    if len(simplices) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+    simplices = simplices.astype(np.intp, copy=False)
+    # Every triangle contributes the edges (0, 1), (1, 2) and (2, 0)
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+    edges.sort(axis=1)
+    # Encode each edge as a single integer so np.unique runs on a flat array
+    n = np.intp(simplices.max() + 1)
+    keys = np.unique(edges[:, 0] * n + edges[:, 1])
+    return np.stack([keys // n, keys % n], axis=1)
+
+
+@profiled('triangulation', lambda edges, coordinates: {'cores': len(coordinates), 'edges': len(edges)})
+def get_edges_from_coordinates(coordinates):
+    """
+    Triangulate the coordinates and return the unique Delaunay edges.
+    :param coordinates: (N, 2) array of core coordinates.
+    :return: (E, 2) int array of edges.
+    """
+    if len(coordinates) < 3:
+        return np.empty((0, 2), dtype=np.intp)
+    return get_all_edges_from_triangulation(Delaunay(coordinates))
+
+
+def calculate_edge_lengths(edges, coordinates):
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    delta = coordinates[edges[:, 1]] - coordinates[edges[:, 0]]
+    return np.hypot(delta[:, 0], delta[:, 1])
+
+
+def calculate_mad_bounds(edge_lengths, threshold_multiplier):
+    median = np.median(edge_lengths)
+    mad = np.median(np.abs(edge_lengths - median))
+    lower_bound = median - (threshold_multiplier * mad)
+    upper_bound = median + (threshold_multiplier * mad)
+    return lower_bound, upper_bound
+
+
+def order_edges_to_point_right(edges, coordinates):
+    edges = np.array(edges, dtype=np.intp).reshape(-1, 2)
+    swap = coordinates[edges[:, 0], 0] > coordinates[edges[:, 1], 0]
+    edges[swap] = edges[swap][:, ::-1]
+    return edges
+
+
+@profiled('length_filter', _filter_counts)
+def filter_edges_by_length(edges, coordinates, threshold_multiplier=1.5):
+    """
+    Drop edges longer than median + threshold_multiplier * MAD and orient the
+    remaining edges so that they point to the right.
+
+    Parameters:
+    edges (ndarray): (E, 2) edge indices.
+    coordinates (ndarray): (N, 2) coordinates.
+    threshold_multiplier (float): Multiplier for the median absolute deviation.
+
+    Returns:
+    ndarray: (E', 2) filtered edges with start x <= end x.
+    """
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    if len(edges) == 0:
+        return edges
+    edge_lengths = calculate_edge_lengths(edges, coordinates)
+    _, upper_bound = calculate_mad_bounds(edge_lengths, threshold_multiplier)
+    # We don't care about getting rid of the short edges, just the really long ones
+    return order_edges_to_point_right(edges[edge_lengths <= upper_bound], coordinates)
+
+
+def calculate_edge_angles(edges, coordinates):
+    """
+    Calculate the angle of every edge with respect to the x-axis.
+
+    Parameters:
+    edges (ndarray): (E, 2) edge indices.
+    coordinates (ndarray): (N, 2) coordinates.
+
+    Returns:
+    ndarray: (E,) angles in degrees, in [-180, 180].
+    """
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    delta = coordinates[edges[:, 1]] - coordinates[edges[:, 0]]
+    return np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))
+
+
+@profiled('angle_filter', _filter_counts)
+def filter_edges_by_angle(edges, coordinates, threshold_angle, origin_angle):
+    """
+    Filter edges based on their angle with respect to the x-axis.
+
+    Parameters:
+    edges (ndarray): (E, 2) edge indices.
+    coordinates (ndarray): (N, 2) coordinates.
+    threshold_angle (float): The +/- threshold angle from the origin angle.
+    origin_angle (float): The angle around which the threshold is calculated.
+
+    Returns:
+    ndarray: Filtered edges that fall within the specified angle range.
+    """
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    angles = calculate_edge_angles(edges, coordinates)
+    keep = (angles >= origin_angle - threshold_angle) & (angles <= origin_angle + threshold_angle)
+    return edges[keep]
+
+
+@profiled('limit_connections', _filter_counts)
+def limit_connections(edges, coordinates):
+    """
+    Limits each point's connections to at most one closest point in each direction based on the shortest distance.
+    Ensures that the connection is mutual and directional criteria are met.
+
+    Parameters:
+    edges (ndarray): (E, 2) edge indices.
+    coordinates (ndarray): (N, 2) coordinates.
+
+    Returns:
+    ndarray: (E', 2) mutual edges with the smaller index first, sorted.
+    """
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    if len(edges) == 0:
+        return edges
+    n_edges = len(edges)
+
+    # Step 1: Every edge is a connection seen from both of its end points
+    point = np.concatenate([edges[:, 0], edges[:, 1]])
+    other = np.concatenate([edges[:, 1], edges[:, 0]])
+    distance = np.tile(calculate_edge_lengths(edges, coordinates), 2)
+    order = np.tile(np.arange(n_edges), 2)
+
+    # Step 2: 0 = connected point is to the left, 1 = to the right; equal x is ignored
+    dx = coordinates[other, 0] - coordinates[point, 0]
+    valid = dx != 0
+    point, other, distance, order = point[valid], other[valid], distance[valid], order[valid]
+    direction = (dx[valid] > 0).astype(np.intp)
+
+    # Step 3: Keep the closest connection per (point, direction); ties go to the earlier edge
+    sort = np.lexsort((order, distance, direction, point))
+    group = point[sort] * 2 + direction[sort]
+    first = np.ones(len(sort), dtype=bool)
+    first[1:] = group[1:] != group[:-1]
+    best = np.full(2 * len(coordinates), -1, dtype=np.intp)
+    best[group[first]] = other[sort][first]
+
+    # Step 4: Confirm the directionality is mutual
+    right = best[1::2]
+    source = np.flatnonzero(right >= 0)
+    target = right[source]
+    mutual = best[2 * target] == source
+    final_edges = np.stack([source[mutual], target[mutual]], axis=1)
+    final_edges.sort(axis=1)
+    return final_edges[np.lexsort((final_edges[:, 1], final_edges[:, 0]))]
+
+
+def filter_edges(triangulation, normalized_coordinates, image_rotation, angle_threshold=10, threshold_multiplier=1.5):
+    """
+    Run the full edge filtering pipeline: Delaunay edges, length filter, angle
+    filter and connection limiting.
+    :param triangulation: Delaunay triangulation of the normalized coordinates.
+    :param normalized_coordinates: (N, 2) coordinates.
+    :param image_rotation: Origin angle of the rows, in degrees.
+    :param angle_threshold: The +/- threshold angle around the rotation.
+    :param threshold_multiplier: MAD multiplier for the length filter.
+    :return: (E, 2) edges to feed the traveling algorithm.
+    """
+    all_edges = get_all_edges_from_triangulation(triangulation)
+    length_filtered_edges = filter_edges_by_length(all_edges, normalized_coordinates, threshold_multiplier)
+    angle_filtered_edges = filter_edges_by_angle(
+        length_filtered_edges, normalized_coordinates, angle_threshold, image_rotation
+    )
+    return limit_connections(angle_filtered_edges, normalized_coordinates)
+
+
+
+def sort_edges_and_add_isolated_points(best_edge_set, normalized_coordinates):
+    """
+    Orient the edges to point right and append a self-referential (i, i) edge
+    for every point that is not part of any edge.
+    :param best_edge_set: (E, 2) edge indices.
+    :param normalized_coordinates: (N, 2) coordinates.
+    :return: (E + I, 2) edge indices.
+    """
+    sorted_edges = order_edges_to_point_right(best_edge_set, normalized_coordinates)
+    used = np.zeros(len(normalized_coordinates), dtype=bool)
+    used[sorted_edges.ravel()] = True
+    isolated_indices = np.flatnonzero(~used)
+    return np.concatenate([sorted_edges, np.stack([isolated_indices, isolated_indices], axis=1)])
+
+
+def _connected_edge_lengths(vectors):
+    # Number of points in each connected chain of edges
+    vectors = np.asarray(vectors, dtype=np.intp).reshape(-1, 2)
+    if len(vectors) == 0:
+        return np.empty(0, dtype=np.intp)
+    points, inverse = np.unique(vectors, return_inverse=True)
+    inverse = inverse.reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(inverse)), (inverse[:, 0], inverse[:, 1])), shape=(len(points), len(points)))
+    _, labels = connected_components(graph, directed=False)
+    return np.bincount(labels)
+
+
+def median_edge_length(vectors):
+    lengths = _connected_edge_lengths(vectors)
+    return float(np.median(lengths)) if len(lengths) else 0
+
+
+def average_edge_length(vectors):
+    lengths = _connected_edge_lengths(vectors)
+    return float(np.mean(lengths)) if len(lengths) else 0
+
+
+# Shared state for the rotation sweep worker processes
+_rotation_state = {}
+
+
+def _init_rotation_worker(normalized_coordinates, edges, score_function):
+    _rotation_state['coordinates'] = normalized_coordinates
+    _rotation_state['edges'] = edges
+    _rotation_state['score_function'] = score_function
+
+
+def _score_edge_subset(normalized_coordinates, edges, score_function):
+    edges_set = limit_connections(edges, normalized_coordinates)
+    edges_set = sort_edges_and_add_isolated_points(edges_set, normalized_coordinates)
+    return score_function(edges_set), edges_set
+
+
+def _score_windows(windows):
+    coordinates = _rotation_state['coordinates']
+    edges = _rotation_state['edges']
+    score_function = _rotation_state['score_function']
+    return [_score_edge_subset(coordinates, edges[np.sort(window)], score_function)[0] for window in windows]
+
+
+@profiled('rotation_sweep', lambda result, *args, **kwargs: {
+    'edges': 0 if result[0] is None else len(result[0]), 'angle': result[2]})
+def determine_image_rotation(normalized_coordinates, length_filtered_edges, min_angle, max_angle, angle_step_size,
+                             angle_threshold, refine_step_sizes=(), workers=1, score_function=median_edge_length):
+    """
+    Sweep the origin angle from min_angle to max_angle and keep the angle whose
+    filtered, connection-limited edge set forms the longest chains.
+
+    Edge angles are computed once and sorted, so each candidate's edge set is a
+    slice of the sorted edges found with np.searchsorted. Candidates that select
+    the same slice are only scored once, and the distinct slices can be scored
+    in a process pool. Each entry of refine_step_sizes re-sweeps one previous
+    step on either side of the best angle with the finer step.
+
+    Parameters:
+    normalized_coordinates (ndarray): (N, 2) coordinates.
+    length_filtered_edges (ndarray): (E, 2) output of filter_edges_by_length.
+    min_angle (float): First candidate angle, in degrees.
+    max_angle (float): Sweep end (exclusive), in degrees.
+    angle_step_size (float): Coarse step between candidate angles.
+    angle_threshold (float): The +/- threshold angle around each candidate.
+    refine_step_sizes (sequence): Finer steps for coarse-to-fine refinement.
+    workers (int): Number of worker processes; 1 scores in-process.
+    score_function (callable): Edge set score, median_edge_length by default.
+
+    Returns:
+    tuple: (best_edge_set, best_edge_set_length, optimal_angle)
+    """
+    normalized_coordinates = np.asarray(normalized_coordinates, dtype=np.float64)
+    edges = np.asarray(length_filtered_edges, dtype=np.intp).reshape(-1, 2)
+    angles = calculate_edge_angles(edges, normalized_coordinates)
+    order = np.argsort(angles, kind='stable')
+    sorted_angles = angles[order]
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_rotation_worker,
+            initargs=(normalized_coordinates, edges, score_function),
+        )
+    else:
+        _init_rotation_worker(normalized_coordinates, edges, score_function)
+
+    scores = {}
+
+    def sweep(candidates):
+        lower = np.searchsorted(sorted_angles, candidates - angle_threshold, side='left')
+        upper = np.searchsorted(sorted_angles, candidates + angle_threshold, side='right')
+        windows = [(lo, hi) for lo, hi in zip(lower.tolist(), upper.tolist()) if (lo, hi) not in scores]
+        windows = list(dict.fromkeys(windows))
+        if pool is not None and len(windows) > 1:
+            chunks = [windows[i::workers] for i in range(workers)]
+            results = pool.map(_score_windows, [[order[lo:hi] for lo, hi in chunk] for chunk in chunks])
+            for chunk, chunk_scores in zip(chunks, results):
+                scores.update(zip(chunk, chunk_scores))
+        else:
+            scores.update(zip(windows, _score_windows([order[lo:hi] for lo, hi in windows])))
+        return [(scores[window], angle) for window, angle in zip(zip(lower.tolist(), upper.tolist()), candidates)]
+
+    def best_of(results, best):
+        for score, angle in results:
+            if score > best[0]:
+                best = (score, float(angle))
+        return best
+
+    try:
+        best = best_of(sweep(np.arange(min_angle, max_angle, angle_step_size)), (0, min_angle))
+        previous_step = angle_step_size
+        for step in refine_step_sizes:
+            low = max(min_angle, best[1] - previous_step)
+            high = min(max_angle, best[1] + previous_step)
+            best = best_of(sweep(np.arange(low, high, step)), best)
+            previous_step = step
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    best_edge_set_length, optimal_angle = best
+    best_edge_set = None
+    if best_edge_set_length > 0:
+        window = filter_edges_by_angle(edges, normalized_coordinates, angle_threshold, optimal_angle)
+        _, best_edge_set = _score_edge_subset(normalized_coordinates, window, score_function)
+    return best_edge_set, best_edge_set_length, optimal_angle
+
+
+# Helper function to check if point is within the image width threshold
+def is_close_to_image_width(point, image_width, gamma):
+    return abs(point[0] - image_width) < gamma
+
+
+@profiled('traveling', lambda rows, S, *args, **kwargs: {'segments': len(S), 'rows': len(rows)})
+def traveling_algorithm(S, image_width, d, gamma, phi=180, origin_angle=0, radius_multiplier=0.5,
+                        max_imaginary_points=50):
+    """
+    Trace rows of cores by following the segments end to start, falling back to
+    a radius search around the current end point and finally to imaginary
+    points spaced d apart along origin_angle, until the row reaches the image
+    width.
+
+    Segment start points are indexed in a KDTree and picked segments are only
+    marked as deleted, so each step costs a tree query instead of a scan of the
+    remaining segments. The rows are identical to the notebook implementation.
+
+    Parameters:
+    S (list or ndarray): Segments as (start, end) coordinate pairs, shape (E, 2, 2).
+    image_width (float): x-coordinate at which a row is considered complete.
+    d (float): Core-to-core distance.
+    gamma (float): Tolerance around the image width.
+    phi (float): Sector angle; the sector search only accepts full circles (360).
+    origin_angle (float): Direction of the rows, in degrees.
+    radius_multiplier (float): Sector search radius as a multiple of d.
+    max_imaginary_points (int): Consecutive imaginary points allowed before
+        the parameters are considered invalid.
+
+    Returns:
+    list: Rows, each a list of dicts with 'point', 'index' and 'is_imaginary' keys.
+    """
+    segments = np.asarray(S, dtype=np.float64).reshape(-1, 2, 2)
+    starts = segments[:, 0]
+    ends = segments[:, 1]
+    n_segments = len(segments)
+    if n_segments == 0:
+        return []
+
+    A = []  # Final list of rows of centroids
+    r = radius_multiplier * d  # Radius for sector search
+    imaginary_points_index = -1  # Start an index for imaginary points
+    delta_rad = np.radians(origin_angle)
+    step = np.array([d * np.cos(delta_rad), d * np.sin(delta_rad)])
+
+    tree = KDTree(starts)
+    alive = np.ones(n_segments, dtype=bool)
+    remaining = n_segments
+    # Segments ordered by start x (then index) so the next row start is found by skipping deleted entries
+    by_start_x = np.lexsort((np.arange(n_segments), starts[:, 0]))
+    cursor = 0
+
+    def find_next_vector(Vj):
+        # Superset query in the max-norm, then the exact np.allclose(start, Vj, atol=1e-3) test
+        tolerance = 1e-3 + 1e-5 * np.abs(Vj)
+        candidates = tree.query_ball_point(Vj, tolerance.max() * (1 + 1e-9), p=np.inf)
+        best = None
+        for i in candidates:
+            if alive[i] and (best is None or i < best) and np.all(np.abs(starts[i] - Vj) <= tolerance):
+                best = i
+        return best
+
+    def find_candidate_in_sector(Vj):
+        # point_in_sector only accepts points for a full circle
+        if phi != 360:
+            return None
+        best, best_distance = None, None
+        for i in sorted(tree.query_ball_point(Vj, r * (1 + 1e-9) + 1e-9)):
+            if not alive[i]:
+                continue
+            if np.sqrt((starts[i][0] - Vj[0]) ** 2 + (starts[i][1] - Vj[1]) ** 2) > r:
+                continue
+            distance = np.sqrt((ends[i][0] - Vj[0]) ** 2 + (ends[i][1] - Vj[1]) ** 2)
+            if best is None or distance < best_distance:
+                best, best_distance = i, distance
+        return best
+
+    def make_vector(i):
+        return {'start': starts[i], 'end': ends[i], 'index': i, 'is_imaginary': False}
+
+    while remaining:
+        # Find the start vector with the smallest x-coordinate in the first point of the vector
+        while not alive[by_start_x[cursor]]:
+            cursor += 1
+        start_index = by_start_x[cursor]
+        alive[start_index] = False
+        remaining -= 1
+        A1 = [make_vector(start_index)]
+        Vj = ends[start_index]
+
+        # Iterative Traveling
+        first_imaginary = True
+        consecutive_imaginary = 0
+        while True:
+            next_index = find_next_vector(Vj)
+            if next_index is None and not is_close_to_image_width(Vj, image_width, gamma):
+                next_index = find_candidate_in_sector(Vj)
+
+            if next_index is not None:
+                A1.append(make_vector(next_index))
+                Vj = ends[next_index]
+                alive[next_index] = False
+                remaining -= 1
+                first_imaginary = True
+                consecutive_imaginary = 0
+            elif not is_close_to_image_width(Vj, image_width, gamma):
+                # Add an imaginary point along the origin angle. The first one starts at the last
+                # real point in the row, so it is not marked as imaginary.
+                Vj_prime = Vj + step
+                A1.append({'start': Vj, 'end': Vj_prime, 'index': imaginary_points_index,
+                           'is_imaginary': not first_imaginary})
+                first_imaginary = False
+                imaginary_points_index -= 1  # Decrement to keep imaginary indices unique and negative
+                Vj = Vj_prime
+                consecutive_imaginary += 1
+                if consecutive_imaginary > max_imaginary_points:
+                    raise ValueError("Invalid parameters: too many consecutive imaginary points.")
+            else:
+                # Remove duplicate points, keeping the first occurrence
+                seen_points = set()
+                unique_row = []
+                for vec in A1:
+                    point = tuple(vec['start'])
+                    if point not in seen_points:
+                        seen_points.add(point)
+                        unique_row.append({'point': vec['start'], 'index': vec['index'],
+                                           'is_imaginary': vec['is_imaginary']})
+                A.append(unique_row)
+                break
+
+    return A
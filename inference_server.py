@@ -0,0 +1,284 @@
+"""
+CPU inference service for the core segmentation model.
+
+The U-Net is exported once to TFLite or ONNX, loaded into a CPU runtime that
+stays warm for the lifetime of the process, and served over a local HTTP
+endpoint. Concurrent requests are grouped into batches by a background thread.
+
+Export the shipped TensorFlow.js model and start the server:
+    python inference_server.py export tfjs_model/model.json core_segmentation.tflite
+    python inference_server.py serve core_segmentation.tflite --port 8000
+
+Then POST an image:
+    curl --data-binary @TMA_WSI_Padded_PNGs/158867.png "localhost:8000/predict?output=centroids"
+"""
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+import core_detection
+
+# Largest request body read, slides are a few megabytes as PNG
+DEFAULT_MAX_BODY_BYTES = 32 << 20
+
+
+def export_model(model_path, output_path):
+    """
+    Convert the Keras/TensorFlow.js model to a CPU runtime format, chosen from
+    the output extension (.tflite or .onnx). Needs the export extra.
+    :param model_path: Path accepted by core_detection.load_model.
+    :param output_path: Destination file.
+    """
+    model = core_detection.load_model(model_path)
+    if output_path.endswith('.onnx'):
+        import tensorflow as tf
+        import tf2onnx
+
+        size = core_detection.MODEL_INPUT_SIZE
+        signature = [tf.TensorSpec((None, size, size, 3), tf.float32, name='input')]
+        tf2onnx.convert.from_keras(model, input_signature=signature, output_path=output_path)
+    elif output_path.endswith('.tflite'):
+        import tensorflow as tf
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        with open(output_path, 'wb') as file:
+            file.write(converter.convert())
+    else:
+        raise ValueError(f"Unknown model format for {output_path}, expected .tflite or .onnx")
+
+
+class OnnxSegmenter:
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class TFLiteSegmenter:
+    def __init__(self, model_path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def predict(self, batch):
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+
+def load_segmenter(model_path, num_threads=None):
+    if model_path.endswith('.onnx'):
+        return OnnxSegmenter(model_path, num_threads)
+    if model_path.endswith('.tflite'):
+        return TFLiteSegmenter(model_path, num_threads)
+    raise ValueError(f"Unknown model format for {model_path}, expected .tflite or .onnx")
+
+
+class DynamicBatcher:
+    """
+    Collects single-image requests from many threads and runs them through the
+    segmenter in batches of up to max_batch_size, waiting at most max_wait_ms
+    for a batch to fill up.
+    """
+
+    def __init__(self, segmenter, max_batch_size=8, max_wait_ms=10):
+        self.segmenter = segmenter
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tensor):
+        """
+        Queue a (H, W, 3) float32 model input.
+        :return: Future resolving to the (H, W) probability mask.
+        """
+        future = Future()
+        self.requests.put((tensor, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            tensors, futures = zip(*batch)
+            try:
+                predictions = self.segmenter.predict(np.stack(tensors))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            for future, prediction in zip(futures, predictions):
+                future.set_result(np.asarray(prediction, dtype=np.float32).reshape(prediction.shape[:2]))
+
+
+def _parse_query(query):
+    """
+    Read the /predict query parameters, raising ValueError for unknown or out of range values.
+    :return: (output, keyword arguments of core_detection.segment_predictions).
+    """
+    query = {key: values[-1] for key, values in parse_qs(query).items()}
+    output = query.get('output', 'mask')
+    if output not in ('mask', 'centroids'):
+        raise ValueError(f"output must be 'mask' or 'centroids', got {output!r}")
+    parameters = {
+        'threshold': float(query.get('threshold', 0.5)),
+        'min_area': int(query.get('min_area', 0)),
+        'max_area': int(query.get('max_area', 2000)),
+        'dis_transform_multiplier': float(query.get('dis_transform_multiplier', 0.625)),
+    }
+    if not 0 <= parameters['threshold'] <= 1:
+        raise ValueError(f"threshold must be between 0 and 1, got {parameters['threshold']}")
+    if not 0 <= parameters['min_area'] <= parameters['max_area']:
+        raise ValueError("min_area and max_area must satisfy 0 <= min_area <= max_area")
+    if not parameters['dis_transform_multiplier'] > 0:
+        raise ValueError("dis_transform_multiplier must be positive")
+    return output, parameters
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    batcher = None
+    max_body_bytes = DEFAULT_MAX_BODY_BYTES
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._send(200, 'application/json', b'{"status": "ok"}')
+        else:
+            self._send(404, 'application/json', b'{"error": "not found"}')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._send(404, 'application/json', b'{"error": "not found"}')
+            return
+
+        # Step 1: Bad parameters and unreadable images are the client's fault, oversized bodies are never read
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(f"invalid Content-Length {length}")
+        except ValueError as error:
+            self._send(400, 'application/json', json.dumps({'error': str(error)}).encode())
+            return
+        if length > self.max_body_bytes:
+            error = f"request body of {length} bytes exceeds the limit of {self.max_body_bytes}"
+            self._send(413, 'application/json', json.dumps({'error': error}).encode())
+            return
+        try:
+            output, parameters = _parse_query(url.query)
+            body = self.rfile.read(length)
+            with Image.open(io.BytesIO(body)) as image:
+                image = np.asarray(image.convert('RGB'))
+            tensor = core_detection.preprocess_image(image)[0]
+        except Exception as error:
+            self._send(400, 'application/json', json.dumps({'error': str(error)}).encode())
+            return
+
+        # Step 2: Failures of the batcher, the model or the segmentation are the server's
+        try:
+            predictions = self.batcher.submit(tensor).result()
+            if output == 'centroids':
+                cores = core_detection.segment_predictions(predictions, **parameters)
+                content_type, response = 'application/json', json.dumps(cores).encode()
+            else:
+                buffer = io.BytesIO()
+                Image.fromarray(np.round(predictions * 255).astype(np.uint8)).save(buffer, format='PNG')
+                content_type, response = 'image/png', buffer.getvalue()
+        except Exception as error:
+            self._send(500, 'application/json', json.dumps({'error': str(error)}).encode())
+            return
+        self._send(200, content_type, response)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(model_path, host='127.0.0.1', port=8000, max_batch_size=8, max_wait_ms=10, num_threads=None,
+          max_body_bytes=DEFAULT_MAX_BODY_BYTES):
+    segmenter = load_segmenter(model_path, num_threads)
+
+    # Warm up the runtime so the first request does not pay for allocation
+    size = core_detection.MODEL_INPUT_SIZE
+    segmenter.predict(np.zeros((1, size, size, 3), dtype=np.float32))
+
+    InferenceRequestHandler.batcher = DynamicBatcher(segmenter, max_batch_size, max_wait_ms)
+    InferenceRequestHandler.max_body_bytes = max_body_bytes
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    print(f"Serving {model_path} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Core segmentation inference server.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='Convert the model to .tflite or .onnx')
+    export.add_argument('model', help='tfjs model.json or Keras .hdf5')
+    export.add_argument('output', help='Destination .tflite or .onnx file')
+
+    server = commands.add_parser('serve', help='Serve an exported model over HTTP')
+    server.add_argument('model', help='Exported .tflite or .onnx model')
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=8000)
+    server.add_argument('--max-batch-size', type=int, default=8)
+    server.add_argument('--max-wait-ms', type=float, default=10)
+    server.add_argument('--threads', type=int, help='CPU threads used by the runtime')
+    server.add_argument('--max-body-mb', type=float, default=DEFAULT_MAX_BODY_BYTES / (1 << 20),
+                        help='Requests with larger bodies are rejected with 413')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        export_model(args.model, args.output)
+    else:
+        serve(args.model, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.threads,
+              int(args.max_body_mb * (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
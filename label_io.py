@@ -0,0 +1,285 @@
+"""
+Core label files: the legacy JSON lists and a packed binary format.
+
+The legacy format is an indented JSON list of {x, y, radius} dictionaries
+per slide. It is read incrementally, one object at a time, so even label
+files of millions of cores never have to be held as Python objects. The
+binary format stores the same cores as one little-endian float32 (N, 3)
+array of x, y and radius behind a short header with JSON metadata. It loads
+with a single read, or as a memory map. Every reader accepts both formats,
+and whole directories can be converted at once.
+
+Layout of a .cores file:
+    b'TMACORES'      magic
+    uint32           format version
+    uint32           length of the metadata in bytes
+    uint64           number of cores N
+    metadata         UTF-8 JSON object, padded with spaces to a multiple of 16 bytes
+    float32 (N, 3)   x, y, radius
+
+Example:
+    python label_io.py augmented_labels --workers 4
+    cores = load_cores(find_label('augmented_labels', '158867_aug_0'))   # (N, 3) float32
+"""
+import argparse
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+MAGIC = b'TMACORES'
+VERSION = 1
+BINARY_EXTENSION = '.cores'
+JSON_EXTENSION = '.json'
+FIELDS = ('x', 'y', 'radius')
+
+_HEADER = struct.Struct('<8sIIQ')
+_ALIGNMENT = 16
+_DTYPE = np.dtype('<f4')
+
+
+def _data_offset(metadata_length):
+    return -(-(_HEADER.size + metadata_length) // _ALIGNMENT) * _ALIGNMENT
+
+
+def _as_array(cores):
+    # (N, 3) x, y, radius from an array or from {x, y, radius} dictionaries
+    if isinstance(cores, np.ndarray):
+        return cores.reshape(-1, 3)
+    return np.array([(core['x'], core['y'], core['radius']) for core in cores], dtype=np.float64).reshape(-1, 3)
+
+
+def write_cores(path, cores, metadata=None):
+    """
+    Write cores in the binary format.
+    :param path: Output path, usually ending in .cores.
+    :param cores: (N, 3) array of x, y, radius, or a list of {x, y, radius} dictionaries.
+    :param metadata: JSON-serializable dictionary stored with the cores, e.g. the original image size.
+    """
+    data = np.ascontiguousarray(_as_array(cores), dtype=_DTYPE)
+    encoded = json.dumps(dict(metadata or {}, fields=list(FIELDS))).encode()
+    encoded += b' ' * (_data_offset(len(encoded)) - _HEADER.size - len(encoded))
+
+    # Written under a temporary name, so readers never see a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, len(encoded), len(data)))
+        file.write(encoded)
+        file.write(data.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _read_header(file, path):
+    magic, version, metadata_length, count = _HEADER.unpack(file.read(_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a core label file")
+    if version > VERSION:
+        raise ValueError(f"{path} has format version {version}, only up to {VERSION} is supported")
+    metadata = json.loads(file.read(metadata_length))
+    return count, metadata, _HEADER.size + metadata_length
+
+
+def read_header(path):
+    """
+    Metadata of a binary file.
+    :return: (number of cores, metadata dictionary, byte offset of the data).
+    """
+    with open(path, 'rb') as file:
+        return _read_header(file, path)
+
+
+def read_cores(path, mmap=False):
+    """
+    Read a binary file.
+    :param mmap: Whether to memory-map the cores instead of reading them.
+    :return: ((N, 3) float32 x, y, radius, metadata dictionary).
+    """
+    with open(path, 'rb') as file:
+        count, metadata, offset = _read_header(file, path)
+        if not mmap or count == 0:
+            # The file is positioned at the data right after the metadata
+            return np.fromfile(file, dtype=_DTYPE, count=3 * count).reshape(count, 3), metadata
+    return np.memmap(path, dtype=_DTYPE, mode='r', offset=offset, shape=(count, 3)), metadata
+
+
+def iter_json_cores(path, chunk_size=1 << 16):
+    """
+    Read a legacy JSON list one object at a time.
+    :param chunk_size: Characters read from the file at once.
+    :return: Generator of the label dictionaries. A ValueError is raised when the file is not a single JSON list,
+        e.g. when it is empty or truncated.
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as file:
+        # expected is what may come next: '[', a value or ']' right after '[', ',' or ']' after a value, a value
+        # after ',', and nothing after ']'
+        buffer, position, expected, eof = '', 0, 'open', False
+        while True:
+            # Skip whitespace, reading more text as needed
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                buffer, position = file.read(chunk_size), 0
+                eof = not buffer
+
+            if position >= len(buffer):
+                if expected == 'end':
+                    return
+                raise ValueError(f"{path} is empty" if expected == 'open' else
+                                 f"{path} ends before the JSON list is closed")
+            char = buffer[position]
+            if expected == 'end':
+                raise ValueError(f"{path} has text after the end of the JSON list")
+            if expected == 'open':
+                if char != '[':
+                    raise ValueError(f"{path} is not a JSON list")
+                expected, position = 'first', position + 1
+                continue
+            if char == ']' and expected in ('first', 'separator'):
+                expected, position = 'end', position + 1
+                continue
+            if expected == 'separator':
+                if char != ',':
+                    raise ValueError(f"{path} has list elements without a comma between them")
+                expected, position = 'value', position + 1
+                continue
+            if char in ',]':
+                raise ValueError(f"{path} has a comma without a list element after it"
+                                 if expected == 'value' else f"{path} has a comma before the first list element")
+
+            try:
+                core, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The object continues in the next chunk
+                if eof:
+                    raise
+                more = file.read(chunk_size)
+                eof = not more
+                buffer, position = buffer[position:] + more, 0
+                continue
+            yield core
+            expected, position = 'separator', end
+
+
+def read_json_cores(path, dtype=np.float64):
+    """
+    Read a legacy JSON list into an (N, 3) array of x, y, radius.
+    """
+    values = np.fromiter(
+        (value for core in iter_json_cores(path) for value in (core['x'], core['y'], core['radius'])),
+        dtype=np.float64,
+    )
+    return values.reshape(-1, 3).astype(dtype, copy=False)
+
+
+def is_binary(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def load_cores(path, dtype=np.float32, mmap=False):
+    """
+    Read the cores of a label file in either format.
+    :param dtype: dtype of the result. JSON values are parsed as float64 first, so float64 keeps them exact.
+    :param mmap: Memory-map binary files, only used when dtype is float32.
+    :return: (N, 3) array of x, y, radius.
+    """
+    if is_binary(path):
+        data, _ = read_cores(path, mmap and np.dtype(dtype) == _DTYPE)
+        return data if np.dtype(dtype) == _DTYPE else data.astype(dtype)
+    return read_json_cores(path, dtype)
+
+
+def load_labels(path):
+    """
+    Read a label file in either format as a list of {x, y, radius} dictionaries, like json.load on the legacy
+    files.
+    """
+    if not is_binary(path):
+        return [{key: core[key] for key in FIELDS} for core in iter_json_cores(path)]
+    data, _ = read_cores(path)
+    return [dict(zip(FIELDS, core)) for core in data.astype(np.float64).tolist()]
+
+
+def find_label(label_dir, name):
+    """
+    Path of a slide's labels: the binary file if there is one at least as new
+    as the JSON, and the JSON otherwise.
+    """
+    binary_path = os.path.join(label_dir, name + BINARY_EXTENSION)
+    json_path = os.path.join(label_dir, name + JSON_EXTENSION)
+    try:
+        binary_mtime = os.path.getmtime(binary_path)
+    except OSError:
+        return json_path
+    try:
+        if os.path.getmtime(json_path) > binary_mtime:
+            return json_path
+    except OSError:
+        pass
+    return binary_path
+
+
+def _convert(json_path, binary_path, metadata):
+    cores = read_json_cores(json_path)
+    write_cores(binary_path, cores, dict(metadata, source=os.path.basename(json_path)))
+    return len(cores)
+
+
+def convert_directory(input_dir, output_dir=None, metadata=None, overwrite=False, workers=1):
+    """
+    Convert every JSON label file in input_dir to the binary format.
+    :param output_dir: Directory of the .cores files, input_dir by default.
+    :param metadata: Metadata stored in every file, e.g. {'original_size': [1024, 1024]}.
+    :param overwrite: Convert files whose binary version is newer than the JSON as well.
+    :param workers: Number of worker processes.
+    :return: Number of files converted.
+    """
+    output_dir = output_dir or input_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = []
+    for filename in sorted(os.listdir(input_dir)):
+        name, extension = os.path.splitext(filename)
+        if extension.lower() != JSON_EXTENSION:
+            continue
+        json_path = os.path.join(input_dir, filename)
+        binary_path = os.path.join(output_dir, name + BINARY_EXTENSION)
+        # Skip files converted since the JSON last changed
+        if not overwrite and os.path.exists(binary_path) and \
+                os.path.getmtime(binary_path) >= os.path.getmtime(json_path):
+            continue
+        jobs.append((json_path, binary_path, metadata or {}))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for future in [executor.submit(_convert, *job) for job in jobs]:
+                future.result()
+    else:
+        for job in jobs:
+            _convert(*job)
+    return len(jobs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert JSON core labels to the packed binary format.')
+    parser.add_argument('input_dirs', nargs='+', help='Directories of {x, y, radius} JSON files')
+    parser.add_argument('--output-dir', help='Where the .cores files are written, next to the JSON by default')
+    parser.add_argument('--original-size', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+                        help='Size of the images the labels were drawn on, stored as metadata')
+    parser.add_argument('--overwrite', action='store_true', help='Also convert files that are up to date')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    metadata = {'original_size': args.original_size} if args.original_size else {}
+    for input_dir in args.input_dirs:
+        count = convert_directory(input_dir, args.output_dir, metadata, args.overwrite, args.workers)
+        print(f"{input_dir}: {count} files converted")
+
+
+if __name__ == '__main__':
+    main()
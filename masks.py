@@ -0,0 +1,143 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from label_io import load_cores
+
+# Size of the padded slides the labels were drawn on
+ORIGINAL_SIZE = (1024, 1024)
+
+# Upper bound on the number of bounding box pixels tested at once
+MAX_CHUNK_PIXELS = 1 << 22
+
+
+def rasterize_disks(x, y, radius, shape, dtype=np.float32):
+    """
+    Draw filled disks into a mask, pixel for pixel the same as calling
+    skimage.draw.disk((y, x), radius, shape=shape) for every disk.
+
+    Every disk is tested against its own bounding box, and the boxes of all
+    disks are stacked into one (N, B, B) array, so a slide is drawn with a few
+    array operations instead of one call per core.
+    :param x: (N,) column coordinates of the centres.
+    :param y: (N,) row coordinates of the centres.
+    :param radius: (N,) radii.
+    :param shape: (height, width) of the mask.
+    :param dtype: Mask dtype, e.g. np.float32, np.uint8 or bool.
+    :return: Mask with 1 inside the disks and 0 elsewhere.
+    """
+    mask = np.zeros(shape, dtype=dtype)
+
+    # Stamping every box is cheaper than scattering the pixel coordinates
+    for row, col, stamp in disk_stamps(x, y, radius, shape):
+        mask[row:row + stamp.shape[0], col:col + stamp.shape[1]][stamp] = 1
+    return mask
+
+
+def disk_stamps(x, y, radius, shape):
+    """
+    Rasterize every disk inside its own bounding box, see rasterize_disks.
+    :return: List of (top, left, (h, w) bool stamp), one per disk. Disks
+        without pixels in the mask get an empty stamp.
+    """
+    center = np.stack([np.asarray(y, dtype=np.float64), np.asarray(x, dtype=np.float64)], axis=1).reshape(-1, 2)
+    radius = np.asarray(radius, dtype=np.float64).reshape(-1)
+    stamps = [(0, 0, np.zeros((0, 0), dtype=bool))] * len(center)
+    if len(center) == 0:
+        return stamps
+
+    # Step 1: Bounding boxes, clipped to the mask like skimage.draw.ellipse
+    upper_left = np.maximum(np.ceil(center - radius[:, np.newaxis]).astype(int), 0)
+    lower_right = np.minimum(np.floor(center + radius[:, np.newaxis]).astype(int), np.array(shape[:2]) - 1)
+    box_size = lower_right - upper_left + 1
+    shifted_center = center - upper_left
+
+    keep = np.flatnonzero((box_size > 0).all(axis=1))
+    upper_left, box_size, shifted_center, radius = upper_left[keep], box_size[keep], shifted_center[keep], radius[keep]
+    if len(radius) == 0:
+        return stamps
+
+    # Step 2: Test the boxes in chunks of disks with stacked distance computations
+    side = int(box_size.max())
+    offsets = np.arange(side, dtype=np.float64)
+    chunk = max(1, MAX_CHUNK_PIXELS // (side * side))
+    for start in range(0, len(radius), chunk):
+        end = start + chunk
+        rad = radius[start:end, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = ((offsets - shifted_center[start:end, 0:1]) / rad) ** 2
+            c = ((offsets - shifted_center[start:end, 1:2]) / rad) ** 2
+        inside = r[:, :, np.newaxis] + c[:, np.newaxis, :] < 1
+
+        for index, (row, col), (height, width), stamp in zip(
+            keep[start:end].tolist(), upper_left[start:end].tolist(), box_size[start:end].tolist(), inside
+        ):
+            stamps[index] = (row, col, stamp[:height, :width])
+    return stamps
+
+
+def create_mask_from_json(json_data, shape, dtype=np.float32, original_size=None):
+    """
+    Rasterize {x, y, radius} labels into a mask.
+    :param json_data: List of label dictionaries.
+    :param shape: (height, width) of the mask.
+    :param dtype: Mask dtype.
+    :param original_size: Size the labels were drawn on; if given they are rescaled to shape as resize_labels does.
+    :return: Mask with 1 inside the cores.
+    """
+    x = np.array([item['x'] for item in json_data], dtype=np.float64)
+    y = np.array([item['y'] for item in json_data], dtype=np.float64)
+    radius = np.array([item['radius'] for item in json_data], dtype=np.float64)
+    return _create_mask(x, y, radius, shape, dtype, original_size)
+
+
+def _create_mask(x, y, radius, shape, dtype, original_size):
+    if original_size is not None:
+        scale_x = shape[1] / original_size[1]
+        scale_y = shape[0] / original_size[0]
+        x, y, radius = x * scale_x, y * scale_y, radius * scale_x
+    return rasterize_disks(x, y, radius, shape, dtype)
+
+
+def resize_labels(labels, original_size, new_size):
+    scale_x = new_size[1] / original_size[1]
+    scale_y = new_size[0] / original_size[0]
+    return [
+        {
+            'x': label['x'] * scale_x,
+            'y': label['y'] * scale_y,
+            'radius': label['radius'] * scale_x,  # Assuming uniform scaling in x and y
+        }
+        for label in labels
+    ]
+
+
+def load_mask(label_path, shape, dtype=np.float32, original_size=ORIGINAL_SIZE):
+    """
+    Rasterize a {x, y, radius} label file at the given size.
+    :param label_path: Path to the JSON or binary labels, drawn on an original_size image.
+    :param shape: (height, width) of the mask.
+    :param dtype: Mask dtype.
+    :return: (height, width) mask.
+    """
+    x, y, radius = load_cores(label_path, np.float64).T
+    return _create_mask(x, y, radius, shape, dtype, original_size)
+
+
+def load_masks(label_paths, shape, dtype=np.uint8, original_size=ORIGINAL_SIZE, workers=1):
+    """
+    Rasterize many label files, optionally in parallel.
+    :param label_paths: Paths to the JSON or binary labels.
+    :param workers: Number of worker processes.
+    :return: (N, height, width) masks.
+    """
+    masks = np.zeros((len(label_paths),) + tuple(shape), dtype=dtype)
+    args = ([shape] * len(label_paths), [dtype] * len(label_paths), [original_size] * len(label_paths))
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for i, mask in enumerate(executor.map(load_mask, label_paths, *args, chunksize=8)):
+                masks[i] = mask
+    else:
+        for i, mask in enumerate(map(load_mask, label_paths, *args)):
+            masks[i] = mask
+    return masks
@@ -0,0 +1,277 @@
+"""
+Parallel padding, cropping and tiling of slides together with their labels.
+
+Does what pad_and_crop_image_and_update_labels in padImages.ipynb does, over
+a process pool: every image is cropped to the top left of a canvas of the
+target size and padded with white, and cores whose centre falls outside are
+dropped from its labels. With a tile size, the canvas (or the whole image if
+no target size is given) is cut into tiles of a fixed stride, and every tile
+gets its own image and labels.
+
+A manifest in the output image directory records the inputs and settings
+every output was made from. Slides whose image and labels are unchanged,
+judged by modification time and size or by content hash, are skipped on the
+next run. Images can be written as PNG at any compression level, all
+lossless, or as raw .npy arrays. Labels can be written as indented JSON, as
+the notebook does, or in the binary .cores format.
+
+Example:
+    python pad_images.py TMA_WSI_PNGs TMA_WSI_Labels_old TMA_WSI_Padded_PNGs TMA_WSI_Labels_updated --workers 4
+    python pad_images.py augmented_images augmented_labels tiles_img tiles_lbl --size 2048 2048 --tile 512 \
+        --overlap 64 --compression 1 --label-format cores
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import core_detection
+from label_io import BINARY_EXTENSION, JSON_EXTENSION, find_label, load_labels, write_cores
+from result_cache import file_hash
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+IMAGE_FORMATS = ('png', 'npy')
+LABEL_FORMATS = ('json', 'cores')
+MANIFEST_FILE = '.pad_images_manifest.json'
+
+
+def pad_and_crop(image, labels, size, fill=255):
+    """
+    Crop an image to the top left size pixels and pad it with fill, keeping the
+    cores whose centre lies on the canvas.
+    :param image: (H, W, 3) uint8 RGB image.
+    :param labels: List of {x, y, radius} dictionaries.
+    :param size: (height, width) of the canvas.
+    :return: ((height, width, 3) uint8 canvas, kept labels).
+    """
+    height, width = size
+    canvas = np.full((height, width, 3), fill, dtype=np.uint8)
+    crop = image[:height, :width]
+    canvas[:crop.shape[0], :crop.shape[1]] = crop
+    return canvas, [label for label in labels if label['x'] < width and label['y'] < height]
+
+
+def tile_origins(length, tile, overlap=0):
+    """
+    Start of every tile along one axis, spaced tile - overlap apart. The last
+    tile may reach past length and is padded.
+    """
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError("overlap must be smaller than the tile size")
+    count = max(1, int(math.ceil((length - overlap) / stride)))
+    return [i * stride for i in range(count)]
+
+
+def cut_tiles(image, labels, tile, overlap=0, fill=255):
+    """
+    Cut an image into tiles, shifting every core into the tile its centre falls in.
+    :param tile: (height, width) of the tiles.
+    :return: Generator of (tile row, tile column, (height, width, 3) tile, tile labels).
+    """
+    tile_height, tile_width = tile
+    x = np.array([label['x'] for label in labels], dtype=np.float64)
+    y = np.array([label['y'] for label in labels], dtype=np.float64)
+
+    for row, top in enumerate(tile_origins(image.shape[0], tile_height, overlap)):
+        for col, left in enumerate(tile_origins(image.shape[1], tile_width, overlap)):
+            canvas, _ = pad_and_crop(image[top:top + tile_height, left:left + tile_width], [], tile, fill)
+            inside = np.flatnonzero((x >= left) & (x < left + tile_width) & (y >= top) & (y < top + tile_height))
+            tile_labels = [
+                dict(labels[i], x=labels[i]['x'] - left, y=labels[i]['y'] - top) for i in inside.tolist()
+            ]
+            yield row, col, canvas, tile_labels
+
+
+def save_image(image, path, compression=6):
+    """
+    Write an image losslessly: .npy as a raw array, anything else with PIL.
+    :param compression: PNG compression level, 0 (fastest) to 9 (smallest).
+    """
+    if path.endswith('.npy'):
+        np.save(path, image)
+    else:
+        Image.fromarray(image).save(path, compress_level=compression)
+
+
+def save_labels(labels, path):
+    # Indented JSON as the notebook writes it, or the binary format for .cores paths
+    if path.endswith(BINARY_EXTENSION):
+        write_cores(path, labels)
+    else:
+        with open(path, 'w') as file:
+            json.dump(labels, file, indent=4)
+
+
+def _source_key(image_path, label_path, check, settings):
+    # Identifies the inputs and settings an output was made from
+    if check == 'hash':
+        sources = [file_hash(path) if path else None for path in (image_path, label_path)]
+    else:
+        sources = [(os.stat(path).st_mtime_ns, os.stat(path).st_size) if path else None
+                   for path in (image_path, label_path)]
+    return hashlib.sha1(json.dumps([sources, settings]).encode()).hexdigest()
+
+
+def preprocess_file(image_path, label_path, output_image_dir, output_label_dir, size=(1024, 1024), tile=None,
+                    overlap=0, image_format='png', compression=6, label_format='json', fill=255):
+    """
+    Pad or crop one slide, optionally cut it into tiles, and write the images and labels.
+    :param label_path: Labels of the slide, or None to only write images.
+    :param size: (height, width) of the canvas, or None to keep the image size when tiling.
+    :param tile: (height, width) of the tiles, or None for a single canvas.
+    :return: Paths of the written files.
+    """
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    image = core_detection.load_image(image_path)
+    labels = load_labels(label_path) if label_path is not None else []
+    if size is not None:
+        image, labels = pad_and_crop(image, labels, size, fill)
+
+    if tile is None:
+        outputs = [(name, image, labels)]
+    else:
+        outputs = [(f'{name}_{row}_{col}', tile_image, tile_labels)
+                   for row, col, tile_image, tile_labels in cut_tiles(image, labels, tile, overlap, fill)]
+
+    written = []
+    label_extension = BINARY_EXTENSION if label_format == 'cores' else JSON_EXTENSION
+    for output_name, output_image, output_labels in outputs:
+        image_output_path = os.path.join(output_image_dir, f'{output_name}.{image_format}')
+        save_image(output_image, image_output_path, compression)
+        written.append(image_output_path)
+        if label_path is not None:
+            label_output_path = os.path.join(output_label_dir, output_name + label_extension)
+            save_labels(output_labels, label_output_path)
+            written.append(label_output_path)
+    return written
+
+
+def _process(job):
+    filename, key, kwargs = job
+    return filename, key, preprocess_file(**kwargs)
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, path)
+
+
+def preprocess_directory(image_dir, label_dir, output_image_dir, output_label_dir=None, size=(1024, 1024), tile=None,
+                         overlap=0, image_format='png', compression=6, label_format='json', fill=255, check='mtime',
+                         overwrite=False, workers=1):
+    """
+    Preprocess every image in image_dir, skipping slides whose outputs are up to date.
+    :param label_dir: Directory of the labels, or None to only write images. Images without labels are skipped.
+    :param check: 'mtime' compares modification times and sizes of the inputs, 'hash' their content.
+    :param overwrite: Process every slide, up to date or not.
+    :param workers: Number of worker processes.
+    :return: (number of slides processed, number skipped as up to date).
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"image_format must be one of {IMAGE_FORMATS}, got {image_format!r}")
+    if label_format not in LABEL_FORMATS:
+        raise ValueError(f"label_format must be one of {LABEL_FORMATS}, got {label_format!r}")
+    output_label_dir = output_label_dir or output_image_dir
+    os.makedirs(output_image_dir, exist_ok=True)
+    if label_dir is not None:
+        os.makedirs(output_label_dir, exist_ok=True)
+
+    settings = [size and list(size), tile and list(tile), overlap, image_format, compression, label_format, fill,
+                os.path.abspath(output_label_dir)]
+    manifest_path = os.path.join(output_image_dir, MANIFEST_FILE)
+    manifest = _load_manifest(manifest_path)
+
+    # Step 1: Find the slides whose outputs are missing or were made from other inputs or settings
+    jobs, skipped = [], 0
+    for filename in sorted(os.listdir(image_dir)):
+        name, extension = os.path.splitext(filename)
+        if extension.lower() not in IMAGE_EXTENSIONS:
+            continue
+        image_path = os.path.join(image_dir, filename)
+        label_path = None
+        if label_dir is not None:
+            label_path = find_label(label_dir, name)
+            if not os.path.exists(label_path):
+                continue
+
+        key = _source_key(image_path, label_path, check, settings)
+        entry = manifest.get(filename)
+        if not overwrite and entry is not None and entry['key'] == key and all(map(os.path.exists, entry['outputs'])):
+            skipped += 1
+            continue
+        jobs.append((filename, key, dict(
+            image_path=image_path, label_path=label_path, output_image_dir=output_image_dir,
+            output_label_dir=output_label_dir, size=size, tile=tile, overlap=overlap, image_format=image_format,
+            compression=compression, label_format=label_format, fill=fill,
+        )))
+
+    # Step 2: Process them as a stream over the pool, the manifest is saved even if a slide fails
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                for filename, key, outputs in executor.map(_process, jobs, chunksize=4):
+                    manifest[filename] = {'key': key, 'outputs': outputs}
+        else:
+            for filename, key, outputs in map(_process, jobs):
+                manifest[filename] = {'key': key, 'outputs': outputs}
+    finally:
+        _save_manifest(manifest, manifest_path)
+    return len(jobs), skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pad, crop and tile slides together with their labels.')
+    parser.add_argument('image_dir', help='Directory of slide images, e.g. TMA_WSI_PNGs')
+    parser.add_argument('label_dir', help="Directory of the slides' labels, or '-' to only process images")
+    parser.add_argument('output_image_dir', help='Where the images are written')
+    parser.add_argument('output_label_dir', nargs='?', help='Where the labels are written, the image directory by default')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+                        help='Canvas size, 1024 1024 by default, or the image size when tiling')
+    parser.add_argument('--tile', type=int, nargs='+', metavar='SIZE', help='Tile size, one side or HEIGHT WIDTH')
+    parser.add_argument('--overlap', type=int, default=0, help='Overlap between neighbouring tiles in pixels')
+    parser.add_argument('--image-format', choices=IMAGE_FORMATS, default='png', help='png, or npy for raw arrays')
+    parser.add_argument('--compression', type=int, default=6, choices=range(10), metavar='0-9',
+                        help='PNG compression level, 1 encodes several times faster than the default')
+    parser.add_argument('--label-format', choices=LABEL_FORMATS, default='json', help='Indented JSON or binary .cores')
+    parser.add_argument('--fill', type=int, default=255, help='Value of the padding')
+    parser.add_argument('--check', choices=('mtime', 'hash'), default='mtime',
+                        help='How unchanged inputs are detected: modification time and size, or content hash')
+    parser.add_argument('--overwrite', action='store_true', help='Reprocess slides that are up to date')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    size = tuple(args.size) if args.size else None
+    if size is None and args.tile is None:
+        size = (1024, 1024)
+    tile = None
+    if args.tile:
+        if len(args.tile) > 2:
+            parser.error('--tile takes one or two sizes')
+        tile = (args.tile[0], args.tile[-1])
+
+    processed, skipped = preprocess_directory(
+        args.image_dir, None if args.label_dir == '-' else args.label_dir, args.output_image_dir,
+        args.output_label_dir, size, tile, args.overlap, args.image_format, args.compression, args.label_format,
+        args.fill, args.check, args.overwrite, args.workers,
+    )
+    print(f"{processed} slides processed, {skipped} up to date, written to {args.output_image_dir}")
+
+
+if __name__ == '__main__':
+    main()
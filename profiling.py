@@ -0,0 +1,320 @@
+"""
+Spans around the dearraying stages: durations, element counts and memory.
+
+Stages are wrapped in spans, with the profiled decorator or the span context
+manager. While profiling is disabled, which is the default, a span is one
+global lookup returning a shared no-op object. Once enabled, every span
+records its start, duration, process, thread, nesting depth, the attributes
+of the spans it is nested in (e.g. the slide name), the counts it reports and
+the change of the process' resident memory. Spans are written as JSON lines
+(.jsonl) or in the Chrome trace format (.json), which chrome://tracing and
+Perfetto load.
+
+Example:
+    profiling.enable()
+    with profiling.span('slide', slide='158867'):
+        edges = get_edges_from_coordinates(coordinates)   # decorated, records a 'triangulation' span
+    profiling.disable('trace.json')
+    python profiling.py trace.json --factor 10
+"""
+import argparse
+import functools
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+# Active profiler, None while profiling is disabled
+_profiler = None
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def _rss_bytes():
+    # Current resident set size, None where /proc is not available
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class _NullSpan:
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    enabled = True
+
+    def __init__(self, profiler, name, attributes):
+        self.profiler = profiler
+        self.name = name
+        self.attributes = attributes
+        self.counts = {}
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        if stack:
+            self.attributes = dict(stack[-1].attributes, **self.attributes)
+        self.depth = len(stack)
+        stack.append(self)
+
+        self.rss = _rss_bytes() if self.profiler.memory else None
+        self.traced = tracemalloc.get_traced_memory()[0] if self.profiler.memory and tracemalloc.is_tracing() else None
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        self.profiler.stack().pop()
+
+        event = {
+            'name': self.name,
+            'start': self.wall_start,
+            'duration': duration,
+            'pid': os.getpid(),
+            'thread': threading.get_ident(),
+            'depth': self.depth,
+            'args': dict(self.attributes, **self.counts),
+        }
+        if self.rss is not None:
+            event['rss_delta'] = _rss_bytes() - self.rss
+        if self.traced is not None and tracemalloc.is_tracing():
+            event['traced_delta'] = tracemalloc.get_traced_memory()[0] - self.traced
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+        self.profiler.events.append(event)
+        return False
+
+    def count(self, **counts):
+        """
+        Attach element counts to the span, e.g. span.count(edges=len(edges)).
+        """
+        self.counts.update(counts)
+
+
+class Profiler:
+    """
+    Collects the spans of one process.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []
+        self._local = threading.local()
+
+    def stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+
+def enable(memory=True):
+    """
+    Start recording spans in this process.
+    :param memory: Whether to record the resident memory change of every span, and the traced memory change
+        while tracemalloc is tracing.
+    :return: The Profiler.
+    """
+    global _profiler
+    _profiler = Profiler(memory)
+    return _profiler
+
+
+def disable(path=None):
+    """
+    Stop recording spans, writing them to path if given.
+    :return: The recorded spans.
+    """
+    global _profiler
+    events = collect()
+    _profiler = None
+    if path is not None:
+        write_events(events, path)
+    return events
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def span(name, **attributes):
+    """
+    Context manager timing a stage. Attributes are passed on to the spans nested inside it.
+    """
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(_profiler, name, attributes)
+
+
+def profiled(name, counts=None):
+    """
+    Decorator recording a span around every call of a function.
+    :param name: Span name.
+    :param counts: Optional callable(result, *args, **kwargs) returning a dictionary of counts.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _Span(_profiler, name, {}) as current:
+                result = function(*args, **kwargs)
+                if counts is not None:
+                    current.count(**counts(result, *args, **kwargs))
+                return result
+        return wrapper
+    return decorator
+
+
+def collect():
+    """
+    Take the spans recorded so far, e.g. to send them from a worker to the main process.
+    """
+    if _profiler is None:
+        return []
+    events, _profiler.events = _profiler.events, []
+    return events
+
+
+def record(events):
+    """
+    Add spans recorded elsewhere, e.g. returned by a worker process.
+    """
+    if _profiler is not None:
+        _profiler.events.extend(events)
+
+
+def to_chrome_trace(events):
+    """
+    Spans in the Chrome trace event format.
+    """
+    trace_events = []
+    for event in events:
+        args = dict(event['args'])
+        for key in ('rss_delta', 'traced_delta', 'error'):
+            if key in event:
+                args[key] = event[key]
+        trace_events.append({
+            'name': event['name'],
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['duration'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['thread'],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_events(events, path):
+    """
+    Write spans as JSON lines, or as a Chrome trace if path ends in .json.
+    """
+    with open(path, 'w') as file:
+        if path.endswith('.json'):
+            json.dump(to_chrome_trace(events), file)
+        else:
+            for event in events:
+                file.write(json.dumps(event) + '\n')
+
+
+def load_events(path):
+    """
+    Read spans written by write_events, in either format.
+    """
+    with open(path) as file:
+        if not path.endswith('.json'):
+            return [json.loads(line) for line in file if line.strip()]
+        trace = json.load(file)
+
+    events = []
+    for trace_event in trace['traceEvents']:
+        args = dict(trace_event.get('args', {}))
+        event = {
+            'name': trace_event['name'],
+            'start': trace_event['ts'] / 1e6,
+            'duration': trace_event['dur'] / 1e6,
+            'pid': trace_event['pid'],
+            'thread': trace_event['tid'],
+        }
+        for key in ('rss_delta', 'traced_delta', 'error'):
+            if key in args:
+                event[key] = args.pop(key)
+        event['args'] = args
+        events.append(event)
+    return events
+
+
+def summarize(events):
+    """
+    Statistics of the span durations per name.
+    :return: {name: {'calls', 'total', 'median', 'max'}} in seconds, in order of first appearance.
+    """
+    durations = defaultdict(list)
+    for event in events:
+        durations[event['name']].append(event['duration'])
+    return {
+        name: {'calls': len(values), 'total': sum(values), 'median': statistics.median(values), 'max': max(values)}
+        for name, values in durations.items()
+    }
+
+
+def outliers(events, factor=10.0, min_seconds=0.01):
+    """
+    Spans that took factor times longer than the median span of the same name.
+    :param min_seconds: Spans shorter than this are never reported.
+    :return: List of (span, times the median), slowest relative to the median first.
+    """
+    medians = {name: stats['median'] for name, stats in summarize(events).items()}
+    found = []
+    for event in events:
+        median = medians[event['name']]
+        if event['duration'] >= min_seconds and event['duration'] > factor * median:
+            found.append((event, event['duration'] / median if median > 0 else float('inf')))
+    return sorted(found, key=lambda item: -item[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize recorded spans and list the outliers.')
+    parser.add_argument('path', help='Spans written by write_events (.jsonl or Chrome trace .json)')
+    parser.add_argument('--factor', type=float, default=10.0, help='Report spans this many times the median')
+    args = parser.parse_args(argv)
+
+    events = load_events(args.path)
+    print(f"{'span':<20}{'calls':>8}{'total (s)':>12}{'median (ms)':>13}{'max (ms)':>12}")
+    for name, stats in summarize(events).items():
+        print(f"{name:<20}{stats['calls']:>8}{stats['total']:>12.2f}"
+              f"{1000 * stats['median']:>13.2f}{1000 * stats['max']:>12.1f}")
+
+    found = outliers(events, args.factor)
+    if found:
+        print(f"\nSpans over {args.factor:g}x their median:")
+    for event, ratio in found:
+        context = ', '.join(f'{key}={value}' for key, value in event['args'].items())
+        print(f"  {event['name']}: {1000 * event['duration']:.1f} ms, {ratio:.1f}x ({context})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Content-addressed cache of intermediate dearraying results.
+
+Every pipeline stage is stored under a key built from the key of the stage
+it consumes plus only the hyperparameters the stage itself reads, starting
+from a hash of the image file. Rerunning a slide with, e.g., another
+radius_multiplier reads the probability mask, centroids, filtered edges and
+rotation back and only repeats the traveling algorithm.
+
+Entries are pickles in one directory, so several worker processes can share
+a cache. Once the directory exceeds its size budget the least recently used
+entries are removed, down to a fraction of the budget so the directory is not
+scanned again on every write. Entries that fail to load are removed and count
+as misses.
+
+Example:
+    cache = ResultCache('result_cache', max_bytes=2 ** 30)
+    key = stage_key('segmentation', predict_key, detection_params)
+    cores = cache.get_or_compute(key, lambda: segment(...))
+"""
+import hashlib
+import json
+import os
+import pickle
+
+DEFAULT_MAX_BYTES = 1 << 30
+# Eviction trims the cache to this fraction of its budget
+LOW_WATER_MARK = 0.9
+# Writes between rescans of the directory, which catch up with the entries other processes wrote
+SCAN_INTERVAL = 256
+
+# Hyperparameters read by each stage, on top of the output of the stage before it
+STAGE_PARAMETERS = {
+    'predict': ('model',),
+    'segmentation': ('threshold', 'min_area', 'max_area', 'dis_transform_multiplier'),
+    'cores': (),
+    'filtered_edges': ('threshold_multiplier',),
+    'rotation': ('min_angle', 'max_angle', 'angle_step_size', 'angle_threshold'),
+    'rows': ('threshold_angle', 'multiplier', 'search_angle', 'radius_multiplier', 'user_radius'),
+}
+
+_MISSING = object()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-1 of a file's content.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_hash(model_path):
+    """
+    Hash of everything a model is loaded from: a Keras file, a SavedModel
+    directory, or a tfjs model.json with the weight shards next to it.
+    """
+    if os.path.isdir(model_path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(model_path) for name in names)
+    elif model_path.endswith('.json'):
+        directory = os.path.dirname(model_path) or '.'
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    else:
+        paths = [model_path]
+    return hashlib.sha1(' '.join(file_hash(path) for path in paths).encode()).hexdigest()
+
+
+def stage_key(stage, parent_key, params):
+    """
+    Key of a stage output.
+    :param stage: Name in STAGE_PARAMETERS.
+    :param parent_key: Key of the input, e.g. the image hash or the key of the previous stage.
+    :param params: Hyperparameters; only the ones the stage reads are part of the key.
+    :return: Hex digest.
+    """
+    values = [params[name] for name in STAGE_PARAMETERS[stage]]
+    return hashlib.sha1(json.dumps([stage, parent_key, values]).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of pickled stage outputs with LRU eviction on a size budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # Size of the directory at the last scan plus what was written since, None before the first scan
+        self._size = None
+        self._writes_since_scan = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            return default
+        try:
+            with file:
+                value = pickle.load(file)
+        except Exception:
+            # Truncated, corrupt or written by an incompatible version of the code: computed again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+        # The modification time doubles as the last access time for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        # Written under a temporary name, so other processes never read a partial entry
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            size = file.tell()
+        os.replace(tmp_path, path)
+
+        self._writes_since_scan += 1
+        if self._size is None or self._writes_since_scan >= SCAN_INTERVAL:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value of key, or compute, store and return it.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        Scan the directory and, if it exceeds the budget, remove the least recently used entries until it fits
+        LOW_WATER_MARK of the budget.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * LOW_WATER_MARK:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self._size = total
+        self._writes_since_scan = 0
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+mask_util = pytest.importorskip("pycocotools.mask")
+
+from coco_eval import encode_masks  # noqa: E402
+
+
+def _probabilities(seed, shape=(6, 1, 45, 38)):
+    generator = torch.Generator().manual_seed(seed)
+    masks = torch.rand(shape, generator=generator) * 0.4
+    for k in range(shape[0] - 1):
+        top, left = torch.randint(0, shape[2] - 5, (2,), generator=generator).tolist()
+        masks[k, 0, top : top + 11, left : left + 9] += torch.rand((1,), generator=generator) + 0.2
+    # Regions touching the image edges, where runs wrap from one column to the next
+    masks[0, 0, -3:, :] = 1
+    masks[1, 0, :, 0] = 1
+    # The last mask stays empty
+    return masks
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_crop_round_trip(seed):
+    masks = _probabilities(seed)
+    rles = encode_masks(masks, crop=True)
+
+    assert rles == encode_masks(masks, crop=False)
+    decoded = mask_util.decode([dict(rle, counts=rle["counts"].encode("utf-8")) for rle in rles])
+    np.testing.assert_array_equal(decoded.transpose(2, 0, 1), (masks[:, 0] > 0.5).numpy())
+
+
+def test_no_masks():
+    assert encode_masks(torch.zeros((0, 1, 8, 8)), crop=True) == []
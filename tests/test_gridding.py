@@ -0,0 +1,95 @@
+"""
+The vectorized gridding and the KDTree traveling algorithm against the
+reference implementation in delaunay_triangle_gridding.ipynb, on the bundled
+labels.
+"""
+import ast
+import json
+import math
+import os
+from collections import defaultdict
+
+import numpy as np
+import pytest
+from scipy.spatial import Delaunay, KDTree
+
+import delaunay_triangulation as gridding
+from data_processing import (
+    DEFAULT_HYPERPARAMETERS,
+    load_data_and_determine_params,
+    normalize_cores,
+)
+from label_io import load_labels
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTEBOOK = os.path.join(ROOT, 'delaunay_triangle_gridding.ipynb')
+LABEL_DIR = os.path.join(ROOT, 'TMA_WSI_Labels_updated')
+# Cells with the edge filtering and the traveling algorithm
+NOTEBOOK_CELLS = (0, 2)
+
+SLIDES = sorted(os.path.splitext(name)[0] for name in os.listdir(LABEL_DIR) if name.endswith('.json'))
+
+
+@pytest.fixture(scope='module')
+def notebook():
+    # Only the function definitions are run, the cells also plot and read files
+    with open(NOTEBOOK) as file:
+        cells = json.load(file)['cells']
+    namespace = {'np': np, 'math': math, 'defaultdict': defaultdict, 'Delaunay': Delaunay, 'KDTree': KDTree}
+    for index in NOTEBOOK_CELLS:
+        tree = ast.parse(''.join(cells[index]['source']))
+        functions = ast.Module([node for node in tree.body if isinstance(node, ast.FunctionDef)], type_ignores=[])
+        exec(compile(functions, NOTEBOOK, 'exec'), namespace)
+    return namespace
+
+
+def _slide(name):
+    coordinates, _ = normalize_cores(load_labels(os.path.join(LABEL_DIR, name + '.json')))
+    return coordinates, load_data_and_determine_params(coordinates, DEFAULT_HYPERPARAMETERS)
+
+
+def _edge_set(edges):
+    return {tuple(int(i) for i in edge) for edge in edges}
+
+
+@pytest.mark.parametrize('name', SLIDES)
+def test_edge_filters_match_notebook(notebook, name):
+    coordinates, params = _slide(name)
+    triangulation = Delaunay(coordinates)
+
+    edges = gridding.get_all_edges_from_triangulation(triangulation)
+    assert _edge_set(edges) == _edge_set(notebook['get_all_edges_from_triangulation'](triangulation))
+
+    length_filtered = gridding.filter_edges_by_length(edges, coordinates, params['threshold_multiplier'])
+    expected = notebook['filter_edges_by_length'](edges, coordinates, params['threshold_multiplier'])
+    assert _edge_set(length_filtered) == _edge_set(expected)
+
+    angle_filtered = gridding.filter_edges_by_angle(
+        length_filtered, coordinates, params['threshold_angle'], params['origin_angle'])
+    expected = notebook['filter_edges_by_angle'](
+        length_filtered, coordinates, params['threshold_angle'], params['origin_angle'])
+    assert _edge_set(angle_filtered) == _edge_set(expected)
+
+    limited = gridding.limit_connections(angle_filtered, coordinates)
+    assert _edge_set(limited) == _edge_set(notebook['limit_connections'](angle_filtered, coordinates))
+
+
+@pytest.mark.parametrize('name', SLIDES)
+def test_traveling_algorithm_matches_notebook(notebook, name):
+    coordinates, params = _slide(name)
+    edges = gridding.filter_edges_by_length(
+        gridding.get_edges_from_coordinates(coordinates), coordinates, params['threshold_multiplier'])
+    edges = gridding.filter_edges_by_angle(edges, coordinates, params['threshold_angle'], params['origin_angle'])
+    edges = gridding.limit_connections(edges, coordinates)
+    segments = coordinates[gridding.sort_edges_and_add_isolated_points(edges, coordinates)]
+
+    arguments = (params['image_width'], params['grid_width'], params['gamma'], params['search_angle'],
+                 params['origin_angle'], params['radius_multiplier'])
+    rows = gridding.traveling_algorithm(segments, *arguments)
+    expected = notebook['traveling_algorithm']([(start, end) for start, end in segments], *arguments)
+
+    assert [[(item['index'], item['is_imaginary']) for item in row] for row in rows] == \
+        [[(item['index'], item['is_imaginary']) for item in row] for row in expected]
+    for row, expected_row in zip(rows, expected):
+        np.testing.assert_allclose([item['point'] for item in row], [item['point'] for item in expected_row])
+
@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import pytest
+
+from label_io import iter_json_cores, load_cores, load_labels, write_cores
+
+CORES = [{'x': 1.5, 'y': 2.0, 'radius': 3.0}, {'x': 4.0, 'y': 5.25, 'radius': 6.0}]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1 << 16])
+@pytest.mark.parametrize('text', [
+    json.dumps(CORES),
+    json.dumps(CORES, indent=4) + '\n',
+    ' [ {"x": 1.5, "y": 2.0, "radius": 3.0} ,\n{"x": 4.0, "y": 5.25, "radius": 6.0} ] ',
+])
+def test_reads_json_lists(tmp_path, text, chunk_size):
+    path = tmp_path / 'cores.json'
+    path.write_text(text)
+    assert list(iter_json_cores(str(path), chunk_size)) == CORES
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1 << 16])
+@pytest.mark.parametrize('text', [
+    '',
+    '{"x": 1}',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0},',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0}',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0}] x',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0},]',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0} {"x": 4.0, "y": 5.25, "radius": 6.0}]',
+    '[{"x": 1.5, "y": 2.0, "radius": 3.0},,{"x": 4.0, "y": 5.25, "radius": 6.0}]',
+    '[,{"x": 1.5, "y": 2.0, "radius": 3.0}]',
+])
+def test_rejects_malformed_json_lists(tmp_path, text, chunk_size):
+    path = tmp_path / 'cores.json'
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iter_json_cores(str(path), chunk_size))
+
+
+def test_empty_json_list(tmp_path):
+    path = tmp_path / 'cores.json'
+    path.write_text('[]')
+    assert list(iter_json_cores(str(path))) == []
+
+
+def test_binary_round_trip(tmp_path):
+    path = str(tmp_path / 'cores.cores')
+    write_cores(path, CORES)
+    assert load_labels(path) == CORES
+    np.testing.assert_array_equal(load_cores(path, mmap=True), np.array([[1.5, 2.0, 3.0], [4.0, 5.25, 6.0]]))
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from masks import rasterize_disks
+
+
+def _reference(x, y, radius, shape):
+    # One skimage.draw.disk call per disk, as the masks used to be drawn
+    draw = pytest.importorskip("skimage.draw")
+    mask = np.zeros(shape, dtype=np.float32)
+    for cx, cy, r in zip(x, y, radius):
+        rows, cols = draw.disk((cy, cx), r, shape=shape)
+        mask[rows, cols] = 1
+    return mask
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (37, 91)])
+def test_matches_skimage(shape):
+    rng = np.random.default_rng(0)
+    count = 200
+    # Centres and radii off the pixel grid, including disks partly or fully outside of the mask
+    x = rng.uniform(-10, shape[1] + 10, count)
+    y = rng.uniform(-10, shape[0] + 10, count)
+    radius = rng.uniform(0.1, 12, count)
+    radius[:5] = [0.5, 1.0, 2.0, 3.0, 0.0]
+    x[:5], y[:5] = 20.0, 20.0
+
+    np.testing.assert_array_equal(rasterize_disks(x, y, radius, shape), _reference(x, y, radius, shape))
+
+
+def test_dtype_and_empty():
+    mask = rasterize_disks(np.array([10.0]), np.array([10.0]), np.array([4.0]), (32, 32), dtype=bool)
+    assert mask.dtype == bool and mask.any()
+    assert not rasterize_disks(np.zeros(0), np.zeros(0), np.zeros(0), (32, 32)).any()
@@ -0,0 +1,29 @@
+import os
+
+from result_cache import ResultCache
+
+
+def test_corrupt_entry_is_recomputed_and_removed(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put('key', list(range(1000)))
+    path = cache._path('key')
+    with open(path, 'rb') as file:
+        truncated = file.read()[:20]
+    with open(path, 'wb') as file:
+        file.write(truncated)
+
+    assert cache.get('key', 'missing') == 'missing'
+    assert not os.path.exists(path)
+    assert cache.get_or_compute('key', lambda: 'computed') == 'computed'
+    assert cache.get('key') == 'computed'
+
+
+def test_eviction_keeps_the_cache_within_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=50_000)
+    for i in range(500):
+        cache.put(f'key_{i}', os.urandom(1000))
+    size = sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+    assert size <= 50_000 + 1100
+    # The newest entry survives, the oldest ones are gone
+    assert cache.get('key_499') is not None
+    assert cache.get('key_0') is None
@@ -0,0 +1,79 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from torchvision import ops  # noqa: E402
+
+import transforms as T  # noqa: E402
+
+
+def _sample(num_instances, seed, size=(64, 64)):
+    generator = torch.Generator().manual_seed(seed)
+    masks = torch.zeros((num_instances, *size), dtype=torch.uint8)
+    for k in range(num_instances):
+        top = int(torch.randint(0, size[0] - 12, (1,), generator=generator))
+        left = int(torch.randint(0, size[1] - 12, (1,), generator=generator))
+        masks[k, top : top + 10, left : left + 12] = 1
+    target = {
+        "boxes": ops.masks_to_boxes(masks),
+        "labels": torch.ones(num_instances, dtype=torch.int64),
+        "masks": masks,
+    }
+    return torch.rand((3, *size), generator=generator), target
+
+
+def _with_crops(target):
+    target = copy.deepcopy(target)
+    target["mask_crops"], target["mask_offsets"] = T.masks_to_crops(target.pop("masks"))
+    return target
+
+
+@pytest.mark.parametrize("blending", [True, False])
+def test_copy_paste_onto_empty_target(blending):
+    image, target = _sample(0, seed=1)
+    paste_image, paste_target = _sample(3, seed=2)
+    torch.manual_seed(0)
+    _, out = T._copy_paste(image, target, paste_image, paste_target, blending=blending)
+
+    # Only pasted instances are left, and their boxes are those of their masks
+    assert len(out["masks"]) == len(out["boxes"]) == len(out["labels"]) > 0
+    assert torch.equal(out["boxes"], ops.masks_to_boxes(out["masks"]))
+
+
+def test_crops_to_boxes_without_instances():
+    boxes = T._crops_to_boxes(torch.zeros((0, 0, 0), dtype=torch.uint8), torch.zeros((0, 2), dtype=torch.int64))
+    assert boxes.shape == (0, 4)
+
+
+@pytest.mark.parametrize(
+    "transform",
+    [
+        T.RandomHorizontalFlip(1.0),
+        T.ScaleJitter((64, 64), (0.3, 2.5)),
+        T.FixedSizeCrop((50, 40)),
+        T.RandomIoUCrop(),
+        T.RandomShortestSize([40, 71, 130], 200),
+        T.RandomZoomOut(p=1.0),
+    ],
+    ids=lambda transform: type(transform).__name__,
+)
+@pytest.mark.parametrize("batched", [False, True])
+def test_mask_crops_match_masks(transform, batched):
+    for seed in range(10):
+        image, target = _sample(5, seed, size=(97, 83))
+        outputs = []
+        for sample_target in (copy.deepcopy(target), _with_crops(target)):
+            torch.manual_seed(seed)
+            if batched:
+                output_image, (output,) = transform.forward_batch(image[None].clone(), [sample_target])
+            else:
+                output_image, output = transform(image.clone(), sample_target)
+            outputs.append((output_image, output))
+
+        (_, expected), (output_image, output) = outputs
+        masks = T.crops_to_masks(output["mask_crops"], output["mask_offsets"], list(output_image.shape[-2:]))
+        assert torch.equal(masks, expected["masks"])
+        assert torch.equal(output["boxes"], expected["boxes"])
@@ -0,0 +1,133 @@
+"""
+File-based tf.data input pipeline for the Keras training scripts.
+
+Slides are read from disk while training instead of being loaded into a
+Python list and embedded in the graph with tf.constant, so the training set
+is no longer limited to what fits in host memory. PNGs are decoded and label
+files parsed in parallel map calls. Decoded slides can be cached in files on
+disk during the first epoch, and batches are prefetched while the model
+trains.
+
+Example:
+    pairs = find_pairs('augmented_images', 'augmented_labels')
+    train, val = split_folds(pairs, num_folds=5, fold=0)
+    model.fit(make_dataset(train, 'mask', batch_size=8, cache_dir='tf_cache'),
+              validation_data=make_dataset(val, 'mask', shuffle=False), ...)
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from label_io import load_labels
+from masks import ORIGINAL_SIZE, load_mask, resize_labels
+
+TARGETS = ('mask', 'boxes')
+
+
+def label_boxes(label_path, size=(512, 512), original_size=ORIGINAL_SIZE, max_boxes=100):
+    """
+    Normalized [ymin, xmin, ymax, xmax] boxes of the cores, zero padded, as
+    convert_to_efficientdet_format and pad_labels in efficientdet.py build them.
+    :param label_path: Path to the JSON or binary labels, drawn on an original_size image.
+    :param size: (height, width) the image is resized to.
+    :param max_boxes: Number of boxes kept and padded to.
+    :return: (max_boxes, 4) float32 array.
+    """
+    labels = resize_labels(load_labels(label_path), original_size, size)
+    x, y, radius = (np.array([label[key] for label in labels], dtype=np.float64) for key in ('x', 'y', 'radius'))
+
+    corners = np.stack([
+        (y - radius) / size[0], (x - radius) / size[1], (y + radius) / size[0], (x + radius) / size[1],
+    ], axis=1).reshape(-1, 4)
+    corners[:, :2] = np.maximum(corners[:, :2], 0)
+    corners[:, 2:] = np.minimum(corners[:, 2:], 1)
+
+    boxes = np.zeros((max_boxes, 4), dtype=np.float32)
+    boxes[:min(len(corners), max_boxes)] = corners[:max_boxes]
+    return boxes
+
+
+def _decode_image(image_path, size):
+    image = tf.io.decode_png(tf.io.read_file(image_path), channels=3)
+    # Same resizing as load_img(target_size=...), which uses nearest neighbour and keeps uint8
+    return tf.image.resize(image, size, method='nearest')
+
+
+def _cache_name(pairs, *settings):
+    # The cache is reused only for the same files, unchanged since, and the same settings
+    stats = [(image_path, label_path, os.stat(image_path).st_mtime_ns, os.stat(label_path).st_mtime_ns)
+             for _, image_path, label_path in pairs]
+    digest = hashlib.sha1(json.dumps([stats, settings]).encode())
+    return 'tf_dataset_' + digest.hexdigest()
+
+
+def make_dataset(pairs, target='mask', size=(512, 512), batch_size=32, shuffle=True, seed=None, cache_dir=None,
+                 shuffle_buffer=256, num_shards=1, shard_index=0, repeat=False, original_size=ORIGINAL_SIZE,
+                 max_boxes=100):
+    """
+    Build a dataset that reads the slides from disk.
+    :param pairs: (name, image path, label path) of the slides, e.g. from find_pairs or split_folds.
+    :param target: 'mask' for ((H, W, 3) images in [0, 1], (H, W, 1) masks), as load_images_and_labels returns;
+        'boxes' for ((H, W, 3) images in [-1, 1], (max_boxes, 4) boxes, (max_boxes, 1) class labels), as
+        prepare_dataset in efficientdet.py returns.
+    :param size: (height, width) of the images.
+    :param batch_size: Number of slides per batch.
+    :param shuffle: Whether to shuffle the slides on every pass.
+    :param seed: Seed of the shuffle.
+    :param cache_dir: Directory for the on-disk cache of decoded slides, written during the first pass.
+    :param shuffle_buffer: Number of decoded slides the shuffle draws from.
+    :param num_shards: Number of shards the slides are split into, e.g. one per training worker.
+    :param shard_index: Shard read by this dataset.
+    :param repeat: Whether to repeat the slides endlessly.
+    :param original_size: Size the labels were drawn on.
+    :param max_boxes: Number of boxes per slide for target='boxes'.
+    :return: tf.data.Dataset of batches.
+    """
+    if target not in TARGETS:
+        raise ValueError(f"target must be one of {TARGETS}, got {target!r}")
+    pairs = list(pairs)
+    size = tuple(size)
+
+    # Step 1: Shard the file list, so a worker only ever decodes its own slides
+    dataset = tf.data.Dataset.from_tensor_slices(([pair[1] for pair in pairs], [pair[2] for pair in pairs]))
+    if num_shards > 1:
+        dataset = dataset.shard(num_shards, shard_index)
+
+    # Step 2: Decode the images and parse the labels in parallel, kept compact until the batches are built
+    def load(image_path, label_path):
+        image = _decode_image(image_path, size)
+        if target == 'mask':
+            label = tf.numpy_function(
+                lambda path: load_mask(path.decode(), size, np.uint8, original_size), [label_path], tf.uint8)
+            label.set_shape(size)
+        else:
+            label = tf.numpy_function(
+                lambda path: label_boxes(path.decode(), size, original_size, max_boxes), [label_path], tf.float32)
+            label.set_shape((max_boxes, 4))
+        return image, label
+
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+
+    # Step 3: Cache the decoded slides on disk, later passes skip the decoding
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        name = _cache_name(pairs, target, size, original_size, max_boxes, num_shards, shard_index)
+        dataset = dataset.cache(os.path.join(cache_dir, name))
+
+    # Step 4: Shuffle, batch and scale to the format the models are trained on
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+
+    def scale(images, labels):
+        if target == 'mask':
+            return tf.cast(images, tf.float32) / 255.0, tf.cast(labels, tf.float32)[..., tf.newaxis]
+        class_labels = tf.ones_like(labels[..., :1], dtype=tf.int32)
+        return tf.cast(images, tf.float32) / 127.5 - 1, labels, class_labels
+
+    dataset = dataset.batch(batch_size).map(scale, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,231 @@
+"""
+Tiled core detection for slides larger than the 1024x1024 canvas.
+
+The slide is read tile by tile, each tile is resized to the model input and
+predicted, and the predictions are blended with linear ramps where tiles
+overlap. Only one band of tile rows is kept in memory: rows of the mosaic are
+final as soon as the next tile row no longer reaches them, so they are
+emitted as strips and segmented in windows of two consecutive strips. Each
+window only keeps the cores whose centre falls between the middles of its two
+strips, so a core cut by a seam is found whole in exactly one window.
+
+Example:
+    python tiled_inference.py scan.svs --model core_segmentation.tflite --downsample 2 --output scan_cores.json
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import core_detection
+
+SLIDE_EXTENSIONS = ('.svs', '.ndpi', '.mrxs', '.scn', '.vms', '.vmu', '.bif')
+
+
+class ArraySlide:
+    """Slide backed by an (H, W, 3) uint8 array, e.g. an np.memmap."""
+
+    def __init__(self, array):
+        self.array = array
+        self.height, self.width = array.shape[:2]
+
+    def read_region(self, x, y, width, height):
+        return np.asarray(self.array[y:y + height, x:x + width, :3])
+
+
+class OpenSlideSlide:
+    """Slide read region by region from level 0 of a whole-slide file."""
+
+    def __init__(self, path):
+        import openslide
+
+        self.slide = openslide.OpenSlide(path)
+        self.width, self.height = self.slide.dimensions
+
+    def read_region(self, x, y, width, height):
+        width, height = min(width, self.width - x), min(height, self.height - y)
+        region = self.slide.read_region((x, y), 0, (width, height))
+        return np.asarray(region.convert('RGB'))
+
+
+def open_slide(path):
+    """
+    Open a slide for tiled reading. Whole-slide formats go through openslide
+    and are read lazily; other images are decoded once with PIL.
+    :param path: Path to the slide.
+    :return: Object with width, height and read_region(x, y, width, height).
+    """
+    if path.lower().endswith(SLIDE_EXTENSIONS):
+        return OpenSlideSlide(path)
+
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = None
+    return ArraySlide(core_detection.load_image(path))
+
+
+def blend_weights(tile_size, overlap):
+    # Linear ramp over the overlap on every side, 1 in the middle of the tile
+    ramp = np.minimum(np.arange(1, tile_size + 1), np.arange(tile_size, 0, -1)) / (overlap + 1)
+    ramp = np.clip(ramp, 0, 1).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+def _read_tile(slide, x, y, tile_size, downsample):
+    import cv2
+
+    # Tiles that run past the slide edge are zero padded, like the padded training canvases
+    region_size = int(round(tile_size * downsample))
+    region = slide.read_region(x, y, region_size, region_size)
+    region = core_detection.pad_image_to_size(region, region_size, region_size)
+    if region_size != tile_size:
+        region = cv2.resize(region, (tile_size, tile_size), interpolation=cv2.INTER_LINEAR)
+    return region.astype(np.float32) / 255.0
+
+
+def predict_tiled(slide, predict, tile_size=core_detection.MODEL_INPUT_SIZE, overlap=64, downsample=2,
+                  batch_size=4):
+    """
+    Predict the probability mosaic of a slide in strips.
+    :param slide: Object returned by open_slide.
+    :param predict: Callable mapping an (N, tile_size, tile_size, 3) float32 batch to (N, tile_size, tile_size[, 1]).
+    :param tile_size: Side length of a tile in model pixels.
+    :param overlap: Overlap between neighbouring tiles in model pixels.
+    :param downsample: Slide pixels per model pixel.
+    :param batch_size: Number of tiles predicted at once.
+    :return: Generator of (first mosaic row, (rows, mosaic width) float32 strip), top to bottom.
+    """
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError("overlap must be smaller than tile_size")
+
+    mosaic_height = int(np.ceil(slide.height / downsample))
+    mosaic_width = int(np.ceil(slide.width / downsample))
+    n_rows = max(1, int(np.ceil((mosaic_height - overlap) / stride)))
+    n_cols = max(1, int(np.ceil((mosaic_width - overlap) / stride)))
+    band_width = (n_cols - 1) * stride + tile_size
+    weights = blend_weights(tile_size, overlap)
+
+    band = np.zeros((tile_size, band_width), dtype=np.float32)
+    band_weight = np.zeros((tile_size, band_width), dtype=np.float32)
+
+    for row in range(n_rows):
+        y = row * stride
+
+        # Step 1: Predict every tile of the row and add it to the band
+        for start in range(0, n_cols, batch_size):
+            cols = range(start, min(start + batch_size, n_cols))
+            batch = np.stack([
+                _read_tile(slide, int(round(col * stride * downsample)), int(round(y * downsample)), tile_size,
+                           downsample)
+                for col in cols
+            ])
+            predictions = np.asarray(predict(batch), dtype=np.float32).reshape(len(cols), tile_size, tile_size)
+            for col, prediction in zip(cols, predictions):
+                x = col * stride
+                band[:, x:x + tile_size] += prediction * weights
+                band_weight[:, x:x + tile_size] += weights
+
+        # Step 2: Emit the rows no later tile reaches, and shift the band up
+        final_rows = stride if row < n_rows - 1 else tile_size
+        final_rows = min(final_rows, mosaic_height - y)
+        yield y, band[:final_rows, :mosaic_width] / band_weight[:final_rows, :mosaic_width]
+
+        band = np.roll(band, -stride, axis=0)
+        band_weight = np.roll(band_weight, -stride, axis=0)
+        band[-stride:] = 0
+        band_weight[-stride:] = 0
+
+
+def detect_cores_tiled(slide, predict, threshold=0.5, min_area=0, max_area=2000, dis_transform_multiplier=0.625,
+                       tile_size=core_detection.MODEL_INPUT_SIZE, overlap=64, downsample=2, batch_size=4):
+    """
+    Detect the cores of a slide of any size.
+    :param slide: Object returned by open_slide.
+    :param predict: See predict_tiled.
+    :return: List of {'x', 'y', 'radius'} dictionaries in slide pixels.
+    """
+    cores = []
+
+    def segment(window_y, window, own_from, own_to):
+        properties = core_detection.segmentation_algorithm(
+            core_detection.apply_threshold(window, threshold), min_area, max_area, dis_transform_multiplier
+        )
+        for prop in properties.values():
+            y = prop['y'] + window_y
+            if own_from <= y < own_to:
+                cores.append({
+                    'x': prop['x'] * downsample,
+                    'y': y * downsample,
+                    'radius': prop['radius'] * downsample,
+                })
+
+    # A window is only segmented once the next strip arrives, so the last one can own the bottom of the slide
+    previous = None
+    window = None
+    own_from = 0
+    for y, strip in predict_tiled(slide, predict, tile_size, overlap, downsample, batch_size):
+        if previous is not None:
+            if window is not None:
+                own_to = previous[0] + len(previous[1]) / 2
+                segment(*window, own_from, own_to)
+                own_from = own_to
+            window = (previous[0], np.concatenate([previous[1], strip]))
+        previous = (y, strip)
+
+    if window is None:
+        window = previous
+    segment(*window, own_from, np.inf)
+    return cores
+
+
+def load_predict(model_path):
+    """
+    Build a batch predict callable from an exported .tflite/.onnx model or a
+    Keras/TensorFlow.js model.
+    """
+    if model_path.endswith(('.tflite', '.onnx')):
+        from inference_server import load_segmenter
+
+        return load_segmenter(model_path).predict
+
+    model = core_detection.load_model(model_path)
+    return lambda batch: model.predict(batch, verbose=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect the cores of a large slide tile by tile.')
+    parser.add_argument('slide', help='Whole-slide file or image')
+    parser.add_argument('--model', required=True, help='Exported .tflite/.onnx model, tfjs model.json or Keras .hdf5')
+    parser.add_argument('--output', help='Where the {x, y, radius} JSON is written (default: next to the slide)')
+    parser.add_argument('--downsample', type=float, default=2, help='Slide pixels per model pixel')
+    parser.add_argument('--tile-size', type=int, default=core_detection.MODEL_INPUT_SIZE)
+    parser.add_argument('--overlap', type=int, default=64, help='Tile overlap in model pixels')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--min-area', type=int, default=0)
+    parser.add_argument('--max-area', type=int, default=2000)
+    parser.add_argument('--dis-transform-multiplier', type=float, default=0.625)
+    args = parser.parse_args(argv)
+
+    cores = detect_cores_tiled(
+        open_slide(args.slide),
+        load_predict(args.model),
+        args.threshold,
+        args.min_area,
+        args.max_area,
+        args.dis_transform_multiplier,
+        args.tile_size,
+        args.overlap,
+        args.downsample,
+        args.batch_size,
+    )
+    output = args.output or os.path.splitext(args.slide)[0] + '_cores.json'
+    with open(output, 'w') as file:
+        json.dump(cores, file)
+    print(f"{len(cores)} cores written to {output}")
+
+
+if __name__ == '__main__':
+    main()